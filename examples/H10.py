@@ -65,17 +65,19 @@ def test_makemole2():
 		impClusters.append(impurity_orbitals)	
 	return mol, mf, impClusters 
 
-for bond in np.arange(0.8, 2.0, 0.2): 
-	mol, mf, impClusters  = test_makemole(bond)
-	symmetry = 'Translation'  #or [0]*5, takes longer time
-	solverlist = 'CASCI' #['RHF', 'CASCI', 'CASCI', 'CASCI', 'CASCI']
-	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'F', solver = solverlist)
-	#runDMET.CAS = [[4,4]]
-	time1 = time.time()
-	runDMET.self_consistent()
-	time2 = time.time()
-	time_mpDMET = time2 - time1
-	print('Total energy + Time:', runDMET.Energy_total, time_mpDMET)
+if __name__ == '__main__':		#Needed with n_workers > 1: the worker processes import this script
+	for bond in np.arange(0.8, 2.0, 0.2): 
+		mol, mf, impClusters  = test_makemole(bond)
+		symmetry = [0, 1, 2, 3, 4]  #or 'Translation', a single irreducible fragment is solved serially
+		solverlist = 'CASCI' #['RHF', 'CASCI', 'CASCI', 'CASCI', 'CASCI']
+		runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'F', solver = solverlist, n_workers = 5)
+		#runDMET.CAS = [[4,4]]
+		time1 = time.time()
+		runDMET.self_consistent()
+		time2 = time.time()
+		time_mpDMET = time2 - time1
+		print('Total energy + Time:', runDMET.Energy_total, time_mpDMET)
+		runDMET.close_workers()
 	
 	'''#QC-DMET	
 	myInts = localintegrals.localintegrals( mf, range( mol.nao_nr() ), 'meta_lowdin' )
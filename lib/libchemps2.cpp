@@ -0,0 +1,137 @@
+/*
+Bulk integral feed and RDM readout for the CheMPS2 DMRG/FCI solvers
+Author: Hung Q. Pham, Unviversity of Minnesota
+email: phamx494@umn.edu
+*/
+
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+#include <pybind11/numpy.h>
+#include <vector>
+#include <tuple>
+#include <memory>
+#include <stdexcept>
+#include <chemps2/Initialize.h>
+#include <chemps2/Hamiltonian.h>
+#include <chemps2/Problem.h>
+#include <chemps2/ConvergenceScheme.h>
+#include <chemps2/DMRG.h>
+#include <chemps2/TwoDM.h>
+#include <chemps2/FCI.h>
+
+namespace py = pybind11;
+
+typedef py::array_t<double, py::array::c_style | py::array::forcecast> numpy_array;
+
+//(D, Econv, maxSweeps, noisePrefactor) of an instruction of the DMRG convergence scheme
+typedef std::tuple<int, double, int, double> instruction;
+
+//CheMPS2 Hamiltonian without point group symmetry from the (Norb, Norb) one-electron Hamiltonian and the (Norb, Norb, Norb, Norb) TEI
+//in chemist notation. CheMPS2 stores one element of each set of elements related by symmetry, so only the unique elements are set:
+//T_ij with i >= j and V_ikjl = (ij|kl) with i >= j, k >= l and ij >= kl
+
+std::unique_ptr<CheMPS2::Hamiltonian> make_hamiltonian(numpy_array &FOCK, numpy_array &TEI)
+{
+	if (FOCK.ndim() != 2 or FOCK.shape(0) != FOCK.shape(1))
+		throw std::runtime_error("FOCK has to be a (Norb, Norb) array");
+	const int Norb = FOCK.shape(0);
+	if (TEI.ndim() != 4 or TEI.shape(0) != Norb or TEI.shape(1) != Norb or TEI.shape(2) != Norb or TEI.shape(3) != Norb)
+		throw std::runtime_error("TEI size does not match with the number of orbitals");
+
+	std::vector<int> orbirreps(Norb, 0);
+	std::unique_ptr<CheMPS2::Hamiltonian> Ham(new CheMPS2::Hamiltonian(Norb, 0, orbirreps.data()));
+	Ham->setEconst(0.0);
+
+	auto T = FOCK.unchecked<2>();
+	auto V = TEI.unchecked<4>();
+	for ( int i = 0; i < Norb; i++ ){
+		for ( int j = 0; j <= i; j++ ){
+			Ham->setTmat(i, j, T(i, j));
+			const int ij = i*(i + 1)/2 + j;
+			for ( int k = 0; k <= i; k++ ){
+				for ( int l = 0; l <= k and k*(k + 1)/2 + l <= ij; l++ ){
+					Ham->setVmat(i, k, j, l, V(i, j, k, l));
+				}
+			}
+		}
+	}
+	return Ham;
+}
+
+//DMRG ground state (singlet, Nel electrons) and its 2RDM (Norb, Norb, Norb, Norb) in chemist notation
+
+py::tuple dmrg(numpy_array FOCK, numpy_array TEI, const int Nel, std::vector<instruction> scheme)
+{
+	if (Nel % 2 != 0) throw std::runtime_error("the number of electrons has to be even");
+	CheMPS2::Initialize::Init();
+	std::unique_ptr<CheMPS2::Hamiltonian> Ham = make_hamiltonian(FOCK, TEI);
+	const int Norb = Ham->getL();
+
+	CheMPS2::Problem Prob(Ham.get(), 0, Nel, 0);		//TwoS = 0, Irrep = 0
+	CheMPS2::ConvergenceScheme OptScheme(scheme.size());
+	for ( size_t count = 0; count < scheme.size(); count++ ){
+		OptScheme.setInstruction(count, std::get<0>(scheme[count]), std::get<1>(scheme[count]), std::get<2>(scheme[count]), std::get<3>(scheme[count]));
+	}
+
+	CheMPS2::DMRG theDMRG(&Prob, &OptScheme);
+	const double EDMRG = theDMRG.Solve();
+	theDMRG.calc2DMandCorrelations();
+
+	// RDM2[p,q,r,s] (chemist) = Gamma_pr,qs (physics)
+	py::array_t<double> RDM2({Norb, Norb, Norb, Norb});
+	auto rdm2 = RDM2.mutable_unchecked<4>();
+	CheMPS2::TwoDM * theTwoDM = theDMRG.get2DM();
+	for ( int p = 0; p < Norb; p++ ){
+		for ( int q = 0; q < Norb; q++ ){
+			for ( int r = 0; r < Norb; r++ ){
+				for ( int s = 0; s < Norb; s++ ){
+					rdm2(p, q, r, s) = theTwoDM->getTwoDMA_HAM(p, r, q, s);
+				}
+			}
+		}
+	}
+	theDMRG.deleteStoredOperators();
+	return py::make_tuple(EDMRG, RDM2);
+}
+
+//FCI ground state (singlet, Nel electrons) and its 2RDM (Norb, Norb, Norb, Norb) in chemist notation
+
+py::tuple fci(numpy_array FOCK, numpy_array TEI, const int Nel, const double maxMemWorkMB)
+{
+	if (Nel % 2 != 0) throw std::runtime_error("the number of electrons has to be even");
+	CheMPS2::Initialize::Init();
+	std::unique_ptr<CheMPS2::Hamiltonian> Ham = make_hamiltonian(FOCK, TEI);
+	const int Norb = Ham->getL();
+
+	CheMPS2::FCI theFCI(Ham.get(), Nel/2, Nel/2, 0, maxMemWorkMB, 0);
+	std::vector<double> GSvector(theFCI.getVecLength(0));
+	theFCI.FillRandom(GSvector.size(), GSvector.data());		//Random numbers in [-1,1]
+	GSvector[theFCI.LowestEnergyDeterminant()] = 12.345;			//Large component for quantum chemistry
+	const double EFCI = theFCI.GSDavidson(GSvector.data());
+
+	// TwoRDM[i + Norb * (j + Norb * (k + Norb * l))] = Gamma_ij,kl (physics), RDM2[p,q,r,s] (chemist) = Gamma_pr,qs
+	const size_t L = Norb;
+	std::vector<double> TwoRDM(L*L*L*L);
+	theFCI.Fill2RDM(GSvector.data(), TwoRDM.data());
+	py::array_t<double> RDM2({Norb, Norb, Norb, Norb});
+	auto rdm2 = RDM2.mutable_unchecked<4>();
+	for ( size_t p = 0; p < L; p++ ){
+		for ( size_t q = 0; q < L; q++ ){
+			for ( size_t r = 0; r < L; r++ ){
+				for ( size_t s = 0; s < L; s++ ){
+					rdm2(p, q, r, s) = TwoRDM[p + L*(r + L*(q + L*s))];
+				}
+			}
+		}
+	}
+	return py::make_tuple(EFCI, RDM2);
+}
+
+
+PYBIND11_PLUGIN(libchemps2)
+{
+	py::module m("libchemps2", "CheMPS2 solvers with NumPy integrals and RDMs");
+	m.def("dmrg", &dmrg, "DMRG energy and 2RDM (chemist notation) from the 1e/2e integrals, scheme: a list of (D, Econv, maxSweeps, noisePrefactor)");
+	m.def("fci", &fci, "FCI energy and 2RDM (chemist notation) from the 1e/2e integrals");
+	return m.ptr();
+}
@@ -10,13 +10,189 @@ email: phamx494@umn.edu
 #include <fstream>
 #include <iostream>
 #include <vector>
+#include <algorithm>
 #include <lawrap/blas.h>
 #include <lawrap/lapack.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
 namespace py = pybind11; 
 
 //Analytical 1RDM derivative for Hamiltonian: H = H0 + H1, ref: J. Chem. Theory Comput. 2016, 12, 2706−2719
+//The terms are processed in blocks of RESPONSE_BLOCK, the terms of a block are distributed over the OpenMP threads 
+//(the BLAS library has to be sequential inside the parallel regions, see SequentialBLAS)
+
+const int RESPONSE_BLOCK = 64;
+
+//The thread controls of a threaded BLAS, they are null unless libdmet is linked against (or loaded with) MKL or OpenBLAS
+extern "C" {
+	int MKL_Get_Max_Threads(void) __attribute__((weak));
+	void MKL_Set_Num_Threads(int nthreads) __attribute__((weak));
+	int openblas_get_num_threads(void) __attribute__((weak));
+	void openblas_set_num_threads(int nthreads) __attribute__((weak));
+}
+
+//Every BLAS call in this file is made by one OpenMP thread on its own block of the work. A threaded BLAS (MKL or OpenBLAS) is set to 
+//one thread while a SequentialBLAS is alive and set back to its previous number of threads afterwards, so the cores are not oversubscribed
+struct SequentialBLAS
+{
+	int mkl_threads = 0, openblas_threads = 0;
+	
+	SequentialBLAS()
+	{
+		if ( MKL_Get_Max_Threads and MKL_Set_Num_Threads ){
+			mkl_threads = MKL_Get_Max_Threads();
+			MKL_Set_Num_Threads(1);
+		}
+		if ( openblas_get_num_threads and openblas_set_num_threads ){
+			openblas_threads = openblas_get_num_threads();
+			openblas_set_num_threads(1);
+		}
+	}
+	
+	~SequentialBLAS()
+	{
+		if ( mkl_threads > 0 ) MKL_Set_Num_Threads(mkl_threads);
+		if ( openblas_threads > 0 ) openblas_set_num_threads(openblas_threads);
+	}
+};
+
+//C = alpha * op(A) * op(B) + beta * C with the n columns of C (and op(B)) split over the OpenMP threads,
+//used for the large gemms outside the loops over the terms since the BLAS library is sequential (SequentialBLAS)
+void parallel_gemm(const char transa, const char transb, const int m, const int n, const int k, const double alpha, 
+			const double * A, const int lda, const double * B, const int ldb, const double beta, double * C, const int ldc)
+{
+	#pragma omp parallel
+	{
+		int nthreads = 1, thread = 0;
+#ifdef _OPENMP
+		nthreads = omp_get_num_threads();
+		thread = omp_get_thread_num();
+#endif
+		const int col_first = (size_t)n*thread/nthreads;
+		const int col_last = (size_t)n*(thread + 1)/nthreads;
+		if ( col_last > col_first ){
+			const double * B_first = (transb == 'N') ? B + (size_t)ldb*col_first : B + col_first;
+			LAWrap::gemm(transa, transb, m, col_last - col_first, k, alpha, A, lda, B_first, ldb, beta, C + (size_t)ldc*col_first, ldc);
+		}
+	}
+}
+
+//Intermediates shared by all terms, eigvecs (column-major) and eigvals are the eigenvectors and eigenvalues of H0 in ascending order
+struct ResponseHelper
+{
+	int Norb, numPairs, nVir, nnz;
+	const std::vector<int> &H1start;
+	const double * occ;
+	const double * virt;
+	std::vector<double> temp;
+	std::vector<double> virtH1row;
+	std::vector<double> occH1col;
+	
+	ResponseHelper(const int inNorb, const int inNumPairs, const std::vector<int> &inH1start, const std::vector<int> &H1row, 
+				const std::vector<int> &H1col, const std::vector<double> &eigvecs, const std::vector<double> &eigvals)
+		: Norb(inNorb), numPairs(inNumPairs), nVir(inNorb - inNumPairs), nnz(H1row.size()), H1start(inH1start)
+	{
+		occ = eigvecs.data();
+		virt = eigvecs.data() + Norb*numPairs;
+		
+		// temp[ vir + nVir * occ ] = - 1 / ( eps_vir - eps_occ )
+		temp.resize(nVir*numPairs);	
+		for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
+			for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+				temp[nVir*orb_occ + orb_vir] = - 1.0 / (eigvals[numPairs + orb_vir] - eigvals[orb_occ]);
+			}
+		}
+		
+		// virtH1row[ elem + nnz * vir ] = VIRT[H1row[elem], vir], occH1col[ elem + nnz * occ ] = OCC[H1col[elem], occ]
+		// i.e. only the rows of the fragment orbitals touched by H1
+		virtH1row.resize(nnz*nVir);
+		occH1col.resize(nnz*numPairs);
+		for ( int elem = 0; elem < nnz; elem++ ){
+			for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ) virtH1row[elem + nnz*orb_vir] = virt[Norb*orb_vir + H1row[elem]];
+			for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ) occH1col[elem + nnz*orb_occ] = occ[Norb*orb_occ + H1col[elem]];
+		}
+	}
+	
+	// Z1 = - VIRT.T * H1 * OCC / ( eps_vir - eps_occ ), Z1 in the equation (44) in JCTC 2016, 12, 2706
+	// computed with a gemm over the H1 elements: VIRT.T * H1 * OCC = VIRT[H1row,:].T * OCC[H1col,:]
+	// Z1 of the term (first + k) is stored in Z1[ nVir * numPairs * k ]
+	void Z1(const int first, const int Nblock, double * Z1) const
+	{
+		const size_t sizeZ1 = nVir*numPairs;
+		#pragma omp parallel for schedule(dynamic)
+		for ( int k = 0; k < Nblock; k++ ){
+			const int deriv = first + k;
+			const int nElem = H1start[deriv + 1] - H1start[deriv];
+			double * Z1_k = Z1 + sizeZ1*k;
+			LAWrap::gemm('T', 'N', nVir, numPairs, nElem, 1.0, virtH1row.data() + H1start[deriv], std::max(nnz, 1), 
+						occH1col.data() + H1start[deriv], std::max(nnz, 1), 0.0, Z1_k, nVir);
+			for ( size_t elem = 0; elem < sizeZ1; elem++ ) Z1_k[elem] *= temp[elem];
+		}
+	}
+};
+
+std::vector<double> response_from_eig(const int Norb, const int Nterms, const int numPairs, const std::vector<int> &H1start, 
+			const std::vector<int> &H1row, const std::vector<int> &H1col, const std::vector<double> &eigvecs, const std::vector<double> &eigvals)
+{
+	const size_t size = Norb * Norb;
+	std::vector<double> rdm_deriv(Nterms*size, 0);
+	SequentialBLAS sequential_blas;
+	ResponseHelper helper(Norb, numPairs, H1start, H1row, H1col, eigvecs, eigvals);
+	const int nVir = helper.nVir;
+	
+	std::vector<double> Z1((size_t)nVir*numPairs*RESPONSE_BLOCK);
+	std::vector<double> work1((size_t)Norb*numPairs*RESPONSE_BLOCK);
+	
+	for ( int first = 0; first < Nterms; first += RESPONSE_BLOCK ){
+		const int Nblock = std::min(RESPONSE_BLOCK, Nterms - first);
+		helper.Z1(first, Nblock, Z1.data());
+		
+		// work1 = 2 * VIRT * Z1 for all the terms of the block in one gemm
+		parallel_gemm('N', 'N', Norb, numPairs*Nblock, nVir, 2.0, helper.virt, Norb, Z1.data(), nVir, 0.0, work1.data(), Norb);
+		
+		#pragma omp parallel
+		{
+			std::vector<double> work2(size);
+			#pragma omp for schedule(static)
+			for ( int k = 0; k < Nblock; k++ ){
+				// work2 = work1 * OCC.T, work2 here is Cvir*Z1*Cocc.T in the equation (45) in JCTC 2016, 12, 2706		
+				LAWrap::gemm('N', 'T', Norb, Norb, numPairs, 1.0, work1.data() + (size_t)Norb*numPairs*k, Norb, helper.occ, Norb, 0.0, work2.data(), Norb);
+				
+				// rdm_deriv[ row + Norb * ( col + Norb * deriv ) ] = work2 + work2.T
+				double * rdm_deriv_k = rdm_deriv.data() + size*(first + k);
+				for ( int row = 0; row < Norb; row++ ){
+					for ( int col = 0; col < Norb; col++ ){
+						rdm_deriv_k[Norb*row + col] = work2[row + Norb*col] + work2[col + Norb*row];
+					}
+				}
+			}
+		}
+	}
+	
+	return rdm_deriv;
+}
+
+//Copy a (Nterms, Norb, Norb) vector to a numpy array
+py::array_t<double> rdm_deriv_to_numpy(const int Norb, const int Nterms, std::vector<double> &rdm_deriv)
+{
+	size_t pyNterms = Nterms;
+	size_t pyNorb = Norb;
+	size_t pyNorb2 = Norb * Norb;
+	py::buffer_info rdm_deriv_buf =
+		{
+			rdm_deriv.data(),
+			sizeof(double),
+			py::format_descriptor<double>::format(),
+			3,
+			{pyNterms, pyNorb, pyNorb},
+			{pyNorb2 * sizeof(double), pyNorb * sizeof(double), sizeof(double)}
+		};
+		
+	return py::array_t<double>(rdm_deriv_buf);
+}
 
 py::array_t<double> rhf_response(const int Norb, const int Nterms, const int numPairs, py::array_t<int> inH1start, 
 			py::array_t<int> inH1row, py::array_t<int> inH1col, py::array_t<double> inH0)
@@ -37,92 +213,214 @@ py::array_t<double> rhf_response(const int Norb, const int Nterms, const int num
 	std::vector<int> H1start(H1start_data, H1start_data + H1start_info.size);
 	std::vector<int> H1row(H1row_data, H1row_data + H1row_info.size);
 	std::vector<int> H1col(H1col_data, H1col_data + H1col_info.size);
-	std::vector<double> H0(H0_data, H0_data + H0_info.size);	
-	std::vector<double> rdm_deriv(Nterms*Norb*Norb, 0);
 
     const int size = Norb * Norb;
-    const int nVir = Norb - numPairs;	
-	
-	std::vector<double> eigvecs(size);
+	std::vector<double> eigvecs(H0_data, H0_data + size);
 	std::vector<double> eigvals(Norb);		
 	
     //eigvecs, eigvals: eigenvectors and eigenvalues of H0
-	int inc = 1;
-	LAWrap::copy(size, H0.data(), inc, eigvecs.data(), inc); 
 	LAWrap::heev('V', 'U',  Norb, eigvecs.data(), Norb, eigvals.data());
 	
-    //Calculating 1RDM: H0 = 2 * OCC * OCC.T
-	LAWrap::gemm('N', 'T', Norb, Norb, numPairs, 2.0, eigvecs.data(), Norb, eigvecs.data(), Norb, 0.0, H0.data(), Norb);
+	std::vector<double> rdm_deriv = response_from_eig(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals);
+	return rdm_deriv_to_numpy(Norb, Nterms, rdm_deriv);
+}	
+
+//Copy a 1D numpy array to a vector
+template <typename T>
+std::vector<T> numpy_to_vector(py::array_t<T> &inArray)
+{
+	py::buffer_info info = inArray.request();
+	const T * data = static_cast<T*>(info.ptr);
+	return std::vector<T>(data, data + info.size);
+}
 
-	//Get the unocc orbitals, for the occ orbitals we can just use eigvals with the appropriate indices
-	std::vector<double>::const_iterator first = eigvecs.begin() + Norb*numPairs;
-	std::vector<double>::const_iterator last = eigvecs.begin() + size;
-	std::vector<double> virt(first, last);
+//Copy a (rows, cols) numpy array (any strides, e.g. a slice of columns) to a column-major vector as used by LAWrap
+std::vector<double> numpy_to_colmajor(py::array_t<double> &inMat, const int rows, const int cols)
+{
+	py::buffer_info info = inMat.request();
+	if (info.ndim != 2 or info.shape[0] != rows or info.shape[1] != cols)
+		throw std::runtime_error("Matrix size does not match");
+	const char * data = static_cast<char*>(info.ptr);
+	std::vector<double> mat(rows*cols);
+	for ( int row = 0; row < rows; row++ ){
+		for ( int col = 0; col < cols; col++ ){
+			mat[rows*col + row] = *reinterpret_cast<const double*>(data + row*info.strides[0] + col*info.strides[1]);
+		}
+	}
+	return mat;
+}
 
-    // temp[ vir + nVir * occ ] = - 1 / ( eps_vir - eps_occ )
-	std::vector<double> temp(nVir*numPairs);	
+//Same as rhf_response, but using the eigenvectors/eigenvalues of H0 already computed in python, i.e. no diagonalization is done here
+//inEigvecs is a (Norb, Norb) array with the eigenvectors as columns, inEigvals is in ascending order
+
+py::array_t<double> rhf_response_eig(const int Norb, const int Nterms, const int numPairs, py::array_t<int> inH1start, 
+			py::array_t<int> inH1row, py::array_t<int> inH1col, py::array_t<double> inEigvecs, py::array_t<double> inEigvals)
+{
+	if (inEigvals.size() != Norb)
+		throw std::runtime_error("Eigenvalues size does not match with the number of basis functions");
+		
+	std::vector<int> H1start = numpy_to_vector(inH1start);
+	std::vector<int> H1row = numpy_to_vector(inH1row);
+	std::vector<int> H1col = numpy_to_vector(inH1col);
+	std::vector<double> eigvals = numpy_to_vector(inEigvals);
+	std::vector<double> eigvecs = numpy_to_colmajor(inEigvecs, Norb, Norb);
 	
-    for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
-        for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
-            temp[nVir*orb_occ + orb_vir] = - 1.0 / (eigvals[numPairs + orb_vir] - eigvals[orb_occ]);
-        }
-    }
+	std::vector<double> rdm_deriv = response_from_eig(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals);
+	return rdm_deriv_to_numpy(Norb, Nterms, rdm_deriv);
+}	
+
+//1RDM response projected onto the Schmidt basis of each fragment: T.T * rdm_deriv[deriv] * T, without building the (Nterms, Norb, Norb) rdm_deriv
+//With rdm_deriv[deriv] = W + W.T and W = 2 * VIRT * Z1 * OCC.T, the projection is A + A.T with A = 2 * (T.T * VIRT) * Z1 * (OCC.T * T)
+//inTransforms is a list of (Norb, n) arrays, the result is a list of (Nterms, n, n) arrays
+
+std::vector<py::array_t<double>> rhf_response_projected(const int Norb, const int Nterms, const int numPairs, py::array_t<int> inH1start, 
+			py::array_t<int> inH1row, py::array_t<int> inH1col, py::array_t<double> inEigvecs, py::array_t<double> inEigvals, 
+			std::vector<py::array_t<double>> inTransforms)
+{
+	if (inEigvals.size() != Norb)
+		throw std::runtime_error("Eigenvalues size does not match with the number of basis functions");
+		
+	std::vector<int> H1start = numpy_to_vector(inH1start);
+	std::vector<int> H1row = numpy_to_vector(inH1row);
+	std::vector<int> H1col = numpy_to_vector(inH1col);
+	std::vector<double> eigvals = numpy_to_vector(inEigvals);
+	std::vector<double> eigvecs = numpy_to_colmajor(inEigvecs, Norb, Norb);
+	SequentialBLAS sequential_blas;
+	ResponseHelper helper(Norb, numPairs, H1start, H1row, H1col, eigvecs, eigvals);
 	
-	std::vector<double> work1(size);	
-	std::vector<double> work2(Norb*numPairs);
+    const int nVir = helper.nVir;
+	const int numFrags = inTransforms.size();
 	
-    for ( int deriv = 0; deriv < Nterms; deriv++ ){
-        // work1 = - VIRT.T * H1 * OCC / ( eps_vir - eps_occ ), work1 here is Z1 in the equation (44) in JCTC 2016, 12, 2706
-        for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
-            for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
-                double value = 0.0;
-                for ( int elem = H1start[deriv]; elem < H1start[deriv + 1]; elem++ ){
-                    value += virt[Norb*orb_vir + H1row[elem]] * eigvecs[Norb*orb_occ + H1col[elem]];
-                }
-                work1[nVir*orb_occ + orb_vir] = value * temp[nVir*orb_occ + orb_vir]; //value * temp[orb_vir + nVir*orb_occ];
-            }
-        }
-		
+	// Tvir[frag] = T.T * VIRT (n x nVir), Tocc[frag] = OCC.T * T (numPairs x n)
+	int maxEmb = 0;
+	std::vector<int> nEmb(numFrags);
+	std::vector<std::vector<double>> Tvir(numFrags), Tocc(numFrags), projected(numFrags);
+	for ( int frag = 0; frag < numFrags; frag++ ){
+		const int n = inTransforms[frag].request().shape[1];
+		std::vector<double> T = numpy_to_colmajor(inTransforms[frag], Norb, n);
+		nEmb[frag] = n;
+		maxEmb = std::max(maxEmb, n);
+		Tvir[frag].resize(n*nVir);
+		Tocc[frag].resize(numPairs*n);
+		projected[frag].resize((size_t)Nterms*n*n);
+		parallel_gemm('T', 'N', n, nVir, Norb, 1.0, T.data(), Norb, helper.virt, Norb, 0.0, Tvir[frag].data(), n);
+		parallel_gemm('T', 'N', numPairs, n, Norb, 1.0, helper.occ, Norb, T.data(), Norb, 0.0, Tocc[frag].data(), numPairs);
+	}
 	
-        // work1 = 2 * VIRT * work1 * OCC.T
-                char notr = 'N';
-                double alpha = 2.0;
-                double beta = 0.0;
-		// work2 = 2 * VIRT * work1		
-		LAWrap::gemm('N', 'N', Norb, numPairs, nVir, 2.0, virt.data(), Norb, work1.data(), nVir, 0.0, work2.data(), Norb);		
+	std::vector<double> Z1((size_t)nVir*numPairs*RESPONSE_BLOCK);
+	std::vector<double> work1((size_t)maxEmb*numPairs*RESPONSE_BLOCK);
+	
+	for ( int first = 0; first < Nterms; first += RESPONSE_BLOCK ){
+		const int Nblock = std::min(RESPONSE_BLOCK, Nterms - first);
+		helper.Z1(first, Nblock, Z1.data());
 		
-		// work1 = work2 * OCC.T, work1 here is Cvir*Z1*Cocc.T in the equation (45) in JCTC 2016, 12, 2706		
-		LAWrap::gemm('N', 'T', Norb, Norb, numPairs, 1.0, work2.data(), Norb, eigvecs.data(), Norb, 0.0, work1.data(), Norb);		
-
-        // rdm_deriv[ row + Norb * ( col + Norb * deriv ) ] = work1 + work1.T
-        for ( int row = 0; row < Norb; row++ ){
-            for ( int col = 0; col < Norb; col++ ){
-                rdm_deriv[size*deriv + Norb*row + col] = work1[row + Norb*col] + work1[col + Norb*row];
+		for ( int frag = 0; frag < numFrags; frag++ ){
+			const int n = nEmb[frag];
+			// work1 = 2 * Tvir * Z1 for all the terms of the block in one gemm
+			parallel_gemm('N', 'N', n, numPairs*Nblock, nVir, 2.0, Tvir[frag].data(), n, Z1.data(), nVir, 0.0, work1.data(), n);
+			
+			#pragma omp parallel
+			{
+				std::vector<double> work2(n*n);
+				#pragma omp for schedule(static)
+				for ( int k = 0; k < Nblock; k++ ){
+					// work2 = work1 * Tocc, projected = work2 + work2.T
+					LAWrap::gemm('N', 'N', n, n, numPairs, 1.0, work1.data() + (size_t)n*numPairs*k, n, Tocc[frag].data(), numPairs, 0.0, work2.data(), n);
+					double * projected_k = projected[frag].data() + (size_t)n*n*(first + k);
+					for ( int row = 0; row < n; row++ ){
+						for ( int col = 0; col < n; col++ ){
+							projected_k[n*row + col] = work2[row + n*col] + work2[col + n*row];
+						}
+					}
 				}
-        }
-    }	
+			}
+		}
+    }
+	
+	std::vector<py::array_t<double>> result;
+	for ( int frag = 0; frag < numFrags; frag++ ){
+		result.push_back(rdm_deriv_to_numpy(nEmb[frag], Nterms, projected[frag]));
+	}
+	return result;
+}
 
-	size_t pyNterms = Nterms;
-	size_t pyNorb = Norb;
-	size_t pyNorb2 = size;
-	py::buffer_info rdm_deriv_buf =
-		{
-			rdm_deriv.data(),
-			sizeof(double),
-			py::format_descriptor<double>::format(),
-			3,
-			{pyNterms, pyNorb, pyNorb},
-			{pyNorb2 * sizeof(double), pyNorb * sizeof(double), sizeof(double)}
-		};
-		
-	return py::array_t<double>(rdm_deriv_buf);
+//Gradient of CF = Sum_x Sum_rs R_x_rs^2 where dR_x/du = T_x.T * rdm_deriv[deriv] * T_x, without building the (Nterms, Norb, Norb) rdm_deriv
+//  gradient[deriv] = Sum_x Sum_rs 2 * R_x_rs * (A_x + A_x.T)_rs = 4 * Sum_ai M_ai * Z1_ai, M = VIRT.T * P * OCC, P = Sum_x T_x * (R_x + R_x.T) * T_x.T
+//  and since Z1 is linear in H1: gradient[deriv] = Sum_(row,col) in H1[deriv] G[row, col], G = VIRT * (4 * M * temp) * OCC.T 
+//The residuals R_x are (n, n) arrays, they should be scaled beforehand to weight the fragments
 
-}	
+py::array_t<double> rhf_response_gradient(const int Norb, const int Nterms, const int numPairs, py::array_t<int> inH1start, 
+			py::array_t<int> inH1row, py::array_t<int> inH1col, py::array_t<double> inEigvecs, py::array_t<double> inEigvals, 
+			std::vector<py::array_t<double>> inTransforms, std::vector<py::array_t<double>> inResiduals)
+{
+	if (inEigvals.size() != Norb)
+		throw std::runtime_error("Eigenvalues size does not match with the number of basis functions");
+	if (inTransforms.size() != inResiduals.size())
+		throw std::runtime_error("The numbers of transformation matrices and residuals do not match");
+		
+	std::vector<int> H1start = numpy_to_vector(inH1start);
+	std::vector<int> H1row = numpy_to_vector(inH1row);
+	std::vector<int> H1col = numpy_to_vector(inH1col);
+	std::vector<double> eigvals = numpy_to_vector(inEigvals);
+	std::vector<double> eigvecs = numpy_to_colmajor(inEigvecs, Norb, Norb);
+	
+    const int nVir = Norb - numPairs;
+	const double * virt = eigvecs.data() + Norb*numPairs;
+	SequentialBLAS sequential_blas;
+	
+	// P = Sum_x T_x * (R_x + R_x.T) * T_x.T
+	std::vector<double> P(Norb*Norb, 0.0);
+	for ( size_t frag = 0; frag < inTransforms.size(); frag++ ){
+		const int n = inTransforms[frag].request().shape[1];
+		std::vector<double> T = numpy_to_colmajor(inTransforms[frag], Norb, n);
+		std::vector<double> R = numpy_to_colmajor(inResiduals[frag], n, n);
+		std::vector<double> S(n*n);
+		for ( int row = 0; row < n; row++ ){
+			for ( int col = 0; col < n; col++ ){
+				S[row + n*col] = R[row + n*col] + R[col + n*row];
+			}
+		}
+		std::vector<double> TS(Norb*n);
+		parallel_gemm('N', 'N', Norb, n, n, 1.0, T.data(), Norb, S.data(), n, 0.0, TS.data(), Norb);
+		parallel_gemm('N', 'T', Norb, Norb, n, 1.0, TS.data(), Norb, T.data(), Norb, 1.0, P.data(), Norb);
+	}
+	
+	// M = 4 * VIRT.T * P * OCC * temp
+	std::vector<double> work(Norb*numPairs);
+	std::vector<double> M(nVir*numPairs);
+	parallel_gemm('N', 'N', Norb, numPairs, Norb, 1.0, P.data(), Norb, eigvecs.data(), Norb, 0.0, work.data(), Norb);
+	parallel_gemm('T', 'N', nVir, numPairs, Norb, 4.0, virt, Norb, work.data(), Norb, 0.0, M.data(), nVir);
+	#pragma omp parallel for schedule(static)
+    for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
+        for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+            M[nVir*orb_occ + orb_vir] *= - 1.0 / (eigvals[numPairs + orb_vir] - eigvals[orb_occ]);
+        }
+    }
+	
+	// G = VIRT * M * OCC.T, reusing P
+	parallel_gemm('N', 'N', Norb, numPairs, nVir, 1.0, virt, Norb, M.data(), nVir, 0.0, work.data(), Norb);
+	parallel_gemm('N', 'T', Norb, Norb, numPairs, 1.0, work.data(), Norb, eigvecs.data(), Norb, 0.0, P.data(), Norb);
+	
+	py::array_t<double> gradient(Nterms);
+	double * gradient_data = static_cast<double*>(gradient.request().ptr);
+	#pragma omp parallel for schedule(static)
+    for ( int deriv = 0; deriv < Nterms; deriv++ ){
+		double value = 0.0;
+		for ( int elem = H1start[deriv]; elem < H1start[deriv + 1]; elem++ ){
+			value += P[H1row[elem] + Norb*H1col[elem]];
+		}
+		gradient_data[deriv] = value;
+	}
+	return gradient;
+}
 
 
 PYBIND11_PLUGIN(libdmet)
 {
 	py::module m("libdmet", "DMET library");
 	m.def("rhf_response", &rhf_response, "Maxtrix multiplication for python");		
+	m.def("rhf_response_eig", &rhf_response_eig, "1RDM response from the eigenvectors/eigenvalues of H0");
+	m.def("rhf_response_projected", &rhf_response_projected, "1RDM response projected onto the Schmidt basis of each fragment");
+	m.def("rhf_response_gradient", &rhf_response_gradient, "Cost function gradient from the 1RDM response and the residuals of each fragment");
 	return m.ptr();
 }
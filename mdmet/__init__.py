@@ -1 +1 @@
-from . import orthobasis, schmidtbasis, qcsolvers, latticeHamiltonian, dmet
\ No newline at end of file
+from . import orthobasis, schmidtbasis, qcsolvers, latticeHamiltonian, response, kspace, solvercache, dmet
\ No newline at end of file
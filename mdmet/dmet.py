@@ -5,18 +5,66 @@ Author: Hung Q. Pham, Unviversity of Minnesota
 email: phamx494@umn.edu
 '''
 
-import os, sys
+import os, sys, atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 from scipy import optimize
+from pyscf import lib
 from functools import reduce
-from mpdmet.mdmet import orthobasis, schmidtbasis, qcsolvers
+from collections import OrderedDict
+from mpdmet.mdmet import orthobasis, schmidtbasis, qcsolvers, response, solvercache
 from pathlib import Path
 sys.path.append(os.getcwd().replace("/mpdmet", "/mpdmet/lib/build"))
 
-import libdmet
+try:
+	import libdmet
+except ImportError:
+	libdmet = None		# the 1RDM response falls back to the NumPy implementation in response.py
+
+WARM_START_CONV_TOL = (1e-12, 1e-9)		# (energy, gradient/residual) thresholds used with warm_start, the 1RDMs do not depend on the starting point
+
+def _solve_embedding(job):
+	'''
+	Solve one embedding problem described by a solver job (see DMET.solver_job).
+	It is also the entry point of the worker processes in DMET.solve_fragments_parallel, hence it only uses the (picklable) job
+	Return:
+		(ImpEnergy, E_emb, RDM1, solver_state)
+	'''
+	solver, CAS, CAS_MO = job['solver'], job['CAS'], job['CAS_MO']
+	qcsolver = qcsolvers.QCsolvers(job['dmetOEI'], job['dmetTEI'], job['dmetCoreJK'], job['DMguess'], job['Norb_in_imp'], job['Nelec_in_imp'], job['numImpOrbs'], job['chempot'], job['state'])
+	qcsolver.conv_tol = job['conv_tol']
+	if solver == 'RHF':
+		ImpEnergy, E_emb, RDM1 = qcsolver.RHF()
+	elif solver == 'UHF':
+		pass
+	elif solver == 'CASCI':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = False)
+	elif solver == 'CASSCF':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = True)		
+	elif solver == 'DMRG-CASCI-C':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = False, solver = 'CheMPS2')
+	elif solver == 'DMRG-CASSCF-C':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = True, solver = 'CheMPS2')			
+	elif solver == 'DMRG-CASCI-B':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = False, solver = 'Block')
+	elif solver == 'DMRG-CASSCF-B':
+		ImpEnergy, E_emb, RDM1 = qcsolver.CAS(CAS, CAS_MO, Orbital_optimization = True, solver = 'Block')						
+	elif solver == 'CCSD':
+		pass			
+	return ImpEnergy, E_emb, RDM1, qcsolver.state
+	
+def _solve_embedding_worker(job):
+	'''
+	Entry point of a worker process in DMET.solve_fragments_parallel, the DMRG solver object is not sent back to the parent process
+	'''
+	ImpEnergy, E_emb, RDM1, solver_state = _solve_embedding(job)
+	if solver_state is not None: solver_state.pop('fcisolver', None)
+	return ImpEnergy, E_emb, RDM1, solver_state
 
 class DMET:
-	def __init__(self, mf, impCluster, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF'):
+	def __init__(self, mf, impCluster, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF', n_workers = 1, eri_type = 'incore'):
 		'''
 		Args:
 			mf 							: a rhf wave function from pyscf
@@ -24,21 +72,46 @@ class DMET:
 										  environment orbitals (not bath) labeled by 0.
 			symmetry					: either 'Translation' or a list of symmetry labels, fragments are symmetrically equivalent if they have the same label
 			orthogonalize_method 		: overlap/boys/lowdin/meta_lowdin
-			schmidt_decomposition_method	: OED/overlap
+			schmidt_decomposition_method	: OED/overlap/SVD, SVD: the bath is built from the SVD of the fragment rows of the occupied orbitals (see schmidtbasis.UsingSVD)
 			OEH_type					: One-electron Hamiltonian used in the bath construction, h = OEH + umat 
 			embedding_symmetry			: a list of integer numbers indicating how the fragments are relevant by symmetry,
 										  defaut: non-symmetry 
 			embedding_solvers			: a list of solvers for each fragment
 										  defaut: use the same solver for all fragments	
-			SCmethod					: CG/SLSQP/BFGS/L-BFGS-B/LSTSQ self-consistent iteration method, defaut: BFGS
+			warm_start					: start the solver of each fragment from its previous solution, default: True. The RHF orbitals and 
+										  the FCI CI vector are rotated to the new embedding basis and reused. The CASSCF orbitals are not reused 
+										  (they start from the warm-started RHF orbitals): CASSCF has several stationary points and the one found 
+										  from the previous orbitals depends on the history of the calculation. The DMRG solver (with its MPS) 
+										  is only reused by serial kernels, it is not sent to/from the workers of solve_fragments_parallel
+			solver_conv_tol				: (energy, gradient/residual) convergence thresholds of the RHF/FCI/CASSCF solvers, 
+										  default: None, i.e. WARM_START_CONV_TOL if warm_start == True, otherwise the pyscf defaults.
+										  NOTE: with warm_start == True the solvers are converged tighter than the pyscf defaults, which makes the
+										  cold solutions more expensive; set solver_conv_tol (e.g. (1e-9, 1e-6)) or warm_start = False to change it.
+										  A warm-started solver stops almost at once on the energy change, the 1RDM (hence Nelec(chempot)) 
+										  then depends on the previous solutions unless the thresholds are tight
+			solver_cache				: a solvercache.SolverCache in front of the solvers, default: None (no cache).
+										  With a directory, the solutions are kept on disk and reused by a restarted calculation.
+			SC_method					: BFGS/CG/LM/GN self-consistent iteration method, defaut: BFGS
+										  LM (Levenberg-Marquardt) and GN (trust-region Gauss-Newton) fit the residuals with their Jacobian
 			SC_threshold				: convergence criteria for correlation potential, default: 1e-6
 			SC_maxcycle                 : maximum cycle for self-consistent iteration, default: 50
+			SC_mixing					: damping/DIIS, mixing of umat between the self-consistent cycles, 
+										  damping with SC_damping (default: 0.0) or DIIS with the last SC_DIIS_space (default: 8) cycles
 			SC_CFtype					: FB/diagFB/F/diagF, cost function type, fitting 1RDM of the entire schmidt basis (FB), diagonal FB (diagFB), 
 										  fragment (F), or diagonal elements of fragment only (diagF), default: FB
+			response_backend			: libdmet/numpy, implementation of the 1RDM response, default: libdmet if it is compiled
 			umat						: correlation potential
 			chempot						: global chemical potential
 			emb_1RDM					: a list of the 1RDM for each fragment
 			emb_orbs					: a list of the fragment and bath orbitals for each fragment			
+			emb_discarded_occupation	: a list of the discarded occupation of the bath orbitals truncated by bath_threshold for each irreducible fragment
+			n_workers					: number of worker processes used to solve the irreducible fragments in parallel,
+										  default: 1 (serial). The OpenMP threads of pyscf are divided between the workers.
+										  The workers are spawned once and reused by all the kernel calls (close_workers shuts them down), 
+										  a spawned worker imports the main script: a driver script with n_workers > 1 has to run DMET
+										  under "if __name__ == '__main__':", otherwise the workers cannot start and the fragments are solved serially
+			eri_type					: incore/outcore/DF, two-electron integrals in the orthonormal basis stored as a 4-index tensor in memory (incore) or in a HDF5 file (outcore)
+										  or as density-fitting three-index tensors (DF, the auxbasis of mf.with_df is used if mf is density-fitted)
 		Return:
 		
 		'''		
@@ -52,10 +125,14 @@ class DMET:
 		self.num_impCluster = len(impCluster)		
 		self.imp_size = self.make_imp_size()
 		
-		self.orthobasis = orthobasis.Orthobasis(mf, orthogonalize_method)
+		self.orthobasis = orthobasis.Orthobasis(mf, orthogonalize_method, eri_type, getattr(getattr(mf, 'with_df', None), 'auxbasis', None))
 		self.sd_type = schmidt_decomposition_method
 		self.OEH_type = OEH_type
 		self.single_embedding = False
+		self.bath_threshold = None		# OED/SVD: bath orbitals within bath_threshold of occupation 0 or 2 are put into the core/discarded, None: no truncation
+		self.n_workers = n_workers
+		self.workers = None		# the ProcessPoolExecutor of solve_fragments_parallel with workers_size processes, started by get_workers
+		self.workers_size = 0
 
 		# Symmetry		
 		if symmetry == None:
@@ -64,6 +141,7 @@ class DMET:
 			assert (self.Norbs/self.imp_size[0]).is_integer()	#Check if Translational symmetry can be used
 			self.num_impCluster = 1
 			self.symmetry = [0]
+			self.orthobasis.make_kspace(self.imp_size[0])		#k-space mean field/response if the Hamiltonian is translationally invariant
 		else:
 			assert isinstance(symmetry, list)
 			assert len(symmetry) == self.num_impCluster
@@ -84,6 +162,10 @@ class DMET:
 			self.solver = [solver]*self.num_impCluster
 		self.CAS = [None]*self.num_impCluster	# (n,m) means n electron in m orbitals
 		self.CAS_MO = [None]*self.num_impCluster
+		self.warm_start = True
+		self.solver_conv_tol = None		# (energy, gradient/residual) thresholds of the RHF/FCI/CASSCF solvers, see get_solver_conv_tol
+		self.solver_state = {}
+		self.solver_cache = None		# a solvercache.SolverCache to reuse the solutions of the embedding problems already solved
 
 		# Self-consistent parameters
 		self.SC_canonical = False		
@@ -92,6 +174,15 @@ class DMET:
 		self.SC_maxcycle =	50	
 		self.SC_CFtype = SC_CFtype
 		self.SC_damping = 0.0
+		self.SC_mixing = 'damping'		# damping/DIIS, mixing of the umat between the self-consistent cycles
+		self.SC_DIIS_space = 8
+		self.SC_DIIS_vecs = []			# the output uvecs and the error vectors of the last SC_DIIS_space cycles used by DIIS_extrapolate
+		self.SC_DIIS_errs = []
+		self.SC_cycles = 0				# number of self-consistent cycles done by the last call of self_consistent
+		self.CF_cache = OrderedDict()		# memoized (CF, gradient) of costfunction_and_gradient
+		self.CF_cache_size = 4
+		self.LSQ_cache = OrderedDict()		# memoized (residuals, Jacobian) of residuals_and_jacobian
+		self.response_backend = 'libdmet' if libdmet is not None else 'numpy'		# libdmet (C++) or numpy, used for the 1RDM response
 
 		# Correlation/chemical potential
 		self.mask, self.redundant = self.make_mask()
@@ -105,10 +196,12 @@ class DMET:
 		self.emb_canonical_1RDM = []
 		self.emb_core_1RDM = []	
 		self.emb_orbs = []
+		self.emb_discarded_occupation = []		# the occupation of the bath orbitals dropped by bath_threshold for each irreducible fragment
 		self.canonical_orthoOED = None			
 		self.fragment_energies = []
 		self.fragment_nelecs = []
 		self.Energy_total = None
+		self.embedding_cache = None		# [key, orthoOED, embedding problems], reused as long as uvec does not change
 		
 		# Others
 		np.set_printoptions(precision=6)
@@ -131,93 +224,38 @@ class DMET:
 		self.fragment_nelecs = []
 		self.emb_1RDM = []
 		self.emb_canonical_1RDM = []
+		self.emb_core_1RDM = []
 		self.emb_orbs = []
+		self.emb_discarded_occupation = []
+		self.CF_cache.clear()		#The cost function depends on the correlated 1RDMs updated here
+		self.LSQ_cache.clear()
 		
-		orthoOED = self.orthobasis.construct_orthoOED(self.uvec2umat(self.uvec), self.OEH_type)		# get both MO coefficients and 1-RDM in orthonormal basis
-		for fragment in self.irred_fragments:
-			impOrbs = np.abs(self.impCluster[fragment])
-			numImpOrbs  = np.sum(impOrbs)
-			numBathOrbs = numImpOrbs
-			schmidt = schmidtbasis.RHF_decomposition(self.mf, impOrbs, numBathOrbs, orthoOED)
-			schmidt.method = self.sd_type		
-			numBathOrbs, FBEorbs, envOrbs_or_core_eigenvals = schmidt.baths()
-
+		orthoOED, embeddings = self.get_embedding_cache(self.uvec)
+		if self.n_workers > 1 and self.irred_size > 1:
+			results = self.solve_fragments_parallel(orthoOED, embeddings, chempot, single_embedding)
+		else:
+			if self.irred_size > 1: self.make_embeddings(orthoOED, embeddings)
+			results = [self.solve_fragment(fragment, orthoOED, embeddings[frag_idx], chempot, single_embedding) for frag_idx, fragment in enumerate(self.irred_fragments)]
 			
-			Norb_in_imp  = numImpOrbs + numBathOrbs
-			assert(Norb_in_imp <= self.Norbs)
+		for frag_idx, (embedding, result, solver_state) in enumerate(results):
+			if embedding is not None: embeddings[frag_idx] = embedding
+			if self.warm_start: self.solver_state[self.irred_fragments[frag_idx]] = solver_state
 			
-			if self.sd_type == 'OED' :
-				core_cutoff = 0.01
-				for cnt in range(len(envOrbs_or_core_eigenvals)):
-					if (envOrbs_or_core_eigenvals[cnt] < core_cutoff):
-						envOrbs_or_core_eigenvals[cnt] = 0.0
-					elif (envOrbs_or_core_eigenvals[cnt] > 2.0 - core_cutoff):
-						envOrbs_or_core_eigenvals[cnt] = 2.0
-					else:
-						print ("Bad DMET bath orbital selection: trying to put a bath orbital with occupation", envOrbs_or_core_eigenvals[cnt], "into the environment :-(.")
-						assert(0 == 1)	
-				Nelec_in_imp = int(round(self.Nelecs - np.sum(envOrbs_or_core_eigenvals)))
-				Nelec_in_environment = int(np.sum(np.abs(envOrbs_or_core_eigenvals)))				
-				core1RDM_ortho = reduce(np.dot, (FBEorbs, np.diag(envOrbs_or_core_eigenvals), FBEorbs.T))				
-			elif self.sd_type == 'overlap':
-				Nelec_in_imp = int(2*numImpOrbs)
-				Nelec_in_environment = self.Nelecs - Nelec_in_imp
-				core1RDM_ortho = 2*np.dot(FBEorbs[:,Norb_in_imp:], FBEorbs[:,Norb_in_imp:].T)				
-				
-			#Transform the 1e/2e integrals and the JK core constribution to schmidt basis
-			dmetOEI  = self.orthobasis.dmet_oei(FBEorbs, Norb_in_imp)
-			dmetTEI  = self.orthobasis.dmet_tei(FBEorbs, Norb_in_imp)			
-			dmetCoreJK = self.orthobasis.dmet_corejk(FBEorbs, Norb_in_imp, core1RDM_ortho)
+			ImpEnergy, E_emb, RDM1, core_orbs, Nelec_in_environment, dmetCore1RDM, emb_orbs, ImpNelecs, canonical_RDM1, discarded_occupation = result
 			
-			#Solving the embedding problem with high level wfs
-			solver = self.solver[fragment]
-			print("    Solving the irreducible fragment %2d [%2d eletrons in (%2d fragment + %2d bath )] by %s solver" % (fragment, Nelec_in_imp, numImpOrbs, numBathOrbs, solver))						
-			DMguess = reduce(np.dot,(FBEorbs[:,:Norb_in_imp].T, orthoOED[1], FBEorbs[:,:Norb_in_imp]))
-			qcsolver = qcsolvers.QCsolvers(dmetOEI, dmetTEI, dmetCoreJK, DMguess, Norb_in_imp, Nelec_in_imp, numImpOrbs, chempot)
-			if solver == 'RHF':
-				ImpEnergy, E_emb, RDM1 = qcsolver.RHF()
-			elif solver == 'UHF':
-				pass
-			elif solver == 'CASCI':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = False)
-			elif solver == 'CASSCF':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = False)		
-			elif solver == 'DMRG-CASCI-C':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = False, solver = 'CheMPS2')
-			elif solver == 'DMRG-CASSCF-C':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = True, solver = 'CheMPS2')			
-			elif solver == 'DMRG-CASCI-B':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = False, solver = 'Block')
-			elif solver == 'DMRG-CASSCF-B':
-				ImpEnergy, E_emb, RDM1 = qcsolver.CAS(self.CAS[fragment], self.CAS_MO[fragment], Orbital_optimization = True, solver = 'Block')						
-			elif solver == 'CCSD':
-				pass			
-				
 			#Collecting the energies/RDM1/no of electrons for each fragment
 			#if single_embedding == True, then self.fragment_energies is a list of the embedding energy, core1RDM, Nelec_in_environment (not rounded)
 			if single_embedding == False:
 				self.fragment_energies.append(ImpEnergy)				
 			else:
-				self.fragment_energies.extend([E_emb, core1RDM_ortho, Nelec_in_environment])
+				self.fragment_energies.extend([E_emb, 2*np.dot(core_orbs, core_orbs.T), Nelec_in_environment])
 				
-			dmetCore1RDM = reduce(np.dot,(FBEorbs[:,:Norb_in_imp].T, core1RDM_ortho	, FBEorbs[:,:Norb_in_imp]))
 			self.emb_1RDM.append(RDM1)
 			self.emb_core_1RDM.append(dmetCore1RDM)
-			self.emb_orbs.append(FBEorbs[:,:Norb_in_imp])
-			ImpNelecs = np.trace(RDM1[:numImpOrbs,:numImpOrbs])
+			self.emb_orbs.append(emb_orbs)
+			self.emb_discarded_occupation.append(discarded_occupation)
 			self.fragment_nelecs.append(ImpNelecs)
-			
-			if self.SC_canonical == True:
-				dmetJ = np.einsum('pqrs,rs->pq', dmetTEI, RDM1) 
-				dmetK = np.einsum('prqs,rs->pq', dmetTEI, RDM1) 
-				dmetFOCK = dmetOEI + dmetCoreJK + dmetJ - 0.5*dmetK
-				eigenvals, eigenvecs = np.linalg.eigh(dmetFOCK)
-				idx = eigenvals.argsort()
-				eigenvals = eigenvals[idx]
-				eigenvecs = eigenvecs[:,idx]
-				nelec_pairs = Nelec_in_imp // 2 
-				canonical_RDM1 = 2 * np.dot(eigenvecs[:,:nelec_pairs], eigenvecs[:,:nelec_pairs].T)
-				self.emb_canonical_1RDM.append(canonical_RDM1)
+			if canonical_RDM1 is not None: self.emb_canonical_1RDM.append(canonical_RDM1)
 		
 		#Transform the irreducible energy/electron lists to the corresponding full lists
 		if single_embedding == False:
@@ -228,6 +266,244 @@ class DMET:
 		if self.symmetry == [0]: multiplicty = self.imp_size.size		
 		return self.fragment_nelecs.sum()*multiplicty
 
+	def get_embedding_cache(self, uvec):
+		'''
+		Return the mean-field orthoOED and the list of embedding problems (one per irreducible fragment) for uvec.
+		None of these depend on the chemical potential, hence they are only rebuilt when uvec changes. 
+		An element of the list is None until the corresponding embedding problem is constructed by make_embedding.
+		'''
+		key = (uvec.tobytes(), self.OEH_type, self.sd_type, self.bath_threshold)
+		if self.embedding_cache is None or self.embedding_cache[0] != key:
+			orthoOED = self.orthobasis.construct_orthoOED(self.uvec2umat(uvec), self.OEH_type)		# get both MO coefficients and 1-RDM in orthonormal basis
+			self.embedding_cache = [key, orthoOED, [None]*self.irred_size]
+		return self.embedding_cache[1], self.embedding_cache[2]
+		
+	def make_embeddings(self, orthoOED, embeddings):
+		'''
+		Construct the missing embedding problems in embeddings (one per irreducible fragment), the SVD baths are built together
+		(schmidtbasis.batch_baths) and the embedding TEIs of all of them come from one batched transform (Orthobasis.dmet_tei_batch)
+		'''
+		missing = [frag_idx for frag_idx, embedding in enumerate(embeddings) if embedding is None]
+		if len(missing) == 0: return
+		baths = [None]*len(missing)
+		if self.sd_type == 'SVD':
+			baths = schmidtbasis.batch_baths(self.mf, [self.impCluster[self.irred_fragments[frag_idx]] for frag_idx in missing], orthoOED, self.bath_threshold)
+		for frag_idx, bath in zip(missing, baths):
+			embeddings[frag_idx] = self.make_embedding(self.irred_fragments[frag_idx], orthoOED, with_tei = False, bath = bath)
+		teis = self.orthobasis.dmet_tei_batch([embeddings[frag_idx]['emb_orbs'] for frag_idx in missing])
+		for frag_idx, tei in zip(missing, teis):
+			embeddings[frag_idx]['dmetTEI'] = tei
+			
+	def make_embedding(self, fragment, orthoOED, with_tei = True, bath = None):
+		'''
+		Construct the Schmidt basis and the embedding Hamiltonian of one irreducible fragment
+		Args:
+			fragment				: the label of the irreducible fragment
+			orthoOED				: MO coefficients and 1-RDM in orthonormal basis from construct_orthoOED
+			with_tei				: if False, dmetTEI is None and has to be filled by the caller
+			bath					: (numBathOrbs, emb_orbs, core_orbs, discarded_occupation) if it is already computed (see schmidtbasis.batch_baths)
+		Return:
+			embedding				: a dict of the embedding orbitals, the numbers of orbitals/electrons, the 1e/2e integrals,
+									  the core JK and the core 1RDM of the embedding problem. The core is kept as its orbitals (core_orbs), 
+									  the dense core1RDM_ortho = 2 * core_orbs * core_orbs.T is only built where it is needed
+		'''
+		impOrbs = np.abs(self.impCluster[fragment])
+		numImpOrbs  = np.sum(impOrbs)
+		numBathOrbs = numImpOrbs
+		schmidt = schmidtbasis.RHF_decomposition(self.mf, impOrbs, numBathOrbs, orthoOED)
+		schmidt.method = self.sd_type		
+		schmidt.emb_only = True
+		schmidt.bath_threshold = self.bath_threshold
+		if bath is None: bath = schmidt.baths() + (schmidt.discarded_occupation,)
+		numBathOrbs, FBEorbs, envOrbs_or_core_orbs, discarded_occupation = bath
+
+		
+		Norb_in_imp  = FBEorbs.shape[1]		#numImpOrbs + numBathOrbs
+		assert(Norb_in_imp <= self.Norbs)
+		
+		core_orbs = envOrbs_or_core_orbs				#FBEorbs only has the fragment and bath orbitals
+		Nelec_in_environment = 2*core_orbs.shape[1]
+		Nelec_in_imp = self.Nelecs - Nelec_in_environment
+			
+		#Transform the 1e/2e integrals and the JK core constribution to schmidt basis
+		embedding = {}
+		embedding['numImpOrbs'] = numImpOrbs
+		embedding['numBathOrbs'] = numBathOrbs
+		embedding['discarded_occupation'] = discarded_occupation
+		embedding['Norb_in_imp'] = Norb_in_imp
+		embedding['Nelec_in_imp'] = Nelec_in_imp
+		embedding['Nelec_in_environment'] = Nelec_in_environment
+		embedding['emb_orbs'] = FBEorbs[:,:Norb_in_imp]
+		embedding['core_orbs'] = core_orbs
+		embedding['dmetOEI'] = self.orthobasis.dmet_oei(FBEorbs, Norb_in_imp)
+		embedding['dmetTEI'] = self.orthobasis.dmet_tei(FBEorbs, Norb_in_imp) if with_tei else None
+		embedding['dmetCoreJK'] = self.orthobasis.dmet_corejk(FBEorbs, Norb_in_imp, core_orbs = core_orbs)
+		emb_core = np.dot(FBEorbs[:,:Norb_in_imp].T, core_orbs)
+		embedding['dmetCore1RDM'] = 2*np.dot(emb_core, emb_core.T)
+		embedding['DMguess'] = reduce(np.dot,(FBEorbs[:,:Norb_in_imp].T, orthoOED[1], FBEorbs[:,:Norb_in_imp]))
+		return embedding
+		
+	def solve_fragment(self, fragment, orthoOED, embedding = None, chempot = 0.0, single_embedding = False):
+		'''
+		Solve the embedding problem of one irreducible fragment
+		Args:
+			fragment				: the label of the irreducible fragment
+			orthoOED				: MO coefficients and 1-RDM in orthonormal basis from construct_orthoOED
+			embedding				: the embedding problem from make_embedding, constructed here if None
+			chempot					: global chemical potential
+		Return:
+			embedding				: the embedding problem
+			result					: a tuple of (ImpEnergy, E_emb, RDM1, core_orbs, Nelec_in_environment, dmetCore1RDM, emb_orbs, ImpNelecs, canonical_RDM1, discarded_occupation),
+									  canonical_RDM1 is None if SC_canonical == False, discarded_occupation: see schmidtbasis.RHF_decomposition
+			solver_state			: the converged state of the solver used to warm-start the next solution of this fragment
+		'''
+		if embedding is None:
+			embedding = self.make_embedding(fragment, orthoOED)
+		
+		#Solving the embedding problem with high level wfs
+		job = self.solver_job(fragment, embedding, chempot)
+		solution = self.read_solver_cache(job)
+		if solution is None:
+			solution = _solve_embedding(job)
+			self.write_solver_cache(job, solution)
+		return self.fragment_result(embedding, solution)
+		
+	def solver_job(self, fragment, embedding, chempot = 0.0):
+		'''
+		The embedding problem of one irreducible fragment together with the solver settings as a dict of arrays/numbers (picklable), 
+		solved by _solve_embedding
+		'''
+		solver = self.solver[fragment]
+		print("    Solving the irreducible fragment %2d [%2d eletrons in (%2d fragment + %2d bath )] by %s solver" % (fragment, embedding['Nelec_in_imp'], embedding['numImpOrbs'], embedding['numBathOrbs'], solver))						
+		job = {key: embedding[key] for key in ['dmetOEI', 'dmetTEI', 'dmetCoreJK', 'DMguess', 'Norb_in_imp', 'Nelec_in_imp', 'numImpOrbs']}
+		job.update(solver = solver, CAS = self.CAS[fragment], CAS_MO = self.CAS_MO[fragment], chempot = chempot, conv_tol = self.get_solver_conv_tol())
+		job['state'] = self.warm_start_state(fragment, embedding['emb_orbs'])
+		return job
+		
+	def get_solver_conv_tol(self):
+		'''
+		The convergence thresholds of the solvers: solver_conv_tol, or WARM_START_CONV_TOL for all the solutions (warm-started or not)
+		if warm_start == True, or None (pyscf defaults)
+		'''
+		if self.solver_conv_tol is not None: return self.solver_conv_tol
+		return WARM_START_CONV_TOL if self.warm_start else None
+		
+	def read_solver_cache(self, job):
+		'''
+		The solution (ImpEnergy, E_emb, RDM1, solver_state) of job in the solver cache, None if it is not cached.
+		A cached solution keeps the warm-start state of job as its solver state
+		'''
+		if self.solver_cache is None: return None
+		cached = self.solver_cache.get(self.solver_cache_key(job))
+		if cached is None: return None
+		print("     The solution is read from the solver cache")
+		return tuple(cached) + (job['state'],)
+		
+	def write_solver_cache(self, job, solution):
+		if self.solver_cache is not None: self.solver_cache.put(self.solver_cache_key(job), *solution[:3])
+		
+	def solver_cache_key(self, job):
+		return solvercache.problem_key(job['dmetOEI'], job['dmetTEI'], job['dmetCoreJK'], job['Nelec_in_imp'], job['numImpOrbs'], job['chempot'], job['solver'], job['CAS'], job['CAS_MO'])
+		
+	def fragment_result(self, embedding, solution):
+		'''
+		Collect the output of solve_fragment from the solution (ImpEnergy, E_emb, RDM1, solver_state) of the embedding problem
+		'''
+		ImpEnergy, E_emb, RDM1, solver_state = solution
+		numImpOrbs = embedding['numImpOrbs']
+		Nelec_in_imp = embedding['Nelec_in_imp']
+		dmetOEI = embedding['dmetOEI']
+		dmetTEI = embedding['dmetTEI']
+		dmetCoreJK = embedding['dmetCoreJK']
+		ImpNelecs = np.trace(RDM1[:numImpOrbs,:numImpOrbs])
+		
+		canonical_RDM1 = None
+		if self.SC_canonical == True:
+			dmetJ = np.einsum('pqrs,rs->pq', dmetTEI, RDM1) 
+			dmetK = np.einsum('prqs,rs->pq', dmetTEI, RDM1) 
+			dmetFOCK = dmetOEI + dmetCoreJK + dmetJ - 0.5*dmetK
+			eigenvals, eigenvecs = np.linalg.eigh(dmetFOCK)
+			idx = eigenvals.argsort()
+			eigenvals = eigenvals[idx]
+			eigenvecs = eigenvecs[:,idx]
+			nelec_pairs = Nelec_in_imp // 2 
+			canonical_RDM1 = 2 * np.dot(eigenvecs[:,:nelec_pairs], eigenvecs[:,:nelec_pairs].T)
+			
+		result = (ImpEnergy, E_emb, RDM1, embedding['core_orbs'], embedding['Nelec_in_environment'], embedding['dmetCore1RDM'], embedding['emb_orbs'], ImpNelecs, canonical_RDM1, embedding['discarded_occupation'])
+		if solver_state is not None: solver_state['emb_orbs'] = embedding['emb_orbs']
+		return embedding, result, solver_state
+		
+	def warm_start_state(self, fragment, emb_orbs):
+		'''
+		The solver state saved from the previous solution of this fragment (None if there is none or warm_start == False). 
+		The MO coefficients are rotated from the previous to the current embedding basis and reorthonormalized (Lowdin),
+		so that they can be reused when the bath changes between self-consistent cycles.
+		'''
+		state = self.solver_state.get(fragment) if self.warm_start else None
+		if state is None or state['emb_orbs'].shape != emb_orbs.shape: return None
+		
+		state = dict(state)
+		overlap = np.dot(emb_orbs.T, state['emb_orbs'])
+		for key in ['hf_mo_coeff', 'mo_coeff']:
+			if key in state: 
+				U, s, Vt = np.linalg.svd(np.dot(overlap, state[key]))
+				state[key] = np.dot(U, Vt)
+		return state
+
+	def solve_fragments_parallel(self, orthoOED, embeddings, chempot = 0.0, single_embedding = False):
+		'''
+		Solve the irreducible fragments in the pool of worker processes of get_workers.
+		The embedding problems are built in this process, only the solver jobs (integrals and solver settings) are sent to the workers.
+		The results are gathered in the order of self.irred_fragments. If the workers cannot start, the fragments are solved serially
+		and n_workers is set to 1
+		'''
+		self.make_embeddings(orthoOED, embeddings)
+		jobs = [self.solver_job(fragment, embeddings[frag_idx], chempot) for frag_idx, fragment in enumerate(self.irred_fragments)]
+		solutions = [self.read_solver_cache(job) for job in jobs]
+		pending = [frag_idx for frag_idx, solution in enumerate(solutions) if solution is None]
+		if len(pending) > 0:
+			for frag_idx in pending:
+				if jobs[frag_idx]['state'] is not None: 
+					jobs[frag_idx]['state'] = {key: value for key, value in jobs[frag_idx]['state'].items() if key != 'fcisolver'}	#The DMRG solver object is not picklable
+			try:
+				pending_solutions = list(self.get_workers().map(_solve_embedding_worker, [jobs[frag_idx] for frag_idx in pending]))
+			except (BrokenProcessPool, OSError) as error:
+				print("WARNING: the DMET worker processes cannot start (%s), the fragments are solved serially. "
+					  "Scripts with n_workers > 1 have to run DMET under if __name__ == '__main__':" % error)
+				self.close_workers()
+				self.n_workers = 1
+				pending_solutions = [_solve_embedding(jobs[frag_idx]) for frag_idx in pending]
+			for frag_idx, solution in zip(pending, pending_solutions):
+				solutions[frag_idx] = solution
+				self.write_solver_cache(jobs[frag_idx], solution)
+		return [self.fragment_result(embedding, solution) for embedding, solution in zip(embeddings, solutions)]
+		
+	def get_workers(self):
+		'''
+		The pool of min(n_workers, irred_size) worker processes, started at the first call and reused by the next ones
+		(a new pool is only started if n_workers changes).
+		The workers are spawned, not forked: a child forked after an OpenMP region of pyscf/libdmet hangs in the OpenMP runtime.
+		The OpenMP threads of this process are shared between the workers
+		'''
+		n_workers = min(self.n_workers, self.irred_size)
+		if self.workers is not None and self.workers_size != n_workers: self.close_workers()
+		if self.workers is None:
+			n_threads = max(1, lib.num_threads() // n_workers)
+			self.workers = ProcessPoolExecutor(max_workers = n_workers, mp_context = multiprocessing.get_context('spawn'), initializer = lib.num_threads, initargs = (n_threads,))
+			self.workers_size = n_workers
+			atexit.register(self.workers.shutdown)
+		return self.workers
+		
+	def close_workers(self):
+		'''
+		Shut down the worker processes of solve_fragments_parallel, they are started again by the next parallel kernel call
+		'''
+		if self.workers is not None:
+			atexit.unregister(self.workers.shutdown)
+			self.workers.shutdown()
+			self.workers = None
+			self.workers_size = 0
+		
 	def one_shot(self):
 		'''
 		Do one-shot DMET, only the chemical potential is optimized
@@ -239,8 +515,7 @@ class DMET:
 			Fragment_nelecs = self.kernel(chempot = 0.0, single_embedding = True)
 			E_embedding = self.fragment_energies[0]
 			orthoOED_core = self.fragment_energies[1]
-			Jcore = np.einsum('pqrs,rs->pq', self.orthobasis.orthoTEI, orthoOED_core)
-			Kcore = np.einsum('prqs,rs->pq', self.orthobasis.orthoTEI, orthoOED_core)
+			Jcore, Kcore = self.orthobasis.ortho_jk(orthoOED_core)
 			JKcore = Jcore - 0.5*Kcore
 			E_core = 0.5*(orthoOED_core*(2*self.orthobasis.orthoOEI + JKcore)).sum()
 			print('-----Single-embedding energy decoposition-----')			
@@ -274,7 +549,9 @@ class DMET:
 		print("- SELF-CONSISTENT DMET CALCULATION : START -")
 		
 		u_diff = 1.0
-		umat = np.zeros((self.Norbs, self.Norbs))
+		umat = self.uvec2umat(self.uvec)
+		self.SC_DIIS_vecs = []
+		self.SC_DIIS_errs = []
 		
 		for cycle in range(self.SC_maxcycle):
 			
@@ -287,22 +564,59 @@ class DMET:
 
 			# Optimize uvec
 			if self.SC_method == 'BFGS':
-				result = optimize.minimize(self.costfunction, self.uvec, method='BFGS', jac=self.costfunction_gradient, options={'disp': False})
+				result = optimize.minimize(self.costfunction_and_gradient, self.uvec, method='BFGS', jac = True, options={'disp': False})
 			elif self.SC_method == 'CG':
-				result = optimize.minimize(self.costfunction, self.uvec, method='CG', jac = self.costfunction_gradient, options={'disp': False})
+				result = optimize.minimize(self.costfunction_and_gradient, self.uvec, method='CG', jac = True, options={'disp': False})
+			elif self.SC_method == 'LM':
+				result = optimize.least_squares(self.lstsq_residuals, self.uvec, jac = self.lstsq_jacobian, method = 'lm')
+			elif self.SC_method == 'GN':
+				result = optimize.least_squares(self.lstsq_residuals, self.uvec, jac = self.lstsq_jacobian, method = 'trf')
 			else:
 				print(self.SC_method, " is not supported")
-			self.uvec = result.x	
-			umat = self.uvec2umat(self.uvec)
+			umat = self.uvec2umat(result.x)
 			umat = umat - np.eye(umat.shape[0])*np.average(np.diag(umat))
 			u_diff = np.linalg.norm(umat_old - umat)
-			umat = self.SC_damping*umat_old + (1.0 - self.SC_damping)*umat #Can be eliminated
+			
+			# Mix the new umat with the previous ones
+			if self.SC_mixing == 'DIIS':
+				umat = self.uvec2umat(self.DIIS_extrapolate(self.umat2uvec(umat_old), self.umat2uvec(umat)))
+			elif self.SC_mixing == 'damping':
+				umat = self.SC_damping*umat_old + (1.0 - self.SC_damping)*umat
+			else:
+				raise Exception('the mixing scheme ' + str(self.SC_mixing) + ' is not supported')
+			self.uvec = self.umat2uvec(umat)
+			
 			print(" 2-norm of difference old and new u-mat: ", u_diff)
 			print("Correlation potential vector: ", self.uvec)
+			self.SC_cycles = cycle + 1
 			if u_diff <= self.SC_threshold: break
 			
 		print("--- SELF-CONSISTENT DMET CALCULATION : END ---")
 		
+	def DIIS_extrapolate(self, uvec_in, uvec_out):
+		'''
+		DIIS (Pulay/Anderson) extrapolation of the fixed-point iteration uvec_in -> uvec_out,
+		using uvec_out - uvec_in as the error vector and the last SC_DIIS_space iterations
+		Return:
+			the extrapolated uvec
+		'''
+		self.SC_DIIS_vecs.append(uvec_out)
+		self.SC_DIIS_errs.append(uvec_out - uvec_in)
+		if len(self.SC_DIIS_vecs) > self.SC_DIIS_space:
+			self.SC_DIIS_vecs.pop(0)
+			self.SC_DIIS_errs.pop(0)
+			
+		# Minimize |Sum_i c_i err_i| with Sum_i c_i = 1
+		space = len(self.SC_DIIS_vecs)
+		errs = np.asarray(self.SC_DIIS_errs)
+		B = np.ones((space + 1, space + 1))
+		B[:space,:space] = np.dot(errs, errs.T)
+		B[space,space] = 0.0
+		rhs = np.zeros(space + 1)
+		rhs[space] = 1.0
+		coeffs = np.linalg.lstsq(B, rhs, rcond = None)[0][:space]
+		return np.dot(coeffs, np.asarray(self.SC_DIIS_vecs))
+		
 	def canonical_self_consistent(self):
 		'''
 		Do canonical self-consistent DMET
@@ -331,8 +645,7 @@ class DMET:
 				the_total_1RDM += self.counts[fragment]*ortho_frag_RDM1
 				
 			# Construct new canonical orthoOED
-			J = np.einsum('pqrs,rs->pq', self.orthobasis.orthoTEI, the_total_1RDM) 
-			K = np.einsum('prqs,rs->pq', self.orthobasis.orthoTEI, the_total_1RDM) 
+			J, K = self.orthobasis.ortho_jk(the_total_1RDM)
 			FOCK = self.orthobasis.orthoOEI + J - 0.5*K
 			eigenvals, eigenvecs = np.linalg.eigh(FOCK)
 			idx = eigenvals.argsort()
@@ -365,13 +678,7 @@ class DMET:
 		'''
 		Cost function: CF(u) = Sum_x (Sum_rs (corrD_x_rs(u) - mfD_x_rs(u))^2) = Sum_x (Sum_rs (rdm_diff_x_rs(u))^2)
 		'''
-		frags_error = []
-		rdm_diff = self.rdm_diff(uvec)
-		for fragment in range(self.irred_size):
-			error = np.power(rdm_diff[fragment], 2).sum()
-			frags_error.append(error)
-		frags_error = np.asarray(frags_error)[self.inverse_indices]		#Transform irreducible array to the full array
-		return frags_error.sum()
+		return self.costfunction_from_rdm_diff(self.rdm_diff(uvec))
 		
 	def costfunction_gradient(self, uvec):
 		'''
@@ -382,31 +689,102 @@ class DMET:
 		
 		the_rdm_diff = self.rdm_diff(uvec)
 		the_rdm_diff_gradient = self.rdm_diff_gradient(uvec)
-		CF_gradient = np.zeros(self.Nterms)
+		return self.costfunction_gradient_from_rdm_diff(the_rdm_diff, the_rdm_diff_gradient)
 		
-		for u in range(self.Nterms):
-			frag_gradient = []
-			for fragment in range(self.irred_size):
-				gradient = np.sum(2 * the_rdm_diff[fragment] * the_rdm_diff_gradient[u][fragment])
-				frag_gradient.append(gradient)
-			frag_gradient = np.asarray(frag_gradient)[self.inverse_indices]		#Transform irreducible array to the full array
-			CF_gradient[u] = frag_gradient.sum()
+	def costfunction_and_gradient(self, uvec):
+		'''
+		Cost function and its analytical gradient from a single diagonalization of the mean-field Hamiltonian,
+		used in scipy.optimize.minimize with jac = True. The results are memoized on the uvec bytes.
+		'''
+		key = uvec.tobytes()
+		if key in self.CF_cache: 
+			CF, CF_gradient = self.CF_cache[key]
+			return CF, CF_gradient.copy()
+			
+		eigenvals, eigenvecs, orthoOED = self.orthobasis.construct_orthoMF(self.uvec2umat(uvec), self.OEH_type)
+		the_rdm_diff = self.rdm_diff(uvec, orthoOED)
+		CF = self.costfunction_from_rdm_diff(the_rdm_diff)
+		
+		#The gradient is contracted with the residuals inside the response backend, the 1RDM response is never stored
+		residuals = []
+		for fragment in range(self.irred_size):
+			error = the_rdm_diff[fragment]
+			if error.ndim == 1: error = np.diag(error)
+			residuals.append(self.counts[fragment] * error)
+		projected = self.kspace_response(uvec)
+		if projected is not None:
+			CF_gradient = sum(2 * np.tensordot(error_deriv, residual, axes = 2) for error_deriv, residual in zip(projected, residuals))
+		else:
+			CF_gradient = self.response_module().rhf_response_gradient(self.Norbs, self.Nterms, self.numPairs, self.H1start, self.H1row, self.H1col, 
+						eigenvecs, eigenvals, self.schmidt_transforms(), residuals)
+		
+		self.CF_cache[key] = (CF, CF_gradient)
+		if len(self.CF_cache) > self.CF_cache_size: self.CF_cache.popitem(last = False)
+		return CF, CF_gradient.copy()
+		
+	def residuals_and_jacobian(self, uvec):
+		'''
+		Residual vector r(u), with CF(u) = Sum_i r_i(u)^2, and its Jacobian dr_i/du_u (size of r x Nterms) for the least-squares fit.
+		Both come from a single diagonalization and are memoized on the uvec bytes.
+		'''
+		key = uvec.tobytes()
+		if key not in self.LSQ_cache:
+			eigenvals, eigenvecs, orthoOED = self.orthobasis.construct_orthoMF(self.uvec2umat(uvec), self.OEH_type)
+			the_rdm_diff = self.rdm_diff(uvec, orthoOED)
+			the_rdm_diff_gradient = self.rdm_diff_gradient(uvec, (eigenvals, eigenvecs))
+			
+			#Fragments are weighted by sqrt(multiplicity) so that Sum_i r_i^2 is the cost function
+			weights = np.sqrt(self.counts)
+			residuals = np.hstack([weights[fragment] * the_rdm_diff[fragment].ravel() for fragment in range(self.irred_size)])
+			jacobian = np.vstack([weights[fragment] * the_rdm_diff_gradient[fragment].reshape(self.Nterms, -1).T for fragment in range(self.irred_size)])
+			self.LSQ_cache[key] = (residuals, jacobian)
+			if len(self.LSQ_cache) > self.CF_cache_size: self.LSQ_cache.popitem(last = False)
+		return self.LSQ_cache[key]
+		
+	def lstsq_residuals(self, uvec):
+		return self.residuals_and_jacobian(uvec)[0].copy()
+		
+	def lstsq_jacobian(self, uvec):
+		return self.residuals_and_jacobian(uvec)[1].copy()
+		
+	def costfunction_from_rdm_diff(self, the_rdm_diff):
+		'''
+		Cost function from the rdm_diff of each irreducible fragment
+		'''
+		frags_error = []
+		for fragment in range(self.irred_size):
+			error = np.power(the_rdm_diff[fragment], 2).sum()
+			frags_error.append(error)
+		frags_error = np.asarray(frags_error)[self.inverse_indices]		#Transform irreducible array to the full array
+		return frags_error.sum()
 		
+	def costfunction_gradient_from_rdm_diff(self, the_rdm_diff, the_rdm_diff_gradient):
+		'''
+		Gradient of the cost function from the rdm_diff and rdm_diff_gradient of each irreducible fragment,
+		the sum over rs is a single tensordot over the stacked derivatives of each fragment
+		'''
+		CF_gradient = np.zeros(self.Nterms)
+		for fragment in range(self.irred_size):
+			error = the_rdm_diff[fragment]
+			error_deriv = the_rdm_diff_gradient[fragment]
+			CF_gradient += 2 * self.counts[fragment] * np.tensordot(error_deriv, error, axes = error.ndim)		#counts: transform irreducible fragments to the full list
 		return CF_gradient
 		
 		
-	def rdm_diff(self, uvec):
+	def rdm_diff(self, uvec, orthoOED = None):
 		'''
 		Calculating the different between mf-1RDM (transformed in schmidt basis) and correlated-1RDM for each
 		embedding problem (each fragment), or rdm_diff_x_rs(u) in self.costfunction()
 		Args:
 			uvec		: the correlation potential vector
+			orthoOED	: the mean-field 1RDM for uvec if it is already computed
 		Return:
 			the_rdm_diff	: a list with the size of the number of irreducible fragment, each element is a numpy array of 
 						  errors for each fragment.
 		'''
 		
-		orthoOED = self.orthobasis.construct_orthoOED(self.uvec2umat(uvec), self.OEH_type)[1]
+		if orthoOED is None:
+			orthoOED = self.orthobasis.construct_orthoOED(self.uvec2umat(uvec), self.OEH_type)[1]
 		the_rdm_diff = []
 		
 		for fragment in range(self.irred_size):
@@ -431,33 +809,21 @@ class DMET:
 			the_rdm_diff.append(error)
 		return the_rdm_diff
 
-	def rdm_diff_gradient(self, uvec):
+	def rdm_diff_gradient(self, uvec, eig = None):
 		'''
 		Compute the rdm_diff gradient
 		Args:
 			uvec			: the correlation potential vector
+			eig				: (eigenvals, eigenvecs) of the mean-field Hamiltonian for uvec if it is already computed
 		Return:
-			the_gradient	: a list with the size of the number of u values in uvec, each element is a list with the size of the number
-							 of irreducible fragment. Each element of this list is a numpy array of derivative corresponding to each rs.
+			the_gradient	: a list with the size of the number of irreducible fragment, each element is a numpy array of derivatives
+							  with the shape of (Nterms, n, n), or (Nterms, n) for the diagFB/diagF cost functions.
 							 
 		'''
 		
-		RDM_deriv = self.construct_1RDM_response(uvec)
-		
-		the_gradient = []
-		for u in range(self.Nterms):
-			frag_gradient = []
-			for fragment in range(self.irred_size):
-				transform_mat = self.emb_orbs[fragment]			#schmidt basis transformation matrix
-				if self.SC_CFtype == 'FB' or self.SC_CFtype == 'diagFB':
-					error_deriv_schmidt = reduce(np.dot, (transform_mat.T, RDM_deriv[u,:,:], transform_mat))				
-					if self.SC_CFtype == 'diagFB': error_deriv_schmidt = np.diag(error_deriv_schmidt)	
-					
-				elif self.SC_CFtype == 'F' or self.SC_CFtype == 'diagF':
-					error_deriv_schmidt = reduce(np.dot, (transform_mat[:,:self.imp_size[fragment]].T, RDM_deriv[u,:,:], transform_mat[:,:self.imp_size[fragment]]))	
-					if self.SC_CFtype == 'diagF': error_deriv_schmidt = np.diag(error_deriv_schmidt)
-				frag_gradient.append(error_deriv_schmidt)
-			the_gradient.append(frag_gradient)
+		the_gradient = self.construct_projected_1RDM_response(uvec, eig)
+		if self.SC_CFtype == 'diagFB' or self.SC_CFtype == 'diagF':
+			the_gradient = [np.einsum('urr->ur', error_deriv) for error_deriv in the_gradient]
 		return the_gradient
 
 ######################################## USEFUL FUNCTION for DMET class ######################################## 
@@ -503,6 +869,12 @@ class DMET:
 				
 		return umat
 
+	def umat2uvec(self, umat):
+		'''
+		Convert a (symmetric) umat back to the uvec, inverse of uvec2umat
+		'''	
+		return umat[self.mask]
+
 	def make_mask(self):
 		'''
 		Create a Norbs x Norbs matrix with 'True' at the location of fragment orbitals, symmetry is considered
@@ -588,10 +960,72 @@ class DMET:
 		H1col   = np.array(H1col)	
 		return theH1, H1start, H1row, H1col
 		
-	def construct_1RDM_response(self, uvec):
+	def construct_1RDM_response(self, uvec, eig = None):
 		'''
 		Calculate the derivative of 1RDM
+		Args:
+			uvec			: the correlation potential vector
+			eig				: (eigenvals, eigenvecs) of the mean-field Hamiltonian for uvec, 
+							  if given, the diagonalization inside the response backend is skipped
+		'''
+		if eig is None:
+			orthoOEH = self.orthobasis.construct_orthoOEH(self.uvec2umat(uvec), self.OEH_type)		#the Hamiltonian of construct_1RDM
+			rdm_deriv = self.response_module().rhf_response(self.Norbs, self.Nterms, self.numPairs, self.H1start, self.H1row, self.H1col, orthoOEH)
+		else:
+			eigenvals, eigenvecs = eig
+			rdm_deriv = self.response_module().rhf_response_eig(self.Norbs, self.Nterms, self.numPairs, self.H1start, self.H1row, self.H1col, eigenvecs, eigenvals)
+		return rdm_deriv
+		
+	def construct_projected_1RDM_response(self, uvec, eig = None):
+		'''
+		Calculate the derivative of 1RDM projected onto the Schmidt basis of each irreducible fragment,
+		i.e. T.T * construct_1RDM_response(uvec)[u] * T, the (Nterms, Norbs, Norbs) response is never built
+		Args:
+			uvec			: the correlation potential vector
+			eig				: (eigenvals, eigenvecs) of the mean-field Hamiltonian for uvec if it is already computed
+		Return:
+			a list of (Nterms, n, n) arrays, one for each irreducible fragment
+		'''
+		projected = self.kspace_response(uvec)
+		if projected is not None: return projected
+		if eig is None:
+			eigenvals, eigenvecs = self.orthobasis.construct_orthoMF(self.uvec2umat(uvec), self.OEH_type)[:2]
+		else:
+			eigenvals, eigenvecs = eig
+		return self.response_module().rhf_response_projected(self.Norbs, self.Nterms, self.numPairs, self.H1start, self.H1row, self.H1col, 
+						eigenvecs, eigenvals, self.schmidt_transforms())
+						
+	def kspace_response(self, uvec):
+		'''
+		The projected 1RDM response computed in k-space (see kspace.KMeanField), 
+		None if the system is not translationally invariant, then the response backend is used
 		'''
-		orthoFOCK = self.orthobasis.orthoFOCK + self.uvec2umat(uvec)
-		rdm_deriv = libdmet.rhf_response(self.Norbs, self.Nterms, self.numPairs, self.H1start, self.H1row, self.H1col, orthoFOCK)
-		return rdm_deriv
\ No newline at end of file
+		umat = self.uvec2umat(uvec)
+		kmf = self.orthobasis.get_kmf(umat, self.OEH_type)
+		if kmf is None: return None
+		return kmf.rhf_response_projected(umat[:kmf.n,:kmf.n], self.Nterms, self.H1start, self.H1row, self.H1col, self.schmidt_transforms())
+		
+	def response_module(self):
+		'''
+		The module used to compute the 1RDM response: libdmet (C++) or response (NumPy), they have the same functions
+		'''
+		if self.response_backend == 'libdmet':
+			if libdmet is None: raise Exception('libdmet is not compiled, use response_backend = numpy')
+			return libdmet
+		elif self.response_backend == 'numpy':
+			return response
+		else:
+			raise Exception('the 1RDM response backend ' + str(self.response_backend) + ' is not supported')
+			
+	def schmidt_transforms(self):
+		'''
+		The Schmidt basis transformation matrix of each irreducible fragment used in the cost function:
+		fragment + bath orbitals for FB/diagFB, fragment orbitals only for F/diagF
+		'''
+		transforms = []
+		for fragment in range(self.irred_size):
+			transform_mat = self.emb_orbs[fragment]
+			if self.SC_CFtype == 'F' or self.SC_CFtype == 'diagF':
+				transform_mat = transform_mat[:,:self.imp_size[fragment]]
+			transforms.append(transform_mat)
+		return transforms
\ No newline at end of file
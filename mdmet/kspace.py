@@ -0,0 +1,163 @@
+'''
+Multipurpose Density Matrix Embedding theory (mp-DMET)
+Copyright (C) 2015 Hung Q. Pham
+Author: Hung Q. Pham, Unviversity of Minnesota
+email: phamx494@umn.edu
+
+Mean field and 1RDM response in k-space for translationally invariant lattices (symmetry = 'Translation').
+The one-electron Hamiltonian of a supercell of Nk cells with n orbitals each is block-circulant (periodic)
+or block-anticirculant (antiperiodic), H_k = Sum_R h_R exp(ikR) is obtained by FFT and diagonalized for each k.
+'''
+
+import numpy as np
+from mpdmet.mdmet.response import RESPONSE_BLOCK
+
+def make_kmf(OEH, cell_size, numPairs, threshold = 1e-10):
+	'''
+	Build the k-space mean field of the one-electron Hamiltonian OEH if it is translationally invariant
+	Args:
+		OEH			: a (Norbs, Norbs) one-electron Hamiltonian
+		cell_size	: the number of orbitals in each cell (fragment)
+	Return:
+		a KMeanField object, None if OEH is neither block-circulant nor block-anticirculant
+	'''
+	Norbs = OEH.shape[0]
+	if Norbs % cell_size != 0 or Norbs == cell_size: return None
+	Nk = Norbs // cell_size
+	blocks = OEH.reshape(Nk, cell_size, Nk, cell_size).transpose(0,2,1,3)		# blocks[R, S] = H_RS
+	cell = np.arange(Nk)
+	shift = (cell[None,:] - cell[:,None]) % Nk
+	wrapped = cell[None,:] < cell[:,None]
+	for twist in [1, -1]:
+		expected = blocks[0][shift] * np.where(wrapped, twist, 1)[:,:,None,None]
+		if np.abs(blocks - expected).max() < threshold:
+			return KMeanField(blocks[0], numPairs, twist)
+	return None
+
+class KMeanField:
+	def __init__(self, h_blocks, numPairs, twist = 1):
+		'''
+		Args:
+			h_blocks	: a (Nk, n, n) array, the first block-row h_R = H_0R of the one-electron Hamiltonian
+			twist		: 1 for a block-circulant Hamiltonian, -1 for a block-anticirculant one (antiperiodic boundary)
+		'''
+		self.Nk, self.n = h_blocks.shape[:2]
+		self.Norbs = self.Nk * self.n
+		self.numPairs = numPairs
+		self.twist = twist
+		Nk = self.Nk
+
+		#k = (2 pi m + phi)/Nk with phi = 0 (periodic) or pi (antiperiodic), the partner of each k is -k
+		self.phi = 0.0 if twist == 1 else np.pi
+		self.kpts = (2*np.pi*np.arange(Nk) + self.phi) / Nk
+		if twist == 1:
+			self.partner = (-np.arange(Nk)) % Nk
+		else:
+			self.partner = Nk - 1 - np.arange(Nk)
+
+		#H_k = Sum_R h_R exp(ikR), using the FFT over R
+		twisted = h_blocks * np.exp(1j*self.phi*np.arange(Nk)/Nk)[:,None,None]
+		self.hk = Nk * np.fft.ifft(twisted, axis = 0)
+
+	def is_tiled(self, umat):
+		'''
+		Check that umat is the same n x n block on each cell, i.e. that H + umat is still translationally invariant
+		'''
+		cell_umat = umat[:self.n,:self.n]
+		return np.array_equal(umat, np.kron(np.eye(self.Nk), cell_umat))
+
+	def eig(self, cell_umat):
+		'''
+		Diagonalize H_k + u for each k
+		Return:
+			(ek, uk, occ), a (Nk, n) array of orbital energies, a (Nk, n, n) array of eigenvectors
+			and a (Nk, n) boolean array of the numPairs lowest orbitals over all k, None if the occupation of k and -k differs
+		'''
+		ek, uk = np.linalg.eigh(self.hk + cell_umat)
+
+		#H_k is real for k = -k, the eigenvectors are chosen to be real as well
+		selfconj = self.partner == np.arange(self.Nk)
+		if selfconj.any():
+			ek[selfconj], real_uk = np.linalg.eigh(self.hk[selfconj].real + cell_umat)
+			uk[selfconj] = real_uk
+
+		occ = np.zeros(self.Nk*self.n, dtype = bool)
+		occ[np.argsort(ek.ravel(), kind = 'stable')[:self.numPairs]] = True
+		occ = occ.reshape(self.Nk, self.n)
+		if not np.array_equal(occ.sum(axis = 1), occ.sum(axis = 1)[self.partner]): return None
+		return ek, uk, occ
+
+	def construct_orthoMF(self, cell_umat):
+		'''
+		Same as Orthobasis.construct_orthoMF for H + umat, umat being cell_umat on each cell.
+		The eigenvectors are real combinations of the Bloch orbitals of k and -k.
+		Return:
+			(eigenvals, eigenvecs, orthoOED), None if the Fermi level splits a k/-k pair
+		'''
+		eig = self.eig(cell_umat)
+		if eig is None: return None
+		ek, uk, occ = eig
+		Nk, n = self.Nk, self.n
+
+		#D_RS = 1/Nk Sum_k exp(ik(R - S)) D_k only depends on R - S
+		occ_uk = uk * occ[:,None,:]
+		Dk = 2 * np.matmul(occ_uk, occ_uk.conj().transpose(0,2,1))
+		shifts = np.arange(-(Nk - 1), Nk)
+		d_shift = np.dot(np.exp(1j*np.outer(shifts, self.kpts)), Dk.reshape(Nk, -1)).real.reshape(-1, n, n) / Nk
+		cell = np.arange(Nk)
+		orthoOED = d_shift[cell[:,None] - cell[None,:] + Nk - 1].transpose(0,2,1,3).reshape(self.Norbs, self.Norbs)
+
+		#Bloch orbitals exp(ikR) u_k / sqrt(Nk): real for k = -k, otherwise sqrt(2) * (Re, Im) of k replace the k, -k pair
+		bloch = np.exp(1j*np.outer(cell, self.kpts))[:,None,:,None] * uk[None,:,:,:].transpose(0,2,1,3) / np.sqrt(Nk)		# [R, p, k, band]
+		bloch = bloch.reshape(self.Norbs, Nk, n)
+		selfconj = self.partner == cell
+		first = cell < self.partner
+		eigenvecs = np.hstack([bloch[:,selfconj].real.reshape(self.Norbs, -1), np.sqrt(2) * bloch[:,first].real.reshape(self.Norbs, -1),
+								np.sqrt(2) * bloch[:,first].imag.reshape(self.Norbs, -1)])
+		eigenvals = np.hstack([ek[selfconj].ravel(), ek[first].ravel(), ek[first].ravel()])
+		idx = np.argsort(eigenvals, kind = 'stable')
+		return (eigenvals[idx], eigenvecs[:,idx], orthoOED)
+
+	def rhf_response_projected(self, cell_umat, Nterms, H1start, H1row, H1col, transforms):
+		'''
+		Same as response.rhf_response_projected, for H1 terms that are the same on each cell (symmetry = 'Translation').
+		The perturbation does not couple different k:
+			dD_k = A + A.H with A = 2 * VIRT_k * Z1_k * OCC_k.H, Z1_k = - VIRT_k.H * h1 * OCC_k / ( eps_vir - eps_occ )
+			T.T * dD * T = 1/Nk Sum_k T_k.H * dD_k * T_k with T_k = Sum_R exp(-ikR) T_R
+		Args:
+			transforms	: a list of (Norbs, n) transformation matrices
+		Return:
+			a list of (Nterms, n, n) arrays, None if the Fermi level splits a k/-k pair
+		'''
+		eig = self.eig(cell_umat)
+		if eig is None: return None
+		ek, uk, occ = eig
+		Nk, n = self.Nk, self.n
+
+		#h1 of each term on the first cell
+		H1start, H1row, H1col = np.asarray(H1start), np.asarray(H1row), np.asarray(H1col)
+		term = np.repeat(np.arange(Nterms), np.diff(H1start))
+		incell = (H1row < n) & (H1col < n)
+		h1 = np.zeros((Nterms, n, n))
+		np.add.at(h1, (term[incell], H1row[incell], H1col[incell]), 1.0)
+
+		#weight[k, a, i] = - 1 / ( eps_a - eps_i ) for a virtual and i occupied at k
+		vir_occ = (~occ)[:,:,None] & occ[:,None,:]
+		gap = np.where(vir_occ, ek[:,:,None] - ek[:,None,:], 1.0)
+		weight = np.where(vir_occ, -1.0 / gap, 0.0)
+
+		#(T_k.H * u_k) for each fragment, T_k from the FFT over the cells
+		phase = np.exp(-1j*self.phi*np.arange(Nk)/Nk)[:,None,None]
+		TU = []
+		for T in transforms:
+			Tk = np.fft.fft(T.reshape(Nk, n, -1) * phase, axis = 0)
+			TU.append(np.matmul(Tk.conj().transpose(0,2,1), uk))
+
+		projected = [np.empty((Nterms, T.shape[1], T.shape[1])) for T in transforms]
+		for first in range(0, Nterms, RESPONSE_BLOCK):
+			last = min(first + RESPONSE_BLOCK, Nterms)
+			Z1 = np.matmul(np.matmul(uk.conj().transpose(0,2,1)[:,None], h1[None,first:last]), uk[:,None]) * weight[:,None]		# [k, term, a, i]
+			for frag in range(len(transforms)):
+				work = 2 * np.matmul(np.matmul(TU[frag][:,None], Z1), TU[frag].conj().transpose(0,2,1)[:,None]).sum(axis = 0) / Nk
+				projected[frag][first:last] = (work + work.conj().transpose(0,2,1)).real
+		return projected
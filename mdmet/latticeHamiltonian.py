@@ -9,6 +9,40 @@ import numpy as np
 from functools import reduce
 from pyscf import gto, scf, ao2mo
 			
+def onsite_jk(U, dm):
+	'''
+	Coulomb and exchange matrices of the on-site repulsion (ii|ii) = U_i: J_pq = K_pq = delta_pq * U_p * dm_pp
+	Args:
+		U		: the on-site repulsion of each site
+		dm		: a density matrix or a list of density matrices
+	'''
+	vj = np.einsum('...pp->...p', np.asarray(dm)) * U
+	vj = vj[...,None] * np.eye(U.size)
+	return vj, vj.copy()
+	
+def onsite_eri(U):
+	'''
+	The on-site repulsion (ii|ii) = U_i as a 8-fold packed ERI array, without a dense (N,N,N,N) intermediate
+	'''
+	num_sites = U.size
+	npair = num_sites*(num_sites + 1)//2
+	eri = np.zeros(npair*(npair + 1)//2)
+	ii = np.arange(num_sites)*(np.arange(num_sites) + 3)//2		#the pair index of (i,i)
+	eri[ii*(ii + 3)//2] = U
+	return eri
+	
+def set_onsite_repulsion(mf, U):
+	'''
+	Set the on-site repulsion of a lattice model on a mf object. It is kept as the vector mf.hubbard_U and used through get_jk,
+	Orthobasis uses it to build the embedding integrals without any N^4 tensor. mf._eri (only needed by pyscf post-HF 
+	methods on the whole lattice) is only built when it fits in mf.max_memory.
+	'''
+	mf.hubbard_U = U
+	mf.get_jk = lambda mol = None, dm = None, *args, **kwargs: onsite_jk(U, dm)
+	npair = U.size*(U.size + 1)//2
+	if npair*(npair + 1)//2 * 8e-6 < mf.max_memory:
+		mf._eri = onsite_eri(U)
+		
 		
 def hubbard_1D(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_conditions = 'pbc', site_energy = None, no_hopping = None):
 	'''
@@ -64,12 +98,7 @@ def hubbard_1D(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_conditions =
 			for site in range(num_sites):
 				h[site, site] = site_energy[site]		
 	
-	#Construct on-site repulsion part:
-	eri = np.zeros((num_sites,num_sites,num_sites,num_sites), dtype=float)
-	for site in range(num_sites):
-		eri[site,site,site,site] = U
-
-	#Construct a mf object:
+	#Construct a mf object with the on-site repulsion:
 	mol = gto.M()
 	mol.nelectron = int(2 * num_sites * filling)
 	mol.nao_nr = lambda *args: num_sites
@@ -77,7 +106,7 @@ def hubbard_1D(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_conditions =
 	mf = scf.RHF(mol)
 	mf.get_hcore = lambda *args: h
 	mf.get_ovlp = lambda *args: np.eye(num_sites)
-	mf._eri = ao2mo.restore(8, eri, num_sites)
+	set_onsite_repulsion(mf, U*np.ones(num_sites))
 	numPairs = mol.nelectron // 2
 	
 	if site_energy != None:					#For heterogeneous lattice
@@ -92,9 +121,9 @@ def hubbard_1D(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_conditions =
 		eigvecs = eigvecs[:, idx]
 		assert( eigvals[numPairs] - eigvals[numPairs-1] > 1e-8 )	#Make sure this is a gapped system
 		RDM1  = 2*np.dot(eigvecs[:,:numPairs], eigvecs[:,:numPairs].T)
-		JK  = np.zeros( [Lattice_size,Lattice_size], dtype=float )
-		JK_value = 0.5 * U * mol.nelectron/Lattice_size
-		for site in range(Lattice_size):
+		JK  = np.zeros( [num_sites,num_sites], dtype=float )
+		JK_value = 0.5 * U * mol.nelectron/num_sites
+		for site in range(num_sites):
 			JK[site,site] = JK_value
 		mf.get_veff = lambda *args: JK
 		mf.mo_coeff = eigvecs
@@ -189,12 +218,7 @@ def hubbard_2D_rectangular(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_
 			for site in range(Lattice_size):
 				h[site, site] = site_energy[site]
 	
-	#Construct on-site repulsion part:
-	eri = np.zeros((Lattice_size,Lattice_size,Lattice_size,Lattice_size), dtype=float)
-	for site in range(Lattice_size):
-		eri[site,site,site,site] = U
-
-	#Construct a mf object:
+	#Construct a mf object with the on-site repulsion:
 	mol = gto.M()
 	mol.nelectron = int(2 * Lattice_size * filling)
 	mol.nao_nr = lambda *args: Lattice_size
@@ -202,7 +226,7 @@ def hubbard_2D_rectangular(num_sites, filling = 0.5, t = 1.0, U = 4.0, boundary_
 	mf = scf.RHF(mol)
 	mf.get_hcore = lambda *args: h
 	mf.get_ovlp = lambda *args: np.eye(Lattice_size)
-	mf._eri = ao2mo.restore(8, eri, Lattice_size)
+	set_onsite_repulsion(mf, U*np.ones(Lattice_size))
 	numPairs = mol.nelectron // 2
 	
 	
@@ -5,20 +5,28 @@ Author: Hung Q. Pham, Unviversity of Minnesota
 email: phamx494@umn.edu
 '''
 
+import os, tempfile
 import numpy as np
 import scipy as scipy
+import h5py
 from functools import reduce
 from pyscf.tools import localizer
 from pyscf.lo import nao, orth
-from pyscf import ao2mo
+from pyscf import ao2mo, df, lib, scf
+from mpdmet.mdmet import kspace
 
 class Orthobasis:
-	def __init__(self, mf, method = 'overlap'):
+	def __init__(self, mf, method = 'overlap', eri_type = 'incore', auxbasis = None):
 		'''
 		Prepare the orthonormal/localized set of orbitals for DMET
 		Args:
 			mf		: a mean-field wf
 			method	: overlap/boys/lowdin/meta_lowdin. if method == lattice: U = 1
+			eri_type	: incore/outcore/DF, two-electron integrals stored as the full orthoTEI in memory (incore), 
+					  in a HDF5 file in lib.param.TMPDIR (outcore), or as the three-index density-fitting tensor orthoCDERI = (L|pq) (DF).
+					  For a lattice model with an on-site repulsion (mf.hubbard_U, see latticeHamiltonian), it is set to hubbard:
+					  only the vector U_i = (ii|ii) is kept
+			auxbasis	: auxiliary basis for DF, default: weigend+etb
 					
 		Return:
 			U		: Tranformation matrix to the orthonormal basis
@@ -30,8 +38,18 @@ class Orthobasis:
 		self.Norbs = mf.mol.nao_nr()
 		self.U = None		
 		self.orthoOEI = None 		
-		self.orthoTEI = None
+		self.orthoTEI_s8 = None		# incore orthoTEI packed with the 8-fold symmetry, built once and used by all the transforms
+		self.orthoCDERI = None		# (L|pq) in the orthonormal basis, a (Naux, Norbs, Norbs) array
+		self.hubbard_U = None		# on-site repulsion U_i = (ii|ii) of a Hubbard-like lattice model
+		self.eri_type = eri_type
+		self.erifile = None			# HDF5 file of the outcore orthoTEI, stored as (pq|rs) with p >= q and r >= s
+		self.max_memory = 2000		# MB, sets the block size when streaming over the outcore orthoTEI
+		self.kmf = None				# {OEH_type: kspace.KMeanField or None}, see make_kspace
 		self.S = mf.get_ovlp()	
+		if eri_type not in ['incore', 'outcore', 'DF']:
+			raise Exception('the integral type ' + str(eri_type) + ' is not supported')
+		if eri_type != 'incore' and method == 'lattice':
+			raise Exception(eri_type + ' integrals are not available for lattice models')
 		
 		if method == 'overlap':
 			self.U = scipy.linalg.fractional_matrix_power(self.S, -0.5)
@@ -50,7 +68,11 @@ class Orthobasis:
 			self.U = orth.orth_ao( self.mol, 'meta_lowdin' )
 		elif method == 'lattice':
 			self.orthoOEI = self.mf.get_hcore()
-			self.orthoTEI = ao2mo.incore.full(ao2mo.restore(8, self.mf._eri, self.Norbs), self.S, compact=False).reshape(self.Norbs, self.Norbs, self.Norbs, self.Norbs)
+			if getattr(self.mf, 'hubbard_U', None) is not None:
+				self.eri_type = 'hubbard'
+				self.hubbard_U = np.asarray(self.mf.hubbard_U, dtype = float)
+			else:
+				self.orthoTEI_s8 = ao2mo.restore(8, ao2mo.incore.full(ao2mo.restore(8, self.mf._eri, self.Norbs), self.S), self.Norbs)
 			self.orthoFOCK = self.orthoOEI + self.mf.get_veff()
 		
 		if method != 'lattice':
@@ -58,36 +80,112 @@ class Orthobasis:
 			OEI = self.mf.get_hcore()
 			self.orthoOEI = reduce(np.dot, (self.U.T, OEI, self.U))
 
-			#Tranform Two-Electron Integral to orthonormal basis	
+			#Tranform Two-Electron Integral to orthonormal basis, the AO integrals are computed in the 8-fold packed form
 			Norbs = self.Norbs		
-			g_format = self.mol.intor('cint2e_sph')
-			TEI = np.zeros([Norbs, Norbs, Norbs, Norbs]) 
-			for cn1 in range(Norbs):
-				for cn2 in range(Norbs):
-					for cn3 in range(Norbs):
-						for cn4 in range(Norbs):
-							TEI[cn1][cn2][cn3][cn4] = g_format[cn1*Norbs + cn2][cn3*Norbs + cn4]		
-			self.orthoTEI = ao2mo.incore.full(ao2mo.restore(8, TEI, Norbs), self.U, compact=False).reshape(Norbs, Norbs, Norbs, Norbs)	
+			if eri_type == 'DF':
+				self.orthoCDERI = self.make_orthoCDERI(auxbasis)
+			elif eri_type == 'outcore':
+				self.erifile = tempfile.NamedTemporaryFile(dir = lib.param.TMPDIR, suffix = '.h5')
+				ao2mo.outcore.full(self.mol, self.U, self.erifile.name, dataname = 'orthoTEI', max_memory = self.max_memory, verbose = 0)
+			else:
+				TEI = self.mol.intor('cint2e_sph', aosym = 's8')
+				self.orthoTEI_s8 = ao2mo.restore(8, ao2mo.incore.full(TEI, self.U), Norbs)
+				del TEI
 
 			#Tranform Fock to orthonormal basis
 			vhf = self.mf.get_veff()
 			FOCK = OEI + vhf  
 			self.orthoFOCK = reduce(np.dot, (self.U.T, FOCK, self.U))
 		
+	def make_orthoCDERI(self, auxbasis = None, blksize = 64):
+		'''
+		Cholesky-decomposed (density-fitted) integrals (pq|rs) = Sum_L (L|pq)(L|rs) in the orthonormal basis
+		Return:
+			a (Naux, Norbs, Norbs) array
+		'''	
+		if auxbasis is None: auxbasis = 'weigend+etb'
+		cderi = df.incore.cholesky_eri(self.mol, auxbasis = auxbasis)
+		Naux = cderi.shape[0]
+		orthoCDERI = np.empty((Naux, self.Norbs, self.Norbs))
+		for p0 in range(0, Naux, blksize):
+			p1 = min(p0 + blksize, Naux)
+			orthoCDERI[p0:p1] = np.matmul(np.matmul(self.U.T, lib.unpack_tril(cderi[p0:p1])), self.U)
+		return orthoCDERI
+		
+	@property
+	def orthoTEI(self):
+		'''
+		The incore orthoTEI as a (Norbs, Norbs, Norbs, Norbs) array, unpacked from orthoTEI_s8 on each access 
+		(None for outcore/DF/hubbard integrals, the Hubbard on-site repulsion is only kept as the vector hubbard_U)
+		'''
+		if self.orthoTEI_s8 is None: return None
+		return ao2mo.restore(1, self.orthoTEI_s8, self.Norbs)
+		
+	def incore_blocks(self):
+		'''
+		Same as outcore_blocks for the incore orthoTEI_s8: (pq|rs) of a block of rows is gathered from the packed 
+		(ij|kl), ij >= kl, storage and unpacked, without restoring the full orthoTEI
+		'''
+		Norbs = self.Norbs
+		p_idx, q_idx = np.tril_indices(Norbs)
+		npair = p_idx.size
+		kl = np.arange(npair)
+		blksize = max(1, int(self.max_memory*1e6/8/(3*Norbs**2)))
+		for row0 in range(0, npair, blksize):
+			row1 = min(row0 + blksize, npair)
+			ij = np.arange(row0, row1)[:,None]
+			index = np.where(kl <= ij, ij*(ij + 1)//2 + kl, kl*(kl + 1)//2 + ij)
+			yield p_idx[row0:row1], q_idx[row0:row1], lib.unpack_tril(self.orthoTEI_s8[index])
+		
+	def outcore_blocks(self):
+		'''
+		Iterate over blocks of rows of the outcore orthoTEI, the file is opened (read-only) for each pass and no HDF5 handle is kept on the object
+		Return:
+			(p, q, eri) for each block, eri[x] = (p[x] q[x]|rs) for all r, s, a (blksize, Norbs, Norbs) array
+		'''
+		Norbs = self.Norbs
+		p_idx, q_idx = np.tril_indices(Norbs)
+		blksize = max(1, int(self.max_memory*1e6/8/(3*Norbs**2)))
+		with h5py.File(self.erifile.name, 'r') as f:
+			orthoTEI = f['orthoTEI']
+			for row0 in range(0, orthoTEI.shape[0], blksize):
+				row1 = min(row0 + blksize, orthoTEI.shape[0])
+				yield p_idx[row0:row1], q_idx[row0:row1], lib.unpack_tril(orthoTEI[row0:row1])
+		
 	def construct_orthoOED(self, umat, OEH_type):
 		'''
 		Construct MOs/one-electron density matrix in orthonormal basis
 		with a certain correlation potential umat
 		'''	
+		eigenvals, eigenvecs, orthoOED = self.construct_orthoMF(umat, OEH_type)
+		return (eigenvecs, orthoOED)
 		
+	def construct_orthoOEH(self, umat, OEH_type):
+		'''
+		The one-electron Hamiltonian OEH + umat of the mean-field calculation in orthonormal basis
+		'''
 		#Two choices for the one-electron Hamiltonian
 		if OEH_type == 'OEI':
-			OEH = self.orthoOEI + umat
+			return self.orthoOEI + umat
 		elif OEH_type == 'FOCK':
-			OEH = self.orthoFOCK + umat
+			return self.orthoFOCK + umat
 		else:
 			raise Exception('the current one-electron Hamiltonian type is not supported')
-
+			
+	def construct_orthoMF(self, umat, OEH_type):
+		'''
+		Same as construct_orthoOED but the orbital energies are also returned,
+		they are needed to compute the 1RDM response from the same diagonalization
+		Return:
+			(eigenvals, eigenvecs, orthoOED)
+		'''	
+		
+		OEH = self.construct_orthoOEH(umat, OEH_type)
+		kmf = self.get_kmf(umat, OEH_type)
+		if kmf is not None:
+			mf = kmf.construct_orthoMF(umat[:kmf.n,:kmf.n])
+			if mf is not None: return mf
+			
 		eigenvals, eigenvecs = np.linalg.eigh(OEH)
 		idx = eigenvals.argsort()
 		eigenvals = eigenvals[idx]
@@ -96,19 +194,162 @@ class Orthobasis:
 		orthoOED = 2 * np.dot(eigenvecs[:,:nelec_pairs], eigenvecs[:,:nelec_pairs].T)	
 		
 		
-		return (eigenvecs, orthoOED)
+		return (eigenvals, eigenvecs, orthoOED)
+		
+	def make_kspace(self, cell_size):
+		'''
+		Prepare the k-space mean field for a translationally invariant system made of cells of cell_size orbitals,
+		it is used by construct_orthoMF when the one-electron Hamiltonian and umat are both translationally invariant
+		'''
+		self.kmf = {}
+		for OEH_type, OEH in [['OEI', self.orthoOEI], ['FOCK', self.orthoFOCK]]:
+			self.kmf[OEH_type] = kspace.make_kmf(OEH, cell_size, self.Nelecs // 2)
+			
+	def get_kmf(self, umat, OEH_type):
+		'''
+		The k-space mean field for OEH_type + umat, None if it cannot be used
+		'''
+		if self.kmf is None or self.kmf.get(OEH_type) is None: return None
+		kmf = self.kmf[OEH_type]
+		if not kmf.is_tiled(umat): return None
+		return kmf
 		
 	def dmet_oei(self, FBEorbs, Norb_in_imp):
 		oei = reduce(np.dot,(FBEorbs[:,:Norb_in_imp].T, self.orthoOEI, FBEorbs[:,:Norb_in_imp]))		
 		return oei
 
 	def dmet_tei(self, FBEorbs, Norb_in_imp):
-		tei = ao2mo.incore.full(ao2mo.restore(8, self.orthoTEI, self.Norbs), FBEorbs[:,:Norb_in_imp], compact=False)
+		if self.eri_type == 'DF':
+			# (ij|kl) = Sum_L (L|ij)(L|kl) 
+			emb_orbs = FBEorbs[:,:Norb_in_imp]
+			Naux = self.orthoCDERI.shape[0]
+			cderi = np.matmul(np.matmul(emb_orbs.T, self.orthoCDERI), emb_orbs).reshape(Naux, -1)
+			tei = np.dot(cderi.T, cderi)
+		elif self.eri_type == 'outcore':
+			return self.outcore_tei([FBEorbs[:,:Norb_in_imp]])[0]
+		elif self.eri_type == 'hubbard':
+			# (ij|kl) = Sum_s U_s C_si C_sj C_sk C_sl, O(Norbs*n^4) without any Norbs^4 intermediate
+			emb_orbs = FBEorbs[:,:Norb_in_imp]
+			pair = (emb_orbs[:,:,None] * emb_orbs[:,None,:]).reshape(self.Norbs, -1)		# C_si C_sj
+			tei = np.dot(pair.T * self.hubbard_U, pair)
+		else:
+			tei = ao2mo.incore.full(self.orthoTEI_s8, FBEorbs[:,:Norb_in_imp], compact=False)
 		tei = tei.reshape(Norb_in_imp, Norb_in_imp, Norb_in_imp, Norb_in_imp)
 		return tei			
 
-	def dmet_corejk(self, FBEorbs, Norb_in_imp, core1RDM_ortho):
-		J = np.einsum('pqrs,rs->pq', self.orthoTEI, core1RDM_ortho)
-		K = np.einsum('prqs,rs', self.orthoTEI, core1RDM_ortho)	
-		jk = reduce(np.dot,(FBEorbs[:,:Norb_in_imp].T, J -0.5*K, FBEorbs[:,:Norb_in_imp]))		
-		return jk
\ No newline at end of file
+	def dmet_tei_batch(self, emb_orbs_list):
+		'''
+		Embedding TEIs of several fragments sharing the integral transform:
+			incore/outcore	: the first index of each block of (pq|rs) rows is transformed for all fragments with one gemm,
+							  the orthoTEI is unpacked (incore) or read (outcore) once for all fragments, see blocked_tei
+			DF/hubbard		: the fragments are transformed one by one, there is nothing to share
+		Args:
+			emb_orbs_list	: a list of (Norbs, n) embedding orbitals
+		Return:
+			a list of (n, n, n, n) arrays
+		'''
+		if self.eri_type == 'outcore':
+			return self.outcore_tei(emb_orbs_list)
+		elif self.eri_type in ['DF', 'hubbard']:
+			return [self.dmet_tei(emb_orbs, emb_orbs.shape[1]) for emb_orbs in emb_orbs_list]
+		return self.blocked_tei(emb_orbs_list, self.incore_blocks)
+		
+	def outcore_tei(self, emb_orbs_list):
+		'''
+		Embedding TEIs from the outcore orthoTEI
+		'''
+		return self.blocked_tei(emb_orbs_list, self.outcore_blocks)
+		
+	def blocked_tei(self, emb_orbs_list, blocks):
+		'''
+		Embedding TEIs from the blocks of (pq| rows of the orthoTEI: the (rs) index of each block is transformed for all fragments 
+		with one gemm, then the (pq| index of the half-transformed (pq|kl) of each fragment. The fragments are grouped so that 
+		their half-transformed integrals fit in max_memory, each group needs one pass over the blocks.
+		Args:
+			blocks		: incore_blocks or outcore_blocks
+		'''
+		groups = []
+		max_size = self.max_memory*1e6/8/self.Norbs**2
+		for emb_orbs in emb_orbs_list:
+			size = emb_orbs.shape[1]**2
+			if len(groups) > 0 and groups[-1][1] + size <= max_size:
+				groups[-1][0].append(emb_orbs)
+				groups[-1][1] += size
+			else:
+				groups.append([[emb_orbs], size])
+				
+		teis = []
+		for group, size in groups:
+			halves = [np.zeros((emb_orbs.shape[1]**2, self.Norbs, self.Norbs)) for emb_orbs in group]
+			columns = np.cumsum([0] + [emb_orbs.shape[1] for emb_orbs in group])
+			for p, q, eri in blocks():
+				eri_rl = np.matmul(eri, np.hstack(group))		# (pq|rl) for the l of all fragments
+				for frag, (emb_orbs, half) in enumerate(zip(group, halves)):
+					kl = np.matmul(emb_orbs.T, eri_rl[:,:,columns[frag]:columns[frag+1]]).reshape(p.size, -1)
+					half[:,p,q] = kl.T
+					half[:,q,p] = kl.T
+			for emb_orbs, half in zip(group, halves):
+				n = emb_orbs.shape[1]
+				teis.append(np.matmul(np.matmul(emb_orbs.T, half), emb_orbs).reshape(n**2, -1).T.reshape(n, n, n, n))
+		return teis
+
+	def dmet_corejk(self, FBEorbs, Norb_in_imp, core1RDM_ortho = None, core_orbs = None):
+		'''
+		Core JK in the embedding space, the core is given by core1RDM_ortho and/or core_orbs
+		Args:
+			core_orbs	: the core orbitals C_core, core1RDM_ortho = 2 * C_core * C_core.T. The DF and hubbard J/K are built from them 
+					  without the dense density: J_ij = Sum_L (L|ij) rho_L with rho_L = 2 Sum_k (L|kk), K_ij = 2 Sum_L Sum_k (L|ik)(L|kj).
+					  Only the incore/outcore J/K need the dense core1RDM_ortho (ortho_jk, built here if it is None), a factorized contraction 
+					  of the exact integrals with the Ncore core orbitals costs O(Norbs^4 Ncore/2) instead of O(Norbs^4/8)
+		'''
+		emb_orbs = FBEorbs[:,:Norb_in_imp]
+		if self.eri_type == 'DF':
+			# J and K are only built in the embedding space: J_ij = Sum_L (L|ij) Sum_rs (L|rs) D_rs, K_ij = Sum_L Sum_rs (L|ir) D_rs (L|sj)
+			cderi_emb = np.matmul(self.orthoCDERI, emb_orbs)		# (L|rj)
+			if core_orbs is not None:
+				cderi_core = np.matmul(core_orbs.T, self.orthoCDERI)		# (L|kr)
+				rho = 2 * np.einsum('Lkr,rk->L', cderi_core, core_orbs)
+				cderi_core_emb = np.matmul(cderi_core, emb_orbs)		# (L|kj)
+				K = 2 * np.matmul(cderi_core_emb.transpose(0,2,1), cderi_core_emb).sum(axis=0)
+			else:
+				rho = np.einsum('Lrs,rs->L', self.orthoCDERI, core1RDM_ortho)
+				K = np.matmul(np.matmul(cderi_emb.transpose(0,2,1), core1RDM_ortho), cderi_emb).sum(axis=0)
+			J = np.einsum('L,Lij->ij', rho, np.matmul(emb_orbs.T, cderi_emb))
+			return J - 0.5*K
+		elif self.eri_type == 'hubbard':
+			# J - 0.5K = diag(0.5 * U_s * D_ss) in the site basis
+			if core_orbs is not None:
+				core_occ = 2 * np.einsum('sk,sk->s', core_orbs, core_orbs)
+			else:
+				core_occ = np.diag(core1RDM_ortho)
+			return np.dot(emb_orbs.T * (0.5 * self.hubbard_U * core_occ), emb_orbs)
+		if core1RDM_ortho is None: core1RDM_ortho = 2*np.dot(core_orbs, core_orbs.T)
+		J, K = self.ortho_jk(core1RDM_ortho)
+		jk = reduce(np.dot,(emb_orbs.T, J -0.5*K, emb_orbs))		
+		return jk
+		
+	def ortho_jk(self, DM):
+		'''
+		Coulomb and exchange matrices of a density matrix in the orthonormal basis
+		Return:
+			(J, K)
+		'''
+		if self.eri_type == 'DF':
+			rho = np.einsum('Lrs,rs->L', self.orthoCDERI, DM)
+			J = np.einsum('L,Lpq->pq', rho, self.orthoCDERI)
+			K = np.matmul(np.matmul(self.orthoCDERI, DM), self.orthoCDERI).sum(axis=0)
+		elif self.eri_type == 'outcore':
+			# Stream over the (pq| rows: J_pq = Sum_rs (pq|rs) D_rs, K_pr += Sum_s (pq|rs) D_sq and K_qr += Sum_s (pq|rs) D_sp for p != q
+			J = np.zeros((self.Norbs, self.Norbs))
+			K = np.zeros((self.Norbs, self.Norbs))
+			for p, q, eri in self.outcore_blocks():
+				J[p,q] = J[q,p] = np.einsum('xrs,rs->x', eri, DM)
+				np.add.at(K, p, np.einsum('xrs,sx->xr', eri, DM[:,q]))
+				offdiag = p != q
+				np.add.at(K, q[offdiag], np.einsum('xrs,sx->xr', eri[offdiag], DM[:,p[offdiag]]))
+		elif self.eri_type == 'hubbard':
+			J = np.diag(self.hubbard_U * np.diag(DM))
+			K = J.copy()
+		else:
+			J, K = scf.hf.dot_eri_dm(self.orthoTEI_s8, DM, hermi = 1)
+		return J, K
\ No newline at end of file
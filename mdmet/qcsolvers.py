@@ -10,11 +10,71 @@ import sys, os, ctypes
 from functools import reduce
 import PyCheMPS2
 import pyscf
-from pyscf import gto, scf, mcscf, dmrgscf, ao2mo
+from pyscf import gto, scf, mcscf, dmrgscf, ao2mo, fci
 from pyscf.tools import rhf_newtonraphson
+sys.path.append(os.getcwd().replace("/mpdmet", "/mpdmet/lib/build"))
+
+try:
+	import libchemps2
+except ImportError:
+	libchemps2 = None		# the CheMPS2 integrals/RDMs are then transferred element by element through PyCheMPS2
+
+DMRG_SCHEME = [(200, 1e-8, 5, 0.03), (500, 1e-8, 5, 0.03), (1000, 1e-8, 5, 0.03), (1000, 1e-8, 100, 0.00)]	#(D, Econst, maxSweeps, noisePrefactor), a few sweeps without noise at the end
+
+def chemps2_set_integrals(HamCheMPS2, FOCK, TEI):
+	'''
+	Feed the 1e (T) and 2e (V) integrals to a CheMPS2 Hamiltonian.
+	CheMPS2 stores a single copy of the elements related by symmetry (2-fold for T, 8-fold for V), 
+	so only the unique elements are set: N(N+1)/2 setTmat and about N^4/8 setVmat calls instead of N^2 and N^4. 
+	The indices and values are gathered with NumPy and passed as Python scalars.
+	NOTE: PyCheMPS2 has no array interface to the Hamiltonian, the setVmat calls are still O(N^4) Python -> C++ calls 
+	(~1e5 for N = 30), the solvers only use this function when libchemps2 (lib/libchemps2.cpp) is not compiled.
+	Args:
+		FOCK		: a (Norb, Norb) one-electron Hamiltonian
+		TEI			: a (Norb, Norb, Norb, Norb) two-electron integrals in chemist notation
+	'''
+	Norb = FOCK.shape[0]
+	row, col = np.tril_indices(Norb)
+	for args in zip(row.tolist(), col.tolist(), FOCK[row, col].tolist()):
+		HamCheMPS2.setTmat(*args)
+		
+	#(ij|kl) with i >= j, k >= l and ij >= kl, V_ikjl = (ij|kl) from chemist to physics notation
+	ij, kl = np.tril_indices(row.size)
+	i, j, k, l = row[ij], col[ij], row[kl], col[kl]
+	for args in zip(i.tolist(), k.tolist(), j.tolist(), l.tolist(), TEI[i, j, k, l].tolist()):
+		HamCheMPS2.setVmat(*args)
+
+def chemps2_get_2rdm(theDMRG, Norb):
+	'''
+	Read the 2RDM from a CheMPS2 DMRG object after calc2DMandCorrelations.
+	Only one element of each set of elements related by the symmetry of a real 2RDM (chemist notation) 
+	RDM2[p,q,r,s] = RDM2[r,s,p,q] = RDM2[q,p,s,r] = RDM2[s,r,q,p] is read with get2DMA, the others are filled with NumPy.
+	NOTE: about N^4/4 get2DMA calls are still needed (PyCheMPS2 has no array interface to the 2RDM), 
+	a real spin-summed 2RDM has no further symmetry, e.g. RDM2[p,q,r,s] != RDM2[q,p,r,s]. 
+	The solvers only use this function when libchemps2 is not compiled.
+	Return:
+		RDM2		: a (Norb, Norb, Norb, Norb) array in chemist notation
+	'''
+	p, q, r, s = np.indices((Norb, Norb, Norb, Norb)).reshape(4, -1)
+	orbits = [(p, q, r, s), (r, s, p, q), (q, p, s, r), (s, r, q, p)]
+	flat = [np.ravel_multi_index(orbit, (Norb, Norb, Norb, Norb)) for orbit in orbits]
+	unique = flat[0] == np.min(flat, axis = 0)
+	up, uq, ur, us = p[unique], q[unique], r[unique], s[unique]
+	values = np.array([theDMRG.get2DMA(*args) for args in zip(up.tolist(), ur.tolist(), uq.tolist(), us.tolist())])	#From physics to chemistry notation
+	RDM2 = np.zeros(Norb**4, dtype=ctypes.c_double)
+	for index in flat:
+		RDM2[index[unique]] = values
+	return RDM2.reshape(Norb, Norb, Norb, Norb)
 
 class QCsolvers:
-	def __init__(self, OEI, TEI, JK, DMguess, Norb, Nel, Nimp, chempot = 0.0):
+	def __init__(self, OEI, TEI, JK, DMguess, Norb, Nel, Nimp, chempot = 0.0, state = None):
+		'''
+		Args:
+			state		: the solver state of a previous (similar) embedding problem used as a warm start, 
+						  it is a dict with some of: 'hf_mo_coeff', 'mo_coeff', 'ci', 'fcisolver', 
+						  'ci_warm_start' (True if the CI vector of the previous solution was used as the initial guess).
+						  self.state is replaced by the state of the new solution after calling a solver
+		'''
 		self.OEI = OEI
 		self.TEI = TEI
 		self.FOCK = OEI + JK
@@ -23,6 +83,17 @@ class QCsolvers:
 		self.Nel = Nel
 		self.Nimp = Nimp
 		self.chempot = chempot
+		self.state = state
+		self.conv_tol = None		#(energy, gradient/residual) thresholds of the RHF, FCI and CASSCF solvers, None for the pyscf defaults
+		
+	def warm_start_DM(self, mf):
+		'''
+		Return the RHF density matrix built from the HF orbitals in self.state, or DMguess if there is none
+		'''
+		if self.conv_tol is not None: mf.conv_tol, mf.conv_tol_grad = self.conv_tol
+		if self.state is None or self.state.get('hf_mo_coeff') is None: return self.DMguess
+		occ = self.state['hf_mo_coeff'][:,:self.Nel//2]
+		return 2 * np.dot(occ, occ.T)
 		
 	def RHF(self):
 		'''
@@ -45,11 +116,12 @@ class QCsolvers:
 		mf.get_hcore = lambda *args: FOCK
 		mf.get_ovlp = lambda *args: np.eye(self.Norb)
 		mf._eri = ao2mo.restore(8, self.TEI, self.Norb)
-		mf.scf(self.DMguess)
+		mf.scf(self.warm_start_DM(mf))
 		DMloc = np.dot(np.dot(mf.mo_coeff, np.diag(mf.mo_occ)), mf.mo_coeff.T)
 		if ( mf.converged == False ):
 			mf = rhf_newtonraphson.solve( mf, dm_guess=DMloc)
 			DMloc = np.dot(np.dot(mf.mo_coeff, np.diag(mf.mo_occ)), mf.mo_coeff.T)
+		self.state = {'hf_mo_coeff': mf.mo_coeff}
 		
 		ERHF = mf.e_tot
 		RDM1 = mf.make_rdm1()
@@ -82,25 +154,11 @@ class QCsolvers:
 		Nimp = self.Nimp
 		FOCK = self.FOCK.copy()	
 		
-		CheMPS2print = False		
-		Initializer = PyCheMPS2.PyInitialize()
-		Initializer.Init()
-		Group = 0
-		orbirreps = np.zeros([Norb], dtype=ctypes.c_int)
-		HamCheMPS2 = PyCheMPS2.PyHamiltonian(Norb, Group, orbirreps)
-		
-		#Feed the 1e and 2e integral (T and V)
-		for cnt1 in range(Norb):
-				for cnt2 in range(Norb):
-					HamCheMPS2.setTmat(cnt1, cnt2, FOCK[cnt1, cnt2])
-					for cnt3 in range(Norb):
-						for cnt4 in range(Norb):
-								HamCheMPS2.setVmat(cnt1, cnt2, cnt3, cnt4, self.TEI[cnt1, cnt3, cnt2, cnt4]) #From chemist to physics notation		
-
 		if (self.chempot != 0.0):
 			for orb in range(Nimp):
-				HamCheMPS2.setTmat(orb, orb, FOCK[orb, orb] - self.chempot)	
-
+				FOCK[orb, orb] -= self.chempot	
+				
+		CheMPS2print = False		
 		if CheMPS2print == False:
 			sys.stdout.flush()
 			old_stdout = sys.stdout.fileno()
@@ -110,34 +168,37 @@ class QCsolvers:
 			os.close(devnull)
 			
 		assert( self.Nel % 2 == 0 )
-		TwoS  = 0
-		Irrep = 0
-		Prob  = PyCheMPS2.PyProblem( HamCheMPS2, TwoS, self.Nel, Irrep )
+		if libchemps2 is not None:
+			#The integrals are fed and the 2RDM is read in C++ 
+			EDMRG, RDM2 = libchemps2.dmrg(FOCK, self.TEI, self.Nel, DMRG_SCHEME)
+		else:
+			Initializer = PyCheMPS2.PyInitialize()
+			Initializer.Init()
+			Group = 0
+			orbirreps = np.zeros([Norb], dtype=ctypes.c_int)
+			HamCheMPS2 = PyCheMPS2.PyHamiltonian(Norb, Group, orbirreps)
+			chemps2_set_integrals(HamCheMPS2, FOCK, self.TEI)		#Feed the 1e and 2e integral (T and V)
+			
+			TwoS  = 0
+			Irrep = 0
+			Prob  = PyCheMPS2.PyProblem( HamCheMPS2, TwoS, self.Nel, Irrep )
 
-		OptScheme = PyCheMPS2.PyConvergenceScheme(4) # 3 instructions
-		#OptScheme.setInstruction(instruction, D, Econst, maxSweeps, noisePrefactor)
-		OptScheme.setInstruction(0,  200, 1e-8,  5, 0.03)		
-		OptScheme.setInstruction(1,  500, 1e-8,  5, 0.03)
-		OptScheme.setInstruction(2, 1000, 1e-8,  5, 0.03)
-		OptScheme.setInstruction(3, 1000, 1e-8,  100, 0.00) # Last instruction a few iterations without noise
+			OptScheme = PyCheMPS2.PyConvergenceScheme(len(DMRG_SCHEME))
+			for instruction, (D, Econst, maxSweeps, noisePrefactor) in enumerate(DMRG_SCHEME):
+				OptScheme.setInstruction(instruction, D, Econst, maxSweeps, noisePrefactor)
 
-		theDMRG = PyCheMPS2.PyDMRG( Prob, OptScheme )
-		EDMRG = theDMRG.Solve()
-		theDMRG.calc2DMandCorrelations()
-		RDM2 = np.zeros( [Norb, Norb, Norb, Norb], dtype=ctypes.c_double )
-		for orb1 in range(Norb):
-			for orb2 in range(Norb):
-				for orb3 in range(Norb):
-					for orb4 in range(Norb):
-						RDM2[ orb1, orb3, orb2, orb4 ] = theDMRG.get2DMA( orb1, orb2, orb3, orb4 ) #From physics to chemistry notation
+			theDMRG = PyCheMPS2.PyDMRG( Prob, OptScheme )
+			EDMRG = theDMRG.Solve()
+			theDMRG.calc2DMandCorrelations()
+			RDM2 = chemps2_get_2rdm(theDMRG, Norb)
 
-		# theDMRG.deleteStoredMPS()
-		theDMRG.deleteStoredOperators()
-		del(theDMRG)
-		del(OptScheme)
-		del(Prob)
-		del(HamCheMPS2)
-		del(Initializer)	
+			# theDMRG.deleteStoredMPS()
+			theDMRG.deleteStoredOperators()
+			del(theDMRG)
+			del(OptScheme)
+			del(Prob)
+			del(HamCheMPS2)
+			del(Initializer)	
 
 		if CheMPS2print == False:		
 			sys.stdout.flush()
@@ -160,25 +221,11 @@ class QCsolvers:
 		Nimp = self.Nimp
 		FOCK = self.FOCK.copy()	
 		
-		CheMPS2print = False
-		Initializer = PyCheMPS2.PyInitialize()
-		Initializer.Init()
-		Group = 0
-		orbirreps = np.zeros([Norb], dtype=ctypes.c_int)
-		HamCheMPS2 = PyCheMPS2.PyHamiltonian(Norb, Group, orbirreps)
-		
-		#Feed the 1e and 2e integral (T and V)
-		for cnt1 in range(Norb):
-				for cnt2 in range(Norb):
-					HamCheMPS2.setTmat(cnt1, cnt2, FOCK[cnt1, cnt2])
-					for cnt3 in range(Norb):
-						for cnt4 in range(Norb):
-								HamCheMPS2.setVmat(cnt1, cnt2, cnt3, cnt4, self.TEI[cnt1, cnt3, cnt2, cnt4]) #From chemist to physics notation		
-
 		if (self.chempot != 0.0):
 			for orb in range(Nimp):
-				HamCheMPS2.setTmat(orb, orb, FOCK[orb, orb] - self.chempot)	
+				FOCK[orb, orb] -= self.chempot	
 
+		CheMPS2print = False
 		if CheMPS2print == False:
 			sys.stdout.flush()
 			old_stdout = sys.stdout.fileno()
@@ -188,23 +235,34 @@ class QCsolvers:
 			os.close(devnull)
 		
 		assert( self.Nel % 2 == 0 )
-		Nel_up       = self.Nel / 2
-		Nel_down     = self.Nel / 2
-		Irrep= 0
 		maxMemWorkMB = 1000.0
-		FCIverbose   = 2
-		theFCI = PyCheMPS2.PyFCI(HamCheMPS2, Nel_up, Nel_down, Irrep, maxMemWorkMB, FCIverbose)
-		GSvector = np.zeros([theFCI.getVecLength() ], dtype=ctypes.c_double)
-		theFCI.FillRandom(theFCI.getVecLength() , GSvector) # Random numbers in [-1,1]
-		GSvector[ theFCI.LowestEnergyDeterminant() ] = 12.345 # Large component for quantum chemistry
-		EFCI = theFCI.GSDavidson( GSvector )
-		#SpinSquared = theFCI.CalcSpinSquared( GSvector )
-		RDM2 = np.zeros( [ Norb**4 ], dtype=ctypes.c_double )
-		theFCI.Fill2RDM( GSvector, RDM2 )
-		RDM2 = RDM2.reshape( [Norb, Norb, Norb, Norb], order='F' )
-		RDM2 = np.swapaxes( RDM2, 1, 2 ) #From physics to chemistry notation
-		del theFCI
-		del HamCheMPS2
+		if libchemps2 is not None:
+			#The integrals are fed and the 2RDM is read in C++ 
+			EFCI, RDM2 = libchemps2.fci(FOCK, self.TEI, self.Nel, maxMemWorkMB)
+		else:
+			Initializer = PyCheMPS2.PyInitialize()
+			Initializer.Init()
+			Group = 0
+			orbirreps = np.zeros([Norb], dtype=ctypes.c_int)
+			HamCheMPS2 = PyCheMPS2.PyHamiltonian(Norb, Group, orbirreps)
+			chemps2_set_integrals(HamCheMPS2, FOCK, self.TEI)		#Feed the 1e and 2e integral (T and V)
+			
+			Nel_up       = self.Nel / 2
+			Nel_down     = self.Nel / 2
+			Irrep= 0
+			FCIverbose   = 2
+			theFCI = PyCheMPS2.PyFCI(HamCheMPS2, Nel_up, Nel_down, Irrep, maxMemWorkMB, FCIverbose)
+			GSvector = np.zeros([theFCI.getVecLength() ], dtype=ctypes.c_double)
+			theFCI.FillRandom(theFCI.getVecLength() , GSvector) # Random numbers in [-1,1]
+			GSvector[ theFCI.LowestEnergyDeterminant() ] = 12.345 # Large component for quantum chemistry
+			EFCI = theFCI.GSDavidson( GSvector )
+			#SpinSquared = theFCI.CalcSpinSquared( GSvector )
+			RDM2 = np.zeros( [ Norb**4 ], dtype=ctypes.c_double )
+			theFCI.Fill2RDM( GSvector, RDM2 )
+			RDM2 = RDM2.reshape( [Norb, Norb, Norb, Norb], order='F' )
+			RDM2 = np.swapaxes( RDM2, 1, 2 ) #From physics to chemistry notation
+			del theFCI
+			del HamCheMPS2
 
 		if CheMPS2print == False:		
 			sys.stdout.flush()
@@ -241,7 +299,7 @@ class QCsolvers:
 		mf.get_hcore = lambda *args: FOCK
 		mf.get_ovlp = lambda *args: np.eye(Norb)
 		mf._eri = ao2mo.restore(8, self.TEI, Norb)
-		mf.scf(self.DMguess)
+		mf.scf(self.warm_start_DM(mf))
 		DMloc = np.dot(np.dot(mf.mo_coeff, np.diag(mf.mo_occ)), mf.mo_coeff.T)
 		
 		if ( mf.converged == False ):
@@ -263,7 +321,15 @@ class QCsolvers:
 		else:
 			mc = mcscf.CASCI(mf, CAS_norb, CAS_nelec)	
 			
-		if solver == 'CheMPS2':
+		# Warm start from the previous solution: the DMRG solver (with its stored MPS) is reused and the CI vector is rotated to the new active orbitals.
+		# The CASSCF orbitals are not reused, CASSCF has several stationary points and the one found from the previous orbitals 
+		# depends on the history of the calculation. The orbital optimization starts from the (warm-started) RHF orbitals
+		state = self.state if self.state is not None else {}
+		if solver != 'FCI' and state.get('fcisolver') is not None:
+			mc.fcisolver = state['fcisolver']
+			mc.fcisolver.mol = mol
+			if hasattr(mc.fcisolver, 'restart'): mc.fcisolver.restart = True
+		elif solver == 'CheMPS2':
 			mc.fcisolver = dmrgscf.CheMPS2(mol)
 		elif solver == 'Block':
 			mc.fcisolver = dmrgscf.DMRGCI(mol)		
@@ -271,9 +337,28 @@ class QCsolvers:
 		if CAS_MO is not None: 
 			print("     Active space MOs: ", CAS_MO)
 			mo = mc.sort_mo(CAS_MO)
-			ECAS = mc.kernel(mo)[0]
 		else:
-			ECAS = mc.kernel()[0]
+			mo = mf.mo_coeff
+			
+		ci0 = None
+		if solver == 'FCI' and self.conv_tol is not None:
+			mc.fcisolver.conv_tol = self.conv_tol[0]
+			mc.fcisolver.conv_tol_residual = self.conv_tol[1]		#lindep keeps the pyscf default, conv_tol[1]**2 would be below the round-off of the Davidson basis
+		if Orbital_optimization == True and self.conv_tol is not None:
+			mc.conv_tol, mc.conv_tol_grad = self.conv_tol
+			
+		# The CI vector is only used when the CI space is solved by the Davidson method (i.e. larger than pspace_size)
+		if solver == 'FCI' and state.get('ci') is not None and state['ci'].size > mc.fcisolver.pspace_size:
+			CAS_slice = slice(mc.ncore, mc.ncore + mc.ncas)
+			rotation = np.dot(state['mo_coeff'][:,CAS_slice].T, mo[:,CAS_slice])
+			ci0 = fci.addons.transform_ci_for_orbital_rotation(state['ci'], mc.ncas, mc.nelecas, rotation)
+		ECAS = mc.kernel(mo, ci0=ci0)[0]
+		
+		self.state = {'hf_mo_coeff': mf.mo_coeff, 'mo_coeff': mc.mo_coeff, 'ci_warm_start': ci0 is not None}
+		if solver == 'FCI':
+			self.state['ci'] = mc.ci
+		else:
+			self.state['fcisolver'] = mc.fcisolver
 			
 		###### Get RDM1 + RDM2 #####
 		CAS_norb = mc.ncas
@@ -0,0 +1,117 @@
+'''
+Multipurpose Density Matrix Embedding theory (mp-DMET)
+Copyright (C) 2015 Hung Q. Pham
+Author: Hung Q. Pham, Unviversity of Minnesota
+email: phamx494@umn.edu
+
+Pure NumPy implementation of the 1RDM response in libdmet (lib/libdmet.cpp), with the same functions and arguments.
+It is used when libdmet is not compiled or with DMET.response_backend = 'numpy'
+ref: J. Chem. Theory Comput. 2016, 12, 2706−2719
+'''
+
+import numpy as np
+import scipy.sparse
+
+RESPONSE_BLOCK = 64		#Number of terms processed together
+
+class ResponseHelper:
+	def __init__(self, Norb, numPairs, H1start, H1row, H1col, eigvecs, eigvals):
+		'''
+		Intermediates shared by all terms
+		Args:
+			eigvecs, eigvals	: eigenvectors (as columns) and eigenvalues of H0 in ascending order
+		'''
+		self.Norb = Norb
+		self.occ = eigvecs[:,:numPairs]
+		self.virt = eigvecs[:,numPairs:]
+		self.temp = -1.0 / (eigvals[numPairs:,None] - eigvals[None,:numPairs])		#temp[vir, occ] = - 1 / ( eps_vir - eps_occ )
+		self.H1start = np.asarray(H1start)
+		self.H1row = np.asarray(H1row)
+		self.H1col = np.asarray(H1col)
+
+	def Z1(self, first, last):
+		'''
+		Z1 = - VIRT.T * H1 * OCC / ( eps_vir - eps_occ ) for the terms [first, last), Z1 in the equation (44) in JCTC 2016, 12, 2706
+		H1 * OCC of all the terms is a single sparse product, Z1 is then a batched matmul
+		Return:
+			Z1		: a (last - first, nVir, numPairs) array
+		'''
+		Nblock = last - first
+		elem_start, elem_end = self.H1start[first], self.H1start[last]
+		term = np.repeat(np.arange(Nblock), np.diff(self.H1start[first:last + 1]))
+		H1 = scipy.sparse.csr_matrix((np.ones(elem_end - elem_start), (term*self.Norb + self.H1row[elem_start:elem_end], self.H1col[elem_start:elem_end])),
+										shape = (Nblock*self.Norb, self.Norb))
+		H1occ = (H1 @ self.occ).reshape(Nblock, self.Norb, -1)
+		return np.matmul(self.virt.T, H1occ) * self.temp
+
+	def blocks(self, Nterms):
+		'''
+		The [first, last) ranges of the blocks of terms
+		'''
+		for first in range(0, Nterms, RESPONSE_BLOCK):
+			yield first, min(first + RESPONSE_BLOCK, Nterms)
+
+def rhf_response(Norb, Nterms, numPairs, H1start, H1row, H1col, H0):
+	'''
+	Analytical 1RDM derivative for Hamiltonian: H = H0 + H1
+	Return:
+		rdm_deriv	: a (Nterms, Norb, Norb) array
+	'''
+	eigvals, eigvecs = np.linalg.eigh(H0)
+	return rhf_response_eig(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals)
+
+def rhf_response_eig(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals):
+	'''
+	Same as rhf_response, but using the eigenvectors/eigenvalues of H0 already computed
+	'''
+	helper = ResponseHelper(Norb, numPairs, H1start, H1row, H1col, eigvecs, eigvals)
+	rdm_deriv = np.empty((Nterms, Norb, Norb))
+	for first, last in helper.blocks(Nterms):
+		# work = 2 * VIRT * Z1 * OCC.T, i.e. Cvir*Z1*Cocc.T in the equation (45) in JCTC 2016, 12, 2706
+		work = np.matmul(2 * np.matmul(helper.virt, helper.Z1(first, last)), helper.occ.T)
+		rdm_deriv[first:last] = work + work.transpose(0,2,1)
+	return rdm_deriv
+
+def rhf_response_projected(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals, transforms):
+	'''
+	1RDM response projected onto the Schmidt basis of each fragment: T.T * rdm_deriv[deriv] * T,
+	computed as A + A.T with A = 2 * (T.T * VIRT) * Z1 * (OCC.T * T) without building rdm_deriv
+	Args:
+		transforms	: a list of (Norb, n) transformation matrices
+	Return:
+		a list of (Nterms, n, n) arrays
+	'''
+	helper = ResponseHelper(Norb, numPairs, H1start, H1row, H1col, eigvecs, eigvals)
+	Tvir = [np.dot(T.T, helper.virt) for T in transforms]
+	Tocc = [np.dot(helper.occ.T, T) for T in transforms]
+	projected = [np.empty((Nterms, T.shape[1], T.shape[1])) for T in transforms]
+	for first, last in helper.blocks(Nterms):
+		Z1 = helper.Z1(first, last)
+		for frag in range(len(transforms)):
+			work = np.matmul(2 * np.matmul(Tvir[frag], Z1), Tocc[frag])
+			projected[frag][first:last] = work + work.transpose(0,2,1)
+	return projected
+
+def rhf_response_gradient(Norb, Nterms, numPairs, H1start, H1row, H1col, eigvecs, eigvals, transforms, residuals):
+	'''
+	Gradient of CF = Sum_x Sum_rs R_x_rs^2 where dR_x/du = T_x.T * rdm_deriv[deriv] * T_x, without building rdm_deriv:
+		gradient[deriv] = Sum_(row,col) in H1[deriv] G[row, col], G = VIRT * (4 * M * temp) * OCC.T,
+		M = VIRT.T * P * OCC, P = Sum_x T_x * (R_x + R_x.T) * T_x.T
+	Args:
+		transforms	: a list of (Norb, n) transformation matrices
+		residuals	: a list of (n, n) residuals, they should be scaled beforehand to weight the fragments
+	'''
+	occ = eigvecs[:,:numPairs]
+	virt = eigvecs[:,numPairs:]
+	temp = -1.0 / (eigvals[numPairs:,None] - eigvals[None,:numPairs])
+	P = np.zeros((Norb, Norb))
+	for T, R in zip(transforms, residuals):
+		P += np.dot(np.dot(T, R + R.T), T.T)
+	M = 4 * np.dot(np.dot(virt.T, P), occ) * temp
+	G = np.dot(np.dot(virt, M), occ.T)
+	H1start = np.asarray(H1start)
+	elem_gradient = G[np.asarray(H1row), np.asarray(H1col)]
+	gradient = np.zeros(Nterms)
+	nonempty = np.diff(H1start) > 0
+	gradient[nonempty] = np.add.reduceat(elem_gradient, H1start[:-1][nonempty])
+	return gradient
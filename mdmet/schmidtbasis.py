@@ -9,6 +9,8 @@ import numpy as np
 import scipy as scipy
 from functools import reduce
 
+BATH_BATCH = 32		#Number of fragments decomposed together in batch_baths
+
 class RHF_decomposition:
 	def __init__(self, mf, impOrbs, numBathOrbs, orthoOED, method = 'OED'):	
 		self.mf = mf
@@ -16,115 +18,217 @@ class RHF_decomposition:
 		self.method = method
 		self.numBathOrbs = numBathOrbs		
 		self.orthoMO, self.orthoOED = orthoOED
+		self.emb_only = False		# OED/overlap: only return the fragment + bath orbitals and the core orbitals, see UsingOED
+		self.bath_threshold = None		# OED/SVD: bath orbitals within bath_threshold of occupation 0 or 2 are put into the environment
+		self.discarded_occupation = 0.0		# Sum of min(occ, 2 - occ) of the bath orbitals put into the environment by the last baths() call
 		
 	def baths(self):
 		'''
 		This function is used to call the Schmidt basis using either an overlap matrix or 1-rdm (or OED)
 		'''
 		if self.method == 'OED':
-			return self.UsingOED(self.numBathOrbs, threshold = 1e-13)
+			return self.UsingOED(self.numBathOrbs, threshold = self.bath_threshold, emb_only = self.emb_only)
 		elif self.method == 'overlap':
-			return self.UsingOverlap(self.numBathOrbs, threshold = 1e-7)
+			return self.UsingOverlap(self.numBathOrbs, threshold = 1e-7, emb_only = self.emb_only)
+		elif self.method == 'SVD':
+			return self.UsingSVD(self.numBathOrbs, threshold = 1e-7, bath_threshold = self.bath_threshold)
+		else:
+			raise Exception('the bath construction method ' + str(self.method) + ' is not supported')
 			
-	def UsingOverlap(self, numBathOrbs, threshold = 1e-7):
+	def UsingOverlap(self, numBathOrbs, threshold = 1e-7, emb_only = False):
 		'''
 		Construct the RHF bath using a projector
 		ref: PHYSICAL REVIEW B 89, 035140 (2014)
+		The fragment projector is a row selection: the overlap matrix between the hole states and the fragment orbitals 
+		Occ.T * P_F * Occ = C_F.T * C_F is diagonalized from the SVD of the fragment rows C_F = U s V.T (d = s^2), 
+		O(N n_occ n_imp) without any N x N projector
+		Args:
+			emb_only	: if True, only the fragment + bath columns are returned, with the core orbitals instead of the entangled orbitals
+		Return:
+			(numBathOrbs, FBEorbs, entorbs), FBEorbs are the fragment, bath and pure environment (core) orbitals
+			or (numBathOrbs, emb_orbs, core_orbs) if emb_only
 		'''
-
-		# Build the projectors for fragment and bath
-		nao = self.mf.mol.nao_nr()
-		P_F = np.zeros((nao,nao))
-		P_F[self.impOrbs == 1,self.impOrbs == 1] = 1
-		P_B = np.identity(nao)- P_F		
-		
-		
-		# Build the overlap matrix between hole states and fragment orbs
+		impurityOrbs = np.asarray(self.impOrbs) == 1
 		nelec_pairs = self.mf.mol.nelectron // 2 	
 		Occ = self.orthoMO[:,:nelec_pairs]
-		M = reduce(np.dot,(Occ.T, P_F,Occ))
-		d, V = np.linalg.eigh(M) 				# 0 <= d <= 1
-		idx = (-d).argsort() 					#d close to 1 come first
-		d, V = d[idx], V[:, idx] 
+		U, s, Vt = np.linalg.svd(Occ[impurityOrbs], full_matrices = False)
+		d = s**2 				# 0 <= d <= 1, d close to 1 come first
 		tokeep = np.sum(d > threshold)
 		if tokeep < numBathOrbs:
 			print ("BATH CONSTRUCTION: using only ", tokeep, " orbitals which are within ", threshold, " of 0 or 1")
 		numBathOrbs = min(tokeep, numBathOrbs) #TODO: Truncated bath scheme for this construction????
 		
-		Forbs = np.einsum('pi,up->ui',V[:,:tokeep], np.dot(P_F, Occ))/np.sqrt(d[:numBathOrbs])
-		Borbs = np.einsum('pi,up->ui',V[:,:tokeep], np.dot(P_B, Occ))/np.sqrt(1 - d[:numBathOrbs])
+		entorbs = np.dot(Occ, Vt[:tokeep].T)
+		Forbs = np.zeros((Occ.shape[0], numBathOrbs))
+		Forbs[impurityOrbs] = entorbs[impurityOrbs,:numBathOrbs] / np.sqrt(d[:numBathOrbs])
+		Borbs = entorbs[:,:numBathOrbs].copy()
+		Borbs[impurityOrbs] = 0.0
+		Borbs /= np.sqrt(1 - d[:numBathOrbs])
+		pureEnorbs = occupied_complement(Occ, Vt[:tokeep])
 		
-		pureEnorbs = np.einsum('pi,up->ui', V[:,tokeep:], Occ)
-		entorbs = np.einsum('pi,up->ui', V[:,:tokeep], Occ)		
+		if emb_only:
+			return (numBathOrbs, np.hstack((Forbs, Borbs)), pureEnorbs)
 		FBEorbs = np.hstack((Forbs, Borbs, pureEnorbs))
-			
 		return (numBathOrbs, FBEorbs, entorbs)
 			
-	def UsingOED( self, numBathOrbs, threshold=1e-13 ):
+	def UsingSVD(self, numBathOrbs, threshold = 1e-7, svd = None, bath_threshold = None):
+		'''
+		Construct the RHF bath from the SVD of the fragment rows of the occupied orbitals, C_F = U s V.T,
+		the environment-fragment block of the 1RDM is D_EF = 2 * (C_E V) s U.T so its left singular vectors (the bath) 
+		are the normalized C_E V, the occupied orbitals orthogonal to V (C_F V_perp = 0) are the core.
+		Only the (N, n_occ) occupied orbitals are used: O(N n_occ n_imp + n_occ n_imp^2), no N x N matrix is diagonalized.
+		Args:
+			svd			: (U, sigma, Vt) of the fragment rows of the occupied orbitals if it is already computed (see batch_baths)
+			bath_threshold	: bath orbitals with an occupation 2(1 - s^2) within bath_threshold of 0 or 2 are discarded/put into the core
+		Return:
+			numBathOrbs	: the number of bath orbitals, bath orbitals with s within threshold of 0 or 1 are not kept
+			emb_orbs	: a (N, n_imp + numBathOrbs) array, the fragment orbitals (U) followed by the bath orbitals
+			core_orbs	: a (N, n_core) array of the core orbitals, the core 1RDM is 2 * core_orbs * core_orbs.T
+		'''
+		impurityOrbs = np.asarray(self.impOrbs) == 1
+		numImpOrbs = np.sum(impurityOrbs)
+		nelec_pairs = self.mf.mol.nelectron // 2
+		Occ = self.orthoMO[:,:nelec_pairs]
+		
+		self.discarded_occupation = 0.0
+		if svd is None:
+			svd = np.linalg.svd(Occ[impurityOrbs], full_matrices = (nelec_pairs < numImpOrbs))
+		U, sigma, Vt = svd		# sigma = sqrt(occupation/2) of the fragment orbitals U
+		Vt = Vt[:sigma.size]
+		tokeep = np.sum((sigma > threshold) & (sigma < 1 - threshold))
+		if tokeep < numBathOrbs:
+			print ("BATH CONSTRUCTION: using only ", tokeep, " orbitals which are within ", threshold, " of 0 or 1")
+		numBathOrbs = min(tokeep, numBathOrbs)
+		
+		# The core: the occupied orbitals orthogonal to the entangled ones C V_(sigma > threshold)
+		core_orbs = occupied_complement(Occ, Vt[:np.sum(sigma > threshold)])
+		
+		keep = (sigma > threshold) & (sigma < 1 - threshold)
+		bath = np.dot(Occ, Vt[keep].T) 
+		bath[impurityOrbs] = 0.0
+		bath /= np.sqrt(1 - sigma[keep]**2)
+		
+		if bath_threshold is not None:
+			occupation = 2*(1 - sigma[keep]**2)
+			entangled_bath = np.minimum(occupation, 2 - occupation) > bath_threshold
+			if not entangled_bath.all():
+				self.discarded_occupation = np.minimum(occupation, 2 - occupation)[~entangled_bath].sum()
+				print ("DMET::constructbath : Throwing out", np.sum(~entangled_bath), "orbitals which are within", bath_threshold, "of 0 or 2, discarded occupation:", self.discarded_occupation)
+				core_orbs = np.hstack((core_orbs, bath[:,~entangled_bath & (occupation > 1.0)]))
+				bath = bath[:,entangled_bath]
+				numBathOrbs = min(bath.shape[1], numBathOrbs)
+		
+		emb_orbs = np.zeros((Occ.shape[0], numImpOrbs + numBathOrbs))
+		emb_orbs[impurityOrbs,:numImpOrbs] = U
+		emb_orbs[:,numImpOrbs:] = bath[:,:numBathOrbs]
+		return (numBathOrbs, emb_orbs, core_orbs)
+		
+	def UsingOED(self, numBathOrbs, threshold = None, emb_only = False):
 		'''
 		Construct the RHF bath using one-electron density matrix (OED)
 		This function is a modified version of qcdmethelper/constructbath funtion 
 		in the QC-DMET <Copyright (C) 2015 Sebastian Wouters>
 		ref: 
 			J. Chem. Theory Comput. 2016, 12, 2706−2719
+		Args:
+			threshold	: bath orbitals within threshold of occupation 0 or 2 are put into the environment, None: no truncation
+			emb_only	: if True, only the fragment + bath columns are returned, with the core orbitals instead of the core occupations
+		Return:
+			(numBathOrbs, FBEorbs, coreOccupations), FBEorbs is a N x N array
+			or (numBathOrbs, emb_orbs, core_orbs) if emb_only, emb_orbs is a N x (n_imp + numBathOrbs) array
 		'''	
 		
 		OneDM = self.orthoOED
-		impurityOrbs = np.asarray(self.impOrbs)
-		embeddingOrbs = 1 - impurityOrbs
-		if (embeddingOrbs.shape[0] > 1):
-			embeddingOrbs = embeddingOrbs.T		
-		embeddingOrbs = np.matrix(embeddingOrbs) 				#Converse embeddingOrbs to a matrix (1, x)
-		isEmbedding = np.dot(embeddingOrbs.T , embeddingOrbs) == 1
-		numEmbedOrbs = np.sum(embeddingOrbs, dtype = np.int32)
-		embedding1RDM = np.reshape(OneDM[isEmbedding], (numEmbedOrbs, numEmbedOrbs))
-
-		numImpOrbs   = np.sum(impurityOrbs, dtype = np.int32)
-		numTotalOrbs = len(impurityOrbs)
-        
-		eigenvals, eigenvecs = np.linalg.eigh(embedding1RDM)  	# 0 <= eigenvals <= 2		
+		impurityOrbs = np.asarray(self.impOrbs) == 1
+		imp_idx = np.flatnonzero(impurityOrbs)
+		env_idx = np.flatnonzero(~impurityOrbs)
+		numImpOrbs   = imp_idx.size
+		numTotalOrbs = impurityOrbs.size
+		
+		eigenvals, eigenvecs = np.linalg.eigh(OneDM[np.ix_(env_idx, env_idx)])  	# 0 <= eigenvals <= 2		
+		eigenvals_frag, eigenvecs_frag = np.linalg.eigh(OneDM[np.ix_(imp_idx, imp_idx)])
 		
 		idx = np.maximum(-eigenvals, eigenvals - 2.0).argsort() # Occupation numbers closest to 1 come first
 		
-		#TODO: whether the truncation should be used
-		'''tokeep = np.sum(-np.maximum(-eigenvals, eigenvals - 2.0)[idx] > threshold)
-		if tokeep < numBathOrbs:
-			print ("DMET::constructbath : Throwing out", numBathOrbs - tokeep, "orbitals which are within", threshold, "of 0 or 2.")
-		numBathOrbs = min(np.sum(tokeep), numBathOrbs)'''
+		self.discarded_occupation = 0.0
+		if threshold is not None:
+			entanglement = -np.maximum(-eigenvals, eigenvals - 2.0)[idx[:numBathOrbs]]		# min(occ, 2 - occ), in descending order
+			tokeep = np.sum(entanglement > threshold)
+			if tokeep < numBathOrbs:
+				self.discarded_occupation = entanglement[tokeep:].sum()
+				print ("DMET::constructbath : Throwing out", numBathOrbs - tokeep, "orbitals which are within", threshold, "of 0 or 2, discarded occupation:", self.discarded_occupation)
+			numBathOrbs = tokeep
 		
+		#Bath orbitals first, then the pure environment orbitals in the descending order of occupation numbers
+		envidx = (-eigenvals[idx[numBathOrbs:]]).argsort()
+		idx = np.hstack((idx[:numBathOrbs], idx[numBathOrbs:][envidx]))
 		eigenvals = eigenvals[idx]
-		eigenvecs = eigenvecs[:,idx]
 		pureEnvals = eigenvals[numBathOrbs:]
-		pureEnorbs = eigenvecs[:,numBathOrbs:]
-		idx = (-pureEnvals).argsort()
-		eigenvecs[:,numBathOrbs:] = pureEnorbs[:,idx]
-		pureEnvals = pureEnvals[idx]
 		coreOccupations = np.hstack((np.zeros([numImpOrbs + numBathOrbs]), pureEnvals)) #Use to calculate the 1e rdm of core orbitals
 
-		# Reconstruct the fragment orbitals so that the density matrix has a trivial form:
-		embeddingOrbs_frag = np.matrix(impurityOrbs) 				#Converse embeddingOrbs to a matrix (1, x)
-		isEmbedding_frag = np.dot(embeddingOrbs_frag.T , embeddingOrbs_frag) == 1
-		numEmbedOrbs_frag = np.sum(embeddingOrbs_frag, dtype = np.int32)
-		embedding1RDM_frag = np.reshape(OneDM[isEmbedding_frag], (numEmbedOrbs_frag, numEmbedOrbs_frag))
-		eigenvals_frag, eigenvecs_frag = np.linalg.eigh(embedding1RDM_frag)  	# 0 <= eigenvals <= 2
-
+		# Reconstruct the fragment orbitals so that the density matrix has a trivial form: eigenvecs_frag
 		#TODO:
 		#Whether one should reconstruct the the fragment orbitals?
 		if False: eigenvecs_frag = np.eye(eigenvecs_frag.shape[0],eigenvecs_frag.shape[0])
 		
-		#Fragment orbitals: stack columns with zeros in the end
-		#Embedding orbitals: stack columns with zeros in the beginning	
-		eigenvecs_frag = np.hstack((eigenvecs_frag, np.zeros((numImpOrbs, numEmbedOrbs)))) 
-		eigenvecs = np.hstack((np.zeros((numEmbedOrbs, numImpOrbs)), eigenvecs))
-		row = 0
-		for ao in range(0, numTotalOrbs):
-			if impurityOrbs[ao]:
-				eigenvecs = np.insert(eigenvecs, ao, eigenvecs_frag[row], axis=0)
-				row += 1
-    
-        # Orthonormality is guaranteed due to (1) stacking with zeros and (2) orthonormality eigenvecs for symmetric matrix
-		assert(np.linalg.norm(np.dot(eigenvecs.T, eigenvecs) - np.identity(numTotalOrbs)) < 1e-12 )
-	
-		return (numBathOrbs, eigenvecs, coreOccupations)
+		#Fragment orbitals on the impurity rows, bath/environment orbitals on the environment rows,
+		#orthonormality is guaranteed by the orthonormality of the eigenvectors of symmetric matrices
+		if emb_only:
+			Norb_in_imp = numImpOrbs + numBathOrbs
+			emb_orbs = np.zeros((numTotalOrbs, Norb_in_imp))
+			emb_orbs[imp_idx,:numImpOrbs] = eigenvecs_frag
+			emb_orbs[env_idx,numImpOrbs:] = eigenvecs[:,idx[:numBathOrbs]]
+			
+			#The pure environment orbitals have to be either empty or doubly occupied
+			core_cutoff = max(0.01, threshold or 0.0)
+			bad = (pureEnvals >= core_cutoff) & (pureEnvals <= 2.0 - core_cutoff)
+			if bad.any():
+				raise Exception('Bad DMET bath orbital selection: trying to put a bath orbital with occupation ' + str(pureEnvals[bad][0]) + ' into the environment')
+			core = np.zeros((numTotalOrbs, np.sum(pureEnvals > 2.0 - core_cutoff)))
+			core[env_idx] = eigenvecs[:,idx[numBathOrbs:][pureEnvals > 2.0 - core_cutoff]]
+			return (numBathOrbs, emb_orbs, core)
+			
+		FBEorbs = np.zeros((numTotalOrbs, numTotalOrbs))
+		FBEorbs[imp_idx,:numImpOrbs] = eigenvecs_frag
+		FBEorbs[env_idx,numImpOrbs:] = eigenvecs[:,idx]
+		return (numBathOrbs, FBEorbs, coreOccupations)
 
-		
+def occupied_complement(Occ, Vt):
+	'''
+	The occupied orbitals orthogonal to Occ * Vt.T: Occ * Q[:,k:] where Q.T * Vt.T = R (QR of the k rows of Vt),
+	Q is applied as Householder reflectors, O(N n_occ k)
+	'''
+	if Vt.shape[0] == 0: return Occ
+	qr, tau = scipy.linalg.qr(Vt.T, mode = 'raw')[0]
+	return scipy.linalg.lapack.dormqr('R', 'N', qr, tau, Occ, max(1, Occ.shape[0]))[0][:,Vt.shape[0]:]
+	
+def batch_baths(mf, impClusters, orthoOED, bath_threshold = None):
+	'''
+	Construct the SVD baths (schmidt_decomposition_method = 'SVD') of all the fragments together: the fragment rows 
+	of the occupied orbitals of the fragments of the same size are decomposed with batched svd calls (BATH_BATCH fragments each).
+	Only the SVD baths are batched, the OED baths are built one fragment at a time by RHF_decomposition.UsingOED, 
+	stacking the (N - n) x (N - n) environment blocks costs memory without a speedup.
+	Args:
+		impClusters	: a list of arrays, the fragment orbitals of each fragment are labeled by 1
+		orthoOED	: MO coefficients and 1-RDM in orthonormal basis from Orthobasis.construct_orthoOED
+		bath_threshold	: see RHF_decomposition.bath_threshold
+	Return:
+		a list of (numBathOrbs, emb_orbs, core_orbs, discarded_occupation), one for each fragment: RHF_decomposition.baths() 
+		with emb_only = True and the discarded occupation of the truncated bath orbitals (RHF_decomposition.discarded_occupation)
+	'''
+	nelec_pairs = mf.mol.nelectron // 2
+	Occ = orthoOED[0][:,:nelec_pairs]
+	imp_idx = [np.flatnonzero(np.abs(impOrbs) == 1) for impOrbs in impClusters]
+	
+	baths = [None]*len(impClusters)
+	sizes = np.asarray([idx.size for idx in imp_idx])
+	for size in np.unique(sizes):
+		same_size = np.flatnonzero(sizes == size)
+		for first in range(0, same_size.size, BATH_BATCH):
+			group = same_size[first:first + BATH_BATCH]
+			imp = np.asarray([imp_idx[frag] for frag in group])			# (G, n)
+			svd = np.linalg.svd(Occ[imp], full_matrices = (nelec_pairs < size))
+			for count, frag in enumerate(group):
+				schmidt = RHF_decomposition(mf, np.abs(impClusters[frag]), size, orthoOED, 'SVD')
+				baths[frag] = schmidt.UsingSVD(size, threshold = 1e-7, svd = (svd[0][count], svd[1][count], svd[2][count]), bath_threshold = bath_threshold) + (schmidt.discarded_occupation,)
+	return baths
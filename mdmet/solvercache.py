@@ -0,0 +1,142 @@
+'''
+Multipurpose Density Matrix Embedding theory (mp-DMET)
+Copyright (C) 2015 Hung Q. Pham
+Author: Hung Q. Pham, Unviversity of Minnesota
+email: phamx494@umn.edu
+
+Content-addressed cache of the embedding solutions (ImpEnergy, E_emb, RDM1) in front of QCsolvers.
+An embedding problem is identified by a hash of its integrals and solver settings, so that the same problem solved
+again (line searches, chemical potential fits or a restarted calculation) is read from the cache instead.
+The entries are kept in memory and, optionally, in a directory on disk, each with its own budget and LRU eviction.
+'''
+
+import numpy as np
+import os, hashlib, tempfile
+from collections import OrderedDict
+
+def problem_key(OEI, TEI, JK, Nel, Nimp, chempot, solver, CAS = None, CAS_MO = None):
+	'''
+	Fingerprint of an embedding problem
+	Args:
+		OEI, TEI, JK			: the integrals of the embedding problem in the Schmidt basis (TEI can be None)
+		solver					: the solver name, e.g. 'CASCI'
+		CAS, CAS_MO				: the active space settings of the CAS solvers
+	Return:
+		a hex string (SHA-1)
+	'''
+	sha = hashlib.sha1()
+	for array in [OEI, TEI, JK]:
+		if array is None:
+			sha.update(b'None')
+		else:
+			array = np.ascontiguousarray(array, dtype = np.float64)
+			sha.update(str(array.shape).encode())
+			sha.update(array.tobytes())
+	sha.update(repr((int(Nel), int(Nimp), float(chempot), solver, CAS)).encode())
+	sha.update(b'None' if CAS_MO is None else np.ascontiguousarray(CAS_MO).tobytes())
+	return sha.hexdigest()
+
+class SolverCache:
+	def __init__(self, max_memory = 256, directory = None, max_disk = 4096):
+		'''
+		Args:
+			max_memory		: the memory budget (MB) of the entries kept in memory
+			directory		: a directory to store the entries on disk (one .npz file per entry), None for a memory-only cache.
+							  The disk cache is shared by all the calculations using the same directory, e.g. to restart a scan
+			max_disk		: the disk budget (MB) of the entries in directory
+		'''
+		self.max_memory = max_memory
+		self.max_disk = max_disk
+		self.directory = directory
+		self.entries = OrderedDict()		# key: (ImpEnergy, E_emb, RDM1), the least recently used entry first
+		self.memory = 0
+		self.hits = 0
+		self.misses = 0
+		if directory is not None: os.makedirs(directory, exist_ok = True)
+
+	def get(self, key):
+		'''
+		Return:
+			(ImpEnergy, E_emb, RDM1), None if the problem is not in the cache
+		'''
+		if key in self.entries:
+			self.entries.move_to_end(key)
+			self.hits += 1
+			ImpEnergy, E_emb, RDM1 = self.entries[key]
+			return ImpEnergy, E_emb, RDM1.copy()
+
+		filename = self.filename(key)
+		if filename is not None and os.path.isfile(filename):
+			try:
+				with np.load(filename) as data:
+					result = (float(data['ImpEnergy']), float(data['E_emb']), data['RDM1'])
+			except (IOError, ValueError, KeyError):
+				self.misses += 1
+				return None
+			try:
+				os.utime(filename)			#The modification time orders the disk entries for the LRU eviction
+			except FileNotFoundError:
+				pass
+			self.put_memory(key, result)
+			self.hits += 1
+			return result[0], result[1], result[2].copy()
+
+		self.misses += 1
+		return None
+
+	def put(self, key, ImpEnergy, E_emb, RDM1):
+		'''
+		Store the solution of the problem key in memory and on disk
+		'''
+		result = (float(ImpEnergy), float(E_emb), np.array(RDM1, dtype = np.float64))
+		self.put_memory(key, result)
+		filename = self.filename(key)
+		if filename is not None:
+			#Written to a unique temporary file then renamed, so that an interrupted calculation does not leave a truncated entry 
+			#and the processes writing the same entry (n_workers > 1) do not overwrite each other's file
+			fd, temp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp.npz')
+			with os.fdopen(fd, 'wb') as f:
+				np.savez(f, ImpEnergy = result[0], E_emb = result[1], RDM1 = result[2])
+			os.replace(temp, filename)
+			self.evict_disk()
+
+	def put_memory(self, key, result):
+		if key in self.entries: self.memory -= self.entries.pop(key)[2].nbytes
+		self.entries[key] = result
+		self.memory += result[2].nbytes
+		while self.memory > self.max_memory * 1e6 and len(self.entries) > 0:
+			self.memory -= self.entries.popitem(last = False)[1][2].nbytes
+
+	def evict_disk(self):
+		'''
+		Remove the least recently used files until the directory fits in max_disk,
+		the files already removed by another process sharing the directory are skipped
+		'''
+		files = []
+		for name in os.listdir(self.directory):
+			if not name.endswith('.npz') or name.endswith('.tmp.npz'): continue
+			try:
+				stat = os.stat(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, name))
+		files.sort()
+		total = sum(size for mtime, size, name in files)
+		for mtime, size, name in files:
+			if total <= self.max_disk * 1e6: break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				pass
+			total -= size
+
+	def filename(self, key):
+		if self.directory is None: return None
+		return os.path.join(self.directory, key + '.npz')
+
+	def clear(self):
+		'''
+		Empty the memory cache, the files on disk are kept
+		'''
+		self.entries.clear()
+		self.memory = 0
@@ -6,7 +6,7 @@ import pyscf
 from pyscf import gto, scf, ao2mo
 import numpy as np
 import pytest
-from mdmet import orthobasis, schmidtbasis, qcsolvers
+from mdmet import orthobasis, schmidtbasis, qcsolvers, dmet
 from functools import reduce
 
 numBathOrbs = 2
@@ -144,4 +144,98 @@ def test_bathconstruction():
 	assert np.isclose(Etest1 + Eemb1, mf.energy_elec()[0])
 	assert np.isclose(Etest1, Etest2)
 	assert np.isclose(Eimp1, Eimp2)	
-	
\ No newline at end of file
+	
+def test_svd_bath():
+	mol, mf, impOrbs  = test_makemole()
+	
+	umat = np.zeros((mol.nao_nr(), mol.nao_nr()))
+	ortho = orthobasis.Orthobasis(mf, method = 'overlap')
+	orthoOED = ortho.construct_orthoOED(umat, OEH_type = 'FOCK')
+	schmidt = schmidtbasis.RHF_decomposition(mf, impOrbs, numBathOrbs, orthoOED)	
+	
+	schmidt.method = 'OED'	
+	BathOrbs1, FBEorbs1, core_eigenvals = schmidt.baths()
+	schmidt.method = 'SVD'	
+	BathOrbs2, emb_orbs, core_orbs = schmidt.baths()
+	
+	numAct = 2*numBathOrbs
+	assert BathOrbs1 == BathOrbs2
+	assert emb_orbs.shape[1] == numAct
+	assert np.allclose(np.dot(emb_orbs.T, emb_orbs), np.eye(numAct))
+	assert np.allclose(np.dot(emb_orbs.T, core_orbs), 0.0)
+	
+	#Same embedding space and core 1RDM as the OED bath
+	assert np.allclose(np.dot(FBEorbs1[:,:numAct], FBEorbs1[:,:numAct].T), np.dot(emb_orbs, emb_orbs.T))
+	assert np.allclose(reduce(np.dot, (FBEorbs1, np.diag(core_eigenvals), FBEorbs1.T)), 2*np.dot(core_orbs, core_orbs.T))
+	
+def test_batch_baths():
+	mol, mf, impClusters = test_makemole2()
+	
+	umat = np.zeros((mol.nao_nr(), mol.nao_nr()))
+	ortho = orthobasis.Orthobasis(mf, method = 'overlap')
+	orthoOED = ortho.construct_orthoOED(umat, OEH_type = 'FOCK')
+	baths = schmidtbasis.batch_baths(mf, impClusters, orthoOED)
+	for impOrbs, bath in zip(impClusters, baths):
+		schmidt = schmidtbasis.RHF_decomposition(mf, impOrbs, impOrbs.sum(), orthoOED, 'SVD')
+		schmidt.emb_only = True
+		numBathOrbs, emb_orbs, core_orbs = schmidt.baths()
+		assert numBathOrbs == bath[0]
+		assert np.allclose(emb_orbs, bath[1])
+		assert np.allclose(core_orbs, bath[2])
+		assert bath[3] == schmidt.discarded_occupation == 0.0
+	
+def test_bath_truncation():
+	mol, mf, impClusters = test_makemole2()
+	
+	umat = np.zeros((mol.nao_nr(), mol.nao_nr()))
+	ortho = orthobasis.Orthobasis(mf, method = 'overlap')
+	orthoOED = ortho.construct_orthoOED(umat, OEH_type = 'FOCK')
+	impOrbs = impClusters[1]
+	
+	#The discarded occupation: Sum of min(occ, 2 - occ) of the bath orbitals (the environment orbitals with the n_imp occupations closest to 1) within 0.05 of 0 or 2
+	env = impOrbs == 0
+	occupation = np.linalg.eigvalsh(orthoOED[1][np.ix_(env, env)])
+	entanglement = np.sort(np.minimum(occupation, 2 - occupation))[::-1][:impOrbs.sum()]
+	discarded_occupation = entanglement[entanglement <= 0.05].sum()
+	assert discarded_occupation > 0.0
+	
+	baths = []
+	for method in ['OED', 'SVD']:
+		schmidt = schmidtbasis.RHF_decomposition(mf, impOrbs, impOrbs.sum(), orthoOED, method)
+		schmidt.emb_only = True
+		schmidt.bath_threshold = 0.05
+		baths.append(schmidt.baths())
+		assert baths[-1][0] < impOrbs.sum()
+		assert np.isclose(schmidt.discarded_occupation, discarded_occupation)
+		
+	#The discarded occupation of each fragment is kept by the DMET results
+	for method in ['OED', 'SVD']:
+		runDMET = dmet.DMET(mf, impClusters, None, orthogonalize_method = 'overlap', schmidt_decomposition_method = method, OEH_type = 'FOCK', solver = 'RHF')
+		runDMET.bath_threshold = 0.05
+		runDMET.kernel()
+		assert np.isclose(runDMET.emb_discarded_occupation[1], discarded_occupation)
+		assert np.isclose(runDMET.embedding_cache[2][1]['discarded_occupation'], discarded_occupation)
+		
+	#Both constructions truncate the same bath orbitals
+	(numBathOrbs1, emb_orbs1, core_orbs1), (numBathOrbs2, emb_orbs2, core_orbs2) = baths
+	assert numBathOrbs1 == numBathOrbs2
+	assert np.allclose(np.dot(emb_orbs1, emb_orbs1.T), np.dot(emb_orbs2, emb_orbs2.T))
+	assert np.allclose(np.dot(core_orbs1, core_orbs1.T), np.dot(core_orbs2, core_orbs2.T))
+	
+def test_overlap_bath_emb_only():
+	mol, mf, impOrbs  = test_makemole()
+	
+	umat = np.zeros((mol.nao_nr(), mol.nao_nr()))
+	ortho = orthobasis.Orthobasis(mf, method = 'overlap')
+	orthoOED = ortho.construct_orthoOED(umat, OEH_type = 'FOCK')
+	schmidt = schmidtbasis.RHF_decomposition(mf, impOrbs, numBathOrbs, orthoOED, 'overlap')
+	BathOrbs1, FBEorbs, entorbs = schmidt.baths()
+	schmidt.emb_only = True
+	BathOrbs2, emb_orbs, core_orbs = schmidt.baths()
+	
+	numAct = 2*numBathOrbs
+	assert BathOrbs1 == BathOrbs2
+	assert np.allclose(FBEorbs[:,:numAct], emb_orbs)
+	assert np.allclose(np.dot(FBEorbs[:,numAct:], FBEorbs[:,numAct:].T), np.dot(core_orbs, core_orbs.T))
+	assert np.allclose(np.dot(core_orbs.T, core_orbs), np.eye(core_orbs.shape[1]))
+	assert np.allclose(2*(np.dot(entorbs, entorbs.T) + np.dot(core_orbs, core_orbs.T)), orthoOED[1])
@@ -6,7 +6,10 @@ import pyscf
 from pyscf import gto, scf, ao2mo
 import numpy as np
 import pytest
-from mdmet import orthobasis, schmidtbasis, qcsolvers, dmet
+import os, sys, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pyscf import lib
+from mdmet import orthobasis, schmidtbasis, qcsolvers, solvercache, dmet
 
 def test_makemole1():
 	bondlength = 1.0
@@ -127,4 +130,289 @@ def test_rdm_diff():
 	CF1 = runDMET.costfunction(umat1)
 	CF2 = runDMET.costfunction(umat2) 
 	assert (CF1 < 1e-8)
-	assert (CF2 > 1e-5)
\ No newline at end of file
+	assert (CF2 > 1e-5)	
+
+	
+def test_parallel_kernel():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = None
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	
+	#The workers are started after the OpenMP regions of the serial kernel
+	n_threads = lib.num_threads()
+	lib.num_threads(4)
+	try:
+		Nelecs_serial = runDMET.kernel()
+		Eserial = runDMET.fragment_energies.copy()
+		RDM1_serial = runDMET.emb_1RDM
+		runDMET.n_workers = 3
+		Nelecs_parallel = runDMET.kernel()
+		
+		#The same workers solve the next kernel calls
+		workers = runDMET.workers
+		runDMET.kernel(chempot = 0.1)
+		assert runDMET.workers is workers
+		runDMET.kernel()
+	finally:
+		lib.num_threads(n_threads)
+		runDMET.close_workers()
+	
+	assert runDMET.workers is None
+	assert np.isclose(Nelecs_serial, Nelecs_parallel)
+	assert np.allclose(Eserial, runDMET.fragment_energies)
+	for RDM1_1, RDM1_2 in zip(RDM1_serial, runDMET.emb_1RDM):
+		assert np.allclose(RDM1_1, RDM1_2)
+		
+def test_parallel_kernel_without_main_guard(tmp_path):
+	#The spawned workers import the script and cannot start without if __name__ == '__main__':, the fragments are then solved serially
+	script = tmp_path / 'driver.py'
+	script.write_text(
+		"import sys\n"
+		"sys.path.insert(0, %r)\n"
+		"from test_dmet import test_makemole2\n"
+		"from mdmet import dmet\n"
+		"mol, mf, impClusters = test_makemole2()\n"
+		"runDMET = dmet.DMET(mf, impClusters, None, solver = 'RHF', n_workers = 2)\n"
+		"print('Nelecs', runDMET.kernel(), runDMET.n_workers)\n" % os.path.dirname(os.path.abspath(__file__)))
+	output = subprocess.run([sys.executable, str(script)], capture_output = True, text = True, timeout = 600)
+	assert output.returncode == 0, output.stderr
+	assert 'the fragments are solved serially' in output.stdout
+	assert output.stdout.splitlines()[-1].split()[-1] == '1'
+	
+def test_embedding_cache():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.kernel(chempot = 0.0)
+	embeddings = runDMET.embedding_cache[2]
+	
+	#The cached embedding problems keep the core orbitals, not the dense N x N core density
+	for embedding in embeddings:
+		assert 'core1RDM_ortho' not in embedding
+		assert embedding['core_orbs'].shape == (runDMET.Norbs, runDMET.Nelecs//2 - embedding['Nelec_in_imp']//2)
+	runDMET.kernel(chempot = 0.1)
+	assert all(emb1 is emb2 for emb1, emb2 in zip(embeddings, runDMET.embedding_cache[2]))
+	runDMET.uvec = np.random.rand(runDMET.uvec.size)*0.01
+	runDMET.kernel(chempot = 0.1)
+	assert all(emb1 is not emb2 for emb1, emb2 in zip(embeddings, runDMET.embedding_cache[2]))
+	
+def test_costfunction_and_gradient():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.one_shot()
+	uvec = np.random.rand(runDMET.uvec.size)*0.05
+	CF, CF_gradient = runDMET.costfunction_and_gradient(uvec)
+	assert np.isclose(CF, runDMET.costfunction(uvec))
+	assert np.allclose(CF_gradient, runDMET.costfunction_gradient(uvec))
+	
+def test_projected_1RDM_response():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	for OEH_type in ['FOCK', 'OEI']:
+		runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = OEH_type, SC_CFtype = 'FB', solver = 'RHF')
+		runDMET.kernel()
+		uvec = np.random.rand(runDMET.uvec.size)*0.05
+		RDM_deriv = runDMET.construct_1RDM_response(uvec)
+		RDM_deriv_schmidt = runDMET.construct_projected_1RDM_response(uvec)
+		for fragment, transform_mat in enumerate(runDMET.schmidt_transforms()):
+			projected = np.einsum('pa,upq,qb->uab', transform_mat, RDM_deriv, transform_mat)
+			assert np.allclose(projected, RDM_deriv_schmidt[fragment])
+	
+def test_numpy_response():
+	if dmet.libdmet is None: pytest.skip('libdmet is not compiled')
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.kernel()
+	uvec = np.random.rand(runDMET.uvec.size)*0.05
+	RDM_deriv_libdmet = runDMET.construct_1RDM_response(uvec)
+	CF_gradient_libdmet = runDMET.costfunction_and_gradient(uvec)[1]
+	runDMET.response_backend = 'numpy'
+	runDMET.CF_cache.clear()
+	RDM_deriv_numpy = runDMET.construct_1RDM_response(uvec)
+	CF_gradient_numpy = runDMET.costfunction_and_gradient(uvec)[1]
+	assert np.allclose(RDM_deriv_libdmet, RDM_deriv_numpy)
+	assert np.allclose(CF_gradient_libdmet, CF_gradient_numpy)
+	
+def test_warm_start():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = None
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASCI')
+	runDMET.CAS = [(4, 8)]*len(impClusters)
+	runDMET.solver_conv_tol = (1e-11, 1e-7)
+	runDMET.kernel(chempot = 0.0)
+	runDMET.uvec = np.random.RandomState(3).rand(runDMET.uvec.size)*0.01
+	Nelecs_warm = runDMET.kernel(chempot = 0.01)
+	Ewarm = runDMET.fragment_energies.copy()
+	
+	#The CI vector of the previous solution is used when the CI space (784 determinants for CAS(4,8)) is larger than pspace_size
+	for state in runDMET.solver_state.values():
+		assert state['ci'].size > 400 and state['ci_warm_start']
+			
+	runDMET.warm_start = False
+	Nelecs_cold = runDMET.kernel(chempot = 0.01)
+	assert len(runDMET.solver_state) == len(impClusters)
+	assert np.isclose(Nelecs_warm, Nelecs_cold)
+	assert np.allclose(Ewarm, runDMET.fragment_energies)
+	
+	#CASSCF is warm-started from the previous RHF orbitals and CI vector, it finds the same solution as a cold solve
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASSCF')
+	runDMET.CAS = [(4, 4)]*len(impClusters)
+	runDMET.kernel(chempot = 0.0)
+	runDMET.kernel(chempot = 0.01)
+	Ewarm = runDMET.fragment_energies.copy()
+	runDMET.warm_start = False
+	runDMET.solver_conv_tol = dmet.WARM_START_CONV_TOL
+	runDMET.kernel(chempot = 0.01)
+	assert np.allclose(Ewarm, runDMET.fragment_energies, atol = 1e-6)
+	
+def test_warm_start_one_shot():
+	#With the default settings (warm_start = True), the chemical potential search converges to the energy of the cold solves
+	mol, mf, impClusters  = test_makemole2()
+	results = []
+	for warm_start in [True, False]:
+		runDMET = dmet.DMET(mf, impClusters, None, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASCI')
+		runDMET.CAS = [(4, 8)]*len(impClusters)
+		if warm_start == False:
+			runDMET.warm_start = False
+			runDMET.solver_conv_tol = dmet.WARM_START_CONV_TOL
+		runDMET.one_shot()
+		results.append((runDMET.Energy_total, runDMET.chempot))
+	assert np.isclose(results[0][0], results[1][0], atol = 1e-8)
+	assert np.isclose(results[0][1], results[1][1], atol = 1e-6)
+	
+def test_density_fitting():
+	mol, mf, impClusters  = test_makemole2()
+	mf = mf.density_fit()
+	mf.scf()
+	symmetry = None
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF', eri_type = 'DF')
+	Nelecs = runDMET.kernel()
+	Etotal = runDMET.fragment_energies.sum()
+
+	assert runDMET.orthobasis.orthoTEI is None
+	assert np.isclose(Nelecs, mol.nelectron)
+	assert np.isclose(Etotal, mf.energy_elec()[0])
+	
+	#The factorized core J/K (core orbitals) are the same as those of the dense core density
+	orbs = np.linalg.qr(np.random.rand(runDMET.Norbs, runDMET.Norbs))[0]
+	emb_orbs, core_orbs = orbs[:,:6], orbs[:,6:10]
+	core1RDM = 2 * np.dot(core_orbs, core_orbs.T)
+	assert np.allclose(runDMET.orthobasis.dmet_corejk(emb_orbs, 6, core1RDM, core_orbs), runDMET.orthobasis.dmet_corejk(emb_orbs, 6, core1RDM))
+	
+def test_outcore_integrals():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.kernel(chempot = 0.1)
+	Eincore = runDMET.fragment_energies.copy()
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF', eri_type = 'outcore')
+	runDMET.orthobasis.max_memory = 1
+	runDMET.kernel(chempot = 0.1)
+	
+	assert runDMET.orthobasis.orthoTEI is None
+	assert np.allclose(Eincore, runDMET.fragment_energies)
+	
+def test_tei_batch():
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = None
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.kernel()
+	emb_orbs_list = [emb_orbs[:,:4] for emb_orbs in runDMET.emb_orbs]
+	teis = runDMET.orthobasis.dmet_tei_batch(emb_orbs_list)
+	for emb_orbs, tei in zip(emb_orbs_list, teis):
+		assert np.allclose(tei, runDMET.orthobasis.dmet_tei(emb_orbs, 4))
+		
+	#Several blocks of orthoTEI_s8 rows and several groups of fragments
+	runDMET.orthobasis.max_memory = 5
+	teis = runDMET.orthobasis.dmet_tei_batch(runDMET.emb_orbs)
+	for emb_orbs, tei in zip(runDMET.emb_orbs, teis):
+		assert np.allclose(tei, runDMET.orthobasis.dmet_tei(emb_orbs, emb_orbs.shape[1]))
+		
+def test_solver_cache(tmpdir):
+	mol, mf, impClusters  = test_makemole2()
+	symmetry = [0, 1, 2, 1, 0]
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.solver_cache = solvercache.SolverCache(directory = str(tmpdir))
+	runDMET.kernel(chempot = 0.1)
+	Ecached = runDMET.fragment_energies.copy()
+	runDMET.kernel(chempot = 0.1)
+	assert runDMET.solver_cache.hits == 3 and runDMET.solver_cache.misses == 3
+	assert np.allclose(Ecached, runDMET.fragment_energies)
+	
+	#A restarted calculation reads the solutions from the disk
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'RHF')
+	runDMET.solver_cache = solvercache.SolverCache(directory = str(tmpdir))
+	runDMET.kernel(chempot = 0.1)
+	assert runDMET.solver_cache.hits == 3 and runDMET.solver_cache.misses == 0
+	assert np.allclose(Ecached, runDMET.fragment_energies)
+	runDMET.kernel(chempot = 0.2)
+	assert runDMET.solver_cache.misses == 3
+	
+	#LRU eviction within the memory budget
+	cache = solvercache.SolverCache(max_memory = 1.5e-4)		#Two 3 x 3 RDM1s
+	RDM1 = np.eye(3)
+	for key in ['a', 'b', 'c']: cache.put(key, 0.0, 0.0, RDM1)
+	assert list(cache.entries.keys()) == ['b', 'c']
+	assert cache.get('a') is None and cache.get('b') is not None
+	cache.put('d', 0.0, 0.0, RDM1)
+	assert list(cache.entries.keys()) == ['b', 'd']
+	
+	#Several processes writing and evicting the same entries of a shared directory
+	with ProcessPoolExecutor(max_workers = 4, mp_context = multiprocessing.get_context('fork')) as executor:
+		list(executor.map(_fill_solver_cache, [str(tmpdir)]*8))
+	names = os.listdir(str(tmpdir))
+	assert len(names) > 0
+	assert not any(name.endswith('.tmp.npz') for name in names)
+	
+def _fill_solver_cache(directory):
+	cache = solvercache.SolverCache(directory = directory, max_disk = 2e-3)
+	for count in range(100):
+		cache.put('key' + str(count % 7), 0.0, 0.0, np.eye(8))
+		cache.get('key' + str((count + 3) % 7))
+	
+def test_SC_mixing():
+	mol, mf, impClusters  = test_makemole1()
+	symmetry = [0]*5
+	results = []
+	for SC_mixing, SC_damping in [('damping', 0.0), ('damping', 0.5), ('DIIS', 0.0)]:
+		runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASCI')
+		runDMET.SC_mixing = SC_mixing
+		runDMET.SC_damping = SC_damping
+		runDMET.self_consistent()
+		results.append((runDMET.uvec, runDMET.Energy_total, runDMET.SC_cycles))
+		
+	#The damped umat is the one used in the next cycle, all the mixing schemes converge to the same umat
+	for uvec, Energy_total, SC_cycles in results[1:]:
+		assert np.allclose(uvec, results[0][0], atol = 1e-6)
+		assert np.isclose(Energy_total, results[0][1], atol = 1e-6)
+	assert results[2][2] < results[0][2] < results[1][2]
+	
+def test_lstsq_SC_methods():
+	mol, mf, impClusters  = test_makemole1()
+	symmetry = [0]*5
+	runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASCI')
+	runDMET.one_shot()
+	
+	#Finite-difference Jacobian of the residuals, CF = Sum_i r_i^2
+	uvec = np.random.rand(runDMET.Nterms)*0.01
+	residuals, jacobian = runDMET.residuals_and_jacobian(uvec)
+	assert np.isclose(np.dot(residuals, residuals), runDMET.costfunction_and_gradient(uvec)[0])
+	step = 1e-5
+	for term in range(runDMET.Nterms):
+		shift = np.zeros(runDMET.Nterms)
+		shift[term] = step
+		fd = (runDMET.lstsq_residuals(uvec + shift) - runDMET.lstsq_residuals(uvec - shift)) / (2*step)
+		assert np.allclose(jacobian[:,term], fd, atol = 1e-7)
+	
+	#LM and GN converge to the BFGS umat
+	results = []
+	for SC_method in ['BFGS', 'LM', 'GN']:
+		runDMET = dmet.DMET(mf, impClusters, symmetry, orthogonalize_method = 'overlap', schmidt_decomposition_method = 'OED', OEH_type = 'FOCK', SC_CFtype = 'FB', solver = 'CASCI')
+		runDMET.SC_method = SC_method
+		runDMET.self_consistent()
+		results.append((runDMET.uvec, runDMET.Energy_total))
+	for uvec, Energy_total in results[1:]:
+		assert np.allclose(uvec, results[0][0], atol = 1e-6)
+		assert np.isclose(Energy_total, results[0][1], atol = 1e-6)
@@ -35,6 +35,56 @@ def test_hubbard2D():
 	mf_hubbard = hubbard_2D_rectangular(num_sites, filling, t, U, boundary_conditions = 'antipbc', site_energy = None, no_hopping = None)
 	return mf_hubbard
 	
+def test_hubbard_onsite_integrals():
+	num_sites = 12
+	U = 4.0
+	site_energy = [0.3, 0] * 6
+	mf_hubbard = hubbard_1D(num_sites, 0.5, -1.0, U, 'open', site_energy, None)
+	mf_hubbard.kernel()
+	impClusters = [[1 if site//2 == frag else 0 for site in range(num_sites)] for frag in range(num_sites//2)]
+	
+	runDMET = dmet.DMET(mf_hubbard, impClusters, None, orthogonalize_method = 'lattice', solver = 'RHF')
+	assert runDMET.orthobasis.eri_type == 'hubbard'
+	assert runDMET.orthobasis.orthoTEI is None
+	runDMET.one_shot()
+	
+	#Reference: the same lattice through the dense TEI
+	mf_hubbard.hubbard_U = None
+	refDMET = dmet.DMET(mf_hubbard, impClusters, None, orthogonalize_method = 'lattice', solver = 'RHF')
+	assert refDMET.orthobasis.eri_type == 'incore'
+	refDMET.one_shot()
+	assert np.isclose(runDMET.Energy_total, refDMET.Energy_total)
+	
+	emb_orbs = np.linalg.qr(np.random.rand(num_sites, 5))[0]
+	core_orbs = np.linalg.qr(np.random.rand(num_sites, 3))[0]
+	core1RDM = 2 * np.dot(core_orbs, core_orbs.T)
+	assert np.allclose(runDMET.orthobasis.dmet_tei(emb_orbs, 5), refDMET.orthobasis.dmet_tei(emb_orbs, 5))
+	assert np.allclose(runDMET.orthobasis.dmet_corejk(emb_orbs, 5, core1RDM, core_orbs), refDMET.orthobasis.dmet_corejk(emb_orbs, 5, core1RDM))
+	
+def test_kspace_mean_field():
+	num_sites = 18
+	mf_hubbard = hubbard_1D(num_sites, 0.5, 1.0, 4.0, 'pbc', None, None)
+	impClusters = [[1 if site//2 == frag else 0 for site in range(num_sites)] for frag in range(num_sites//2)]
+	runDMET = dmet.DMET(mf_hubbard, impClusters, 'Translation', orthogonalize_method = 'lattice', solver = 'RHF')
+	assert runDMET.orthobasis.kmf['FOCK'] is not None
+	runDMET.kernel()
+	
+	uvec = np.random.rand(runDMET.uvec.size) * 0.3
+	umat = runDMET.uvec2umat(uvec)
+	eigenvals, eigenvecs, orthoOED = runDMET.orthobasis.construct_orthoMF(umat, 'FOCK')
+	CF, CF_gradient = runDMET.costfunction_and_gradient(uvec)
+	
+	#Reference: the dense mean field and response
+	runDMET.orthobasis.kmf = None
+	runDMET.CF_cache.clear()
+	ref_eigenvals, ref_eigenvecs, ref_orthoOED = runDMET.orthobasis.construct_orthoMF(umat, 'FOCK')
+	ref_CF, ref_CF_gradient = runDMET.costfunction_and_gradient(uvec)
+	assert np.allclose(eigenvals, ref_eigenvals)
+	assert np.allclose(orthoOED, ref_orthoOED)
+	assert np.allclose(np.dot(eigenvecs.T, eigenvecs), np.eye(num_sites))
+	assert np.isclose(CF, ref_CF)
+	assert np.allclose(CF_gradient, ref_CF_gradient)
+	
 '''def test_hubbard1D_DMET():
 	EFCI, mf_hubbard = test_hubbard1D_FCI()	
 	impClusters = [[1, 1, 0, 0],[0, 0, 1, 1]]
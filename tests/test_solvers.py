@@ -3,7 +3,7 @@ Testing the self_consistent DMET
 '''
 
 import sys, os
-from pyscf import gto, scf
+from pyscf import gto, scf, ao2mo, fci
 import numpy as np
 import pytest
 from mdmet import orthobasis, schmidtbasis, qcsolvers, dmet
@@ -91,3 +91,72 @@ def test_solvers():
 		os.system('rm -rf ' + str(i) + '*')
 
 
+	
+class MockHamCheMPS2:
+	'''
+	Stores T and V like the CheMPS2 Hamiltonian: one element for each set of elements related by symmetry (physics notation)
+	'''
+	def __init__(self):
+		self.T = {}
+		self.V = {}
+		
+	def setTmat(self, i, j, value):
+		self.T[min(i, j), max(i, j)] = value
+		
+	def Vkey(self, i, j, k, l):
+		return min([(i,j,k,l), (j,i,l,k), (k,l,i,j), (l,k,j,i), (k,j,i,l), (l,i,j,k), (i,l,k,j), (j,k,l,i)])
+		
+	def setVmat(self, i, j, k, l, value):
+		self.V[self.Vkey(i, j, k, l)] = value
+		
+	def getVmat(self, i, j, k, l):
+		return self.V[self.Vkey(i, j, k, l)]
+		
+class MockDMRG:
+	'''
+	get2DMA from a 2RDM in chemist notation
+	'''
+	def __init__(self, RDM2):
+		self.RDM2 = RDM2
+		self.calls = 0
+		
+	def get2DMA(self, i, j, k, l):
+		self.calls += 1
+		return self.RDM2[i, k, j, l]
+		
+def test_chemps2_bulk_transfer():
+	Norb = 6
+	FOCK = np.random.rand(Norb, Norb)
+	FOCK = FOCK + FOCK.T
+	npair = Norb*(Norb + 1)//2
+	TEI = ao2mo.restore(1, np.random.rand(npair*(npair + 1)//2), Norb)
+	
+	HamCheMPS2 = MockHamCheMPS2()
+	qcsolvers.chemps2_set_integrals(HamCheMPS2, FOCK, TEI)
+	assert len(HamCheMPS2.T) == npair and len(HamCheMPS2.V) == npair*(npair + 1)//2
+	for i, j, k, l in np.ndindex(Norb, Norb, Norb, Norb):
+		assert np.isclose(HamCheMPS2.getVmat(i, k, j, l), TEI[i, j, k, l])
+		assert np.isclose(HamCheMPS2.T[min(i, j), max(i, j)], FOCK[i, j])
+		
+	E, ci = fci.direct_spin1.kernel(FOCK, TEI, Norb, (3, 3))
+	RDM2 = fci.direct_spin1.make_rdm12(ci, Norb, (3, 3))[1]
+	theDMRG = MockDMRG(RDM2)
+	assert np.allclose(qcsolvers.chemps2_get_2rdm(theDMRG, Norb), RDM2)
+	assert theDMRG.calls < Norb**4 / 3
+	
+@pytest.mark.skipif(qcsolvers.libchemps2 is None, reason = 'libchemps2 (lib/libchemps2.cpp) is not compiled')
+def test_libchemps2():
+	Norb, Nel, Nimp = 6, 6, 2
+	OEI = np.random.rand(Norb, Norb)
+	OEI = OEI + OEI.T
+	npair = Norb*(Norb + 1)//2
+	TEI = ao2mo.restore(1, np.random.rand(npair*(npair + 1)//2), Norb)
+	JK = np.zeros([Norb, Norb])
+	E, ci = fci.direct_spin1.kernel(OEI, TEI, Norb, Nel)
+	RDM1 = fci.direct_spin1.make_rdm1(ci, Norb, Nel)
+	
+	solver = qcsolvers.QCsolvers(OEI, TEI, JK, None, Norb, Nel, Nimp)
+	EFCI, RDM1_FCI = solver.FCI()[1:]
+	EDMRG, RDM1_DMRG = solver.DMRG()[1:]
+	assert np.isclose(EFCI, E) and np.allclose(RDM1_FCI, RDM1)
+	assert np.isclose(EDMRG, E) and np.allclose(RDM1_DMRG, RDM1, atol = 1e-6)